@@ -0,0 +1,139 @@
+#!/usr/bin/python2.7
+import argparse
+import collections
+import json
+import logging
+import sys
+import kextindex
+import logformat
+import mappedfile
+import patch
+import patchorder
+import plistloader
+
+log = logging.getLogger("analyzepatches")
+
+# Report how the patches in a config.plist depend on their order: where
+# they overlap, which ones a Replace earlier in the sequence makes or
+# breaks matches for, and which are duplicates or do nothing. See
+# patchorder.py.
+
+KEXTS_PATH = ("KernelAndKextPatches", "KextsToPatch")
+DSDT_PATH = ("ACPI", "DSDT", "Patches")
+
+parser = argparse.ArgumentParser(description="Find Clover patches whose results depend on their order")
+parser.add_argument("--json", help="Write the findings as JSON", action="store_true")
+parser.add_argument("-v", "--verbose", help="Be more verbose, -vv for more", action="count")
+subparsers = parser.add_subparsers(dest="command")
+
+kexts_parser = subparsers.add_parser("kexts", help="Analyze kext patches against the kexts they patch")
+kexts_parser.add_argument("-a", "--enable-all",
+                          help="Pretend all patches are enabled, but do not do replacements for disabled ones",
+                          action="store_true")
+kexts_parser.add_argument("-e", "--extensions", action="append", metavar="DIR",
+                          help="Extensions directory to search; may be repeated. The default is /System/Library/Extensions and /Library/Extensions")
+kexts_parser.add_argument("config", help="path to config.plist", default="config.plist")
+
+dsdt_parser = subparsers.add_parser("dsdt", help="Analyze ACPI patches against AML files")
+dsdt_parser.add_argument("-c", "--config", default="config.plist",
+                         help="The clover config file. Defaults to config.plist.")
+dsdt_parser.add_argument("dsdt", nargs='+', metavar="DSDT.aml",
+                         help="One or more DSDT.aml/SSDT.aml files.")
+
+
+def describe(p, index):
+    return "#%d %s" % (index, p.comment or repr(p.find))
+
+
+def report(target, patches, indexes, findings, out):
+    """Log or collect findings for one target.
+
+    :param patches: the target's patches, in order
+    :param indexes: each patch's index in the config
+    :param out: list to add JSON-ready findings to, or None to log them
+    """
+    for f in findings:
+        p = patches[f.index]
+        others = [indexes[i] for i in f.others]
+        if out is not None:
+            d = f.as_dict()
+            d.update(target=target, index=indexes[f.index], comment=p.comment, others=others)
+            out.append(d)
+            continue
+        what = "%s: %s" % (target, describe(p, indexes[f.index]))
+        names = ", ".join(describe(patches[i], indexes[i]) for i in f.others)
+        if f.kind == "changes-nothing":
+            log.warning("%s: Find and Replace are the same", what)
+        elif f.kind == "duplicate":
+            log.warning("%s: duplicate of %s", what, names)
+        elif f.kind == "overlap":
+            log.info("%s: overlaps %s at %s", what, names, patch.format_offsets(f.overlaps))
+        else:
+            if f.kind == "shadowed":
+                log.warning("%s: matches nothing after %s", what, names or "earlier patches")
+            else:
+                log.warning("%s: matches depend on %s", what, names or "earlier patches")
+            if f.created:
+                log.info("  %d more in sequence, at %s", len(f.created), patch.format_offsets(f.created))
+            if f.destroyed:
+                log.info("  %d fewer in sequence, at %s", len(f.destroyed), patch.format_offsets(f.destroyed))
+
+
+def analyze_kexts(out):
+    config = plistloader.load(args.config, [KEXTS_PATH])
+    patches = patch.FilePatch.list_from_clover_config(config)
+    targets = collections.OrderedDict()
+    for i, p in enumerate(patches):
+        if args.enable_all or not p.disabled:
+            targets.setdefault(p.filename, []).append(i)
+    index = kextindex.KextIndex()
+    index.resolve(targets, args.extensions or ["/System/Library/Extensions", "/Library/Extensions"])
+    for name, indexes in targets.items():
+        group = [patches[i] for i in indexes]
+        try:
+            contents = mappedfile.MappedFile(index.binary_path(name))
+        except KeyError:
+            log.warning("No file found for %s", name)
+            continue
+        try:
+            findings = patchorder.analyze(contents, group, [p for p in group if p.disabled])
+        finally:
+            contents.close()
+        report(name, group, indexes, findings, out)
+
+
+def analyze_dsdt(out):
+    config = plistloader.load(args.config, [DSDT_PATH])
+    patches = patch.Patch.list_from_clover_config(config)
+    for name in args.dsdt:
+        with open(name, "rb") as f:
+            contents = f.read()
+        report(name, patches, range(len(patches)), patchorder.analyze(contents, patches), out)
+
+
+def main(argv=None):
+    global args
+    args = parser.parse_args(argv)
+    logformat.basic_config("%(levelname)-10s %(message)s")
+    for logger in [log, kextindex.log]:
+        if args.verbose == 1:
+            logger.setLevel(logging.INFO)
+        elif args.verbose >= 2:
+            logger.setLevel(logging.DEBUG)
+
+    findings = [] if args.json else None
+    if args.command == "kexts":
+        analyze_kexts(findings)
+    else:
+        analyze_dsdt(findings)
+    if args.json:
+        json.dump(findings, sys.stdout, indent=1, sort_keys=True, separators=(",", ": "))
+        sys.stdout.write("\n")
+    return 0
+
+
+# Set by main()
+args = None
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+#!/usr/bin/python2.7
+import argparse
+import collections
+import gzip
+import hashlib
+import json
+import os
+import platform
+import plistlib
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+
+import expectwriter
+import kextindex
+import mappedfile
+import patch
+import plistloader
+import plistwriter
+
+# Time the stages of the checkers against generated inputs.
+#
+# Inputs are made from a seed, so two revisions benchmarked with the same
+# arguments see the same bytes: an Extensions tree of kexts with nested
+# Contents/PlugIns and a few multi-MB binaries, DSDT/SSDT files, and
+# config.plists with each requested number of patches. Patch Finds are
+# planted in the binaries, so most patches match somewhere.
+#
+# Results are JSON; --compare prints the change from an earlier run.
+
+DSDT_PATH = ("ACPI", "DSDT", "Patches")
+KEXTS_PATH = ("KernelAndKextPatches", "KextsToPatch")
+
+parser = argparse.ArgumentParser(
+    description="Benchmark the patch checkers on generated inputs",
+    epilog="example: benchmark.py -p 10,100,1000 -o before.json")
+parser.add_argument("-p", "--patches", default="10,100,1000,5000",
+                    help="Comma-separated patch counts to generate configs for (default 10,100,1000,5000)")
+parser.add_argument("-k", "--kexts", type=int, default=300,
+                    help="Number of kexts in the generated Extensions tree (default 300)")
+parser.add_argument("--patched-kexts", type=int, default=8,
+                    help="Number of kexts the patches target, with large binaries (default 8)")
+parser.add_argument("--binary-mb", type=float, default=4,
+                    help="Size of each patched kext binary in MB (default 4)")
+parser.add_argument("--aml-kb", type=int, default=512,
+                    help="Size of DSDT.aml in KB (default 512)")
+parser.add_argument("--seed", default="clover", help="Seed for the generated inputs")
+parser.add_argument("-r", "--repeat", type=int, default=3,
+                    help="Time each stage N times and keep every timing (default 3)", metavar="N")
+parser.add_argument("-w", "--work-dir",
+                    help="Generate inputs here and keep them; by default a temporary directory is used and removed")
+parser.add_argument("--no-scripts", action="store_true",
+                    help="Skip timing the check-*-patches.py scripts end to end")
+parser.add_argument("-o", "--output", type=argparse.FileType("w"), default=sys.stdout,
+                    help="Write JSON results here (default stdout)")
+parser.add_argument("--compare", type=argparse.FileType("r"), metavar="OLD.json",
+                    help="Print each stage's best time against an earlier results file")
+
+# Set by main()
+args = None
+
+# Each timed() stage, for the report
+results = []
+
+
+class Generator:
+    """Deterministic bytes and choices from a seed."""
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.counter = 0
+
+    def bytes(self, n):
+        # sha256 in counter mode: fast enough for MBs, and the same
+        # everywhere, unlike random.Random across Python versions
+        blocks = []
+        for i in range((n + 31) // 32):
+            self.counter += 1
+            blocks.append(hashlib.sha256("%s:%d" % (self.seed, self.counter)).digest())
+        return "".join(blocks)[:n]
+
+    def below(self, n):
+        return int(self.bytes(4).encode("hex"), 16) % n
+
+
+def token(prefix, i):
+    return "%s%05X" % (prefix, i)
+
+
+def make_binary(gen, size, tokens):
+    """Random bytes with each token planted 0-3 times."""
+    buf = bytearray(gen.bytes(size))
+    for i, t in enumerate(tokens):
+        # Leave every tenth token out, so some patches don't match
+        if i % 10 == 9:
+            continue
+        for _ in range(gen.below(4)):
+            off = gen.below(size - len(t))
+            buf[off:off + len(t)] = t
+    return str(buf)
+
+
+def write_kext(path, name, binary):
+    os.makedirs(os.path.join(path, "Contents", "MacOS"))
+    plistwriter.writePlist({"CFBundleIdentifier": "com.example." + name,
+                            "CFBundleExecutable": name},
+                           os.path.join(path, "Contents", "Info.plist"))
+    with open(os.path.join(path, "Contents", "MacOS", name), "wb") as f:
+        f.write(binary)
+
+
+def generate(work, patch_counts):
+    """Generate the inputs in work, with a config.plist for each number
+    of patches; return a dict describing them."""
+    max_patches = patch_counts[-1]
+    gen = Generator(args.seed)
+    ext = os.path.join(work, "Extensions")
+    os.makedirs(ext)
+    bundle_paths = []
+    patched = []
+    for i in range(args.kexts):
+        name = "Fake%04d" % i
+        path = os.path.join(ext, name + ".kext")
+        if i < args.patched_kexts:
+            size = int(args.binary_mb * 1024 * 1024)
+            tokens = [token("K", j) for j in range(i, max_patches, args.patched_kexts)]
+            patched.append(name)
+        else:
+            size = 4096
+            tokens = []
+        write_kext(path, name, make_binary(gen, size, tokens))
+        bundle_paths.append("/" + name + ".kext")
+        # Every fifth kext has plugins, some of them with plugins too
+        if i % 5 == 0:
+            for j in range(3):
+                plugin = "%sPlugin%d" % (name, j)
+                plugin_path = os.path.join(path, "Contents", "PlugIns", plugin + ".kext")
+                write_kext(plugin_path, plugin, gen.bytes(1024))
+                bundle_paths.append("/%s.kext/Contents/PlugIns/%s.kext" % (name, plugin))
+                if j == 0:
+                    nested = plugin + "Nested"
+                    write_kext(os.path.join(plugin_path, "Contents", "PlugIns", nested + ".kext"),
+                               nested, gen.bytes(1024))
+                    bundle_paths.append("/%s.kext/Contents/PlugIns/%s.kext/Contents/PlugIns/%s.kext"
+                                        % (name, plugin, nested))
+
+    identifiers = os.path.join(work, "KextIdentifiers.plist.gz")
+    with gzip.open(identifiers, "wb") as f:
+        plistwriter.writePlist({"OSKextIdentifierCacheKextInfo":
+                                [{"OSBundlePath": p} for p in bundle_paths]}, f)
+
+    aml_tokens = [token("Q", j) for j in range(max_patches)]
+    amls = []
+    for name, size, tokens in [("DSDT.aml", args.aml_kb * 1024, aml_tokens),
+                               ("SSDT-1.aml", 64 * 1024, aml_tokens[::7]),
+                               ("SSDT-2.aml", 16 * 1024, [])]:
+        path = os.path.join(work, name)
+        with open(path, "wb") as f:
+            f.write(make_binary(gen, size, tokens))
+        amls.append(path)
+
+    configs = {}
+    for n in patch_counts:
+        dsdt = []
+        kexts = []
+        for j in range(n):
+            dsdt.append(collections.OrderedDict([
+                ("Comment", "rename %s" % token("Q", j)),
+                ("Find", plistlib.Data(token("Q", j))),
+                ("Replace", plistlib.Data(token("X", j)))]))
+            kexts.append(collections.OrderedDict([
+                ("Comment", "patch %s" % token("K", j)),
+                ("Find", plistlib.Data(token("K", j))),
+                ("Name", patched[j % len(patched)]),
+                ("Replace", plistlib.Data(token("Y", j)))]))
+        config = collections.OrderedDict([
+            ("ACPI", {"DSDT": {"Patches": dsdt}}),
+            ("KernelAndKextPatches", {"KextsToPatch": kexts})])
+        path = os.path.join(work, "config-%d.plist" % n)
+        plistwriter.writePlist(config, path)
+        configs[n] = path
+
+    return {"extensions": ext, "identifiers": identifiers, "amls": amls,
+            "configs": configs, "patched_kexts": patched}
+
+
+def timed(stage, fn, patches=None, repeat=None, **extra):
+    """Run fn repeat times, recording the wall-clock time of each run."""
+    times = []
+    for _ in range(repeat or args.repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    r = {"stage": stage, "seconds": times, "best": min(times)}
+    if patches is not None:
+        r["patches"] = patches
+    r.update(extra)
+    results.append(r)
+    sys.stderr.write("%-36s %6s %9.4fs\n" % (stage, "" if patches is None else patches, min(times)))
+
+
+def bench_index(inputs, work):
+    ext = inputs["extensions"]
+
+    def walk():
+        kextindex.KextIndex().walk_for_kexts(ext)
+    timed("index.walk_for_kexts", walk)
+
+    dircache_file = os.path.join(work, "dircache.json")
+
+    def walk_cold():
+        if os.path.exists(dircache_file):
+            os.unlink(dircache_file)
+        dircache = kextindex.DirectoryCache(dircache_file)
+        kextindex.KextIndex().walk_for_kexts(ext, dircache)
+        dircache.save()
+    timed("index.walk_for_kexts.dircache_cold", walk_cold)
+
+    def walk_warm():
+        kextindex.KextIndex().walk_for_kexts(ext, kextindex.DirectoryCache(dircache_file))
+    timed("index.walk_for_kexts.dircache_warm", walk_warm)
+
+    def translations():
+        kextindex.KextIndex().read_name_translations_from(inputs["identifiers"], ext)
+    timed("index.read_name_translations_from", translations)
+
+    def resolve():
+        kextindex.KextIndex().resolve(inputs["patched_kexts"], [ext])
+    timed("index.resolve", resolve)
+
+
+def bench_config(inputs, n):
+    config = inputs["configs"][n]
+    timed("parse.readPlist", lambda: plistlib.readPlist(config), n)
+    timed("parse.plistloader.dsdt", lambda: plistloader.load(config, [DSDT_PATH]), n)
+    timed("parse.plistloader.kexts", lambda: plistloader.load(config, [KEXTS_PATH]), n)
+
+    tree = plistloader.load(config)
+    dsdt_patches = patch.Patch.list_from_clover_config(tree)
+    kext_patches = patch.FilePatch.list_from_clover_config(tree)
+    amls = []
+    for path in inputs["amls"]:
+        with open(path, "rb") as f:
+            amls.append(f.read())
+    aml_bytes = sum(len(a) for a in amls)
+
+    def dsdt_loop():
+        # The original one-scan-per-patch loop
+        for aml in amls:
+            for p in dsdt_patches:
+                p.count(aml)
+                aml = p.apply(aml)
+    timed("dsdt.count_apply_loop", dsdt_loop, n, bytes=aml_bytes)
+
+    def dsdt_count_and_apply():
+        for aml in amls:
+            buf = bytearray(aml)
+            for p in dsdt_patches:
+                p.count_and_apply(buf)
+    timed("dsdt.count_and_apply", dsdt_count_and_apply, n, bytes=aml_bytes)
+
+    def dsdt_patchset():
+        ps = patch.PatchSet(dsdt_patches)
+        for aml in amls:
+            ps.apply(bytearray(aml))
+    timed("dsdt.patchset", dsdt_patchset, n, bytes=aml_bytes)
+
+    targets = {}
+    for p in kext_patches:
+        targets.setdefault(p.filename, []).append(p)
+    binaries = {}
+    for name in targets:
+        binaries[name] = os.path.join(inputs["extensions"], name + ".kext",
+                                      "Contents", "MacOS", name)
+    kext_bytes = sum(os.path.getsize(b) for b in binaries.values())
+
+    def kext_loop():
+        for name, ps in targets.items():
+            with open(binaries[name], "rb") as f:
+                contents = f.read()
+            for p in ps:
+                p.count(contents)
+                contents = p.apply(contents)
+    timed("kexts.count_apply_loop", kext_loop, n, bytes=kext_bytes)
+
+    def kext_patchset():
+        for name, ps in targets.items():
+            contents = mappedfile.MappedFile(binaries[name])
+            patch.PatchSet(ps).apply(contents)
+            contents.close()
+    timed("kexts.patchset", kext_patchset, n, bytes=kext_bytes)
+
+    with open(config, "rb") as f:
+        src = f.read()
+    expects = dict((i, i % 4) for i in range(n))
+
+    def expected():
+        expectwriter.write_expected(src, DSDT_PATH, expects, StringIO.StringIO())
+    timed("expected.write_expected", expected, n)
+
+    def rewrite():
+        plistwriter.writePlist(tree, StringIO.StringIO())
+    timed("expected.writePlist", rewrite, n)
+
+
+def bench_scripts(inputs, work, n):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(work, "cache"))
+    config = inputs["configs"][n]
+    with open(os.devnull, "wb") as null:
+        def run(argv):
+            return lambda: subprocess.call([sys.executable] + argv, stdout=null, stderr=null, env=env)
+        timed("script.check-dsdt-patches", run(
+            [os.path.join(here, "check-dsdt-patches.py"), "--no-cache", "-c", config] + inputs["amls"]), n)
+        timed("script.check-kext-patches", run(
+            [os.path.join(here, "check-kext-patches.py"), "--no-cache", "-e", inputs["extensions"], config]), n)
+
+
+def bench_dense(work):
+    """Compare the patch engines where patches match thousands of times.
+
+    The binary is bytes from a four-letter alphabet and the patches have
+    three-byte Finds, some of them shared, so each patch leaves thousands
+    of small edits for the later ones to search around.
+    """
+    gen = Generator(args.seed + ":dense")
+    alphabet = "\x00\x48\x89\xe5"
+    contents = "".join(alphabet[ord(c) & 3] for c in gen.bytes(256 * 1024))
+    path = os.path.join(work, "dense.bin")
+    with open(path, "wb") as f:
+        f.write(contents)
+    finds = ["".join(alphabet[ord(c) & 3] for c in gen.bytes(3)) for _ in range(12)]
+    patches = []
+    for i in range(18):
+        find = finds[gen.below(len(finds))]
+        replace = "".join(alphabet[ord(c) & 3] for c in gen.bytes(3))
+        patches.append(patch.Patch({"Comment": "dense %d" % i, "Find": plistlib.Data(find),
+                                    "Replace": plistlib.Data(replace)}))
+
+    def loop():
+        # The original one-scan-per-patch loop
+        s = contents
+        for p in patches:
+            p.count(s)
+            s = p.apply(s)
+    timed("dense.count_apply_loop", loop, len(patches), bytes=len(contents))
+
+    def count_and_apply():
+        buf = bytearray(contents)
+        for p in patches:
+            p.count_and_apply(buf)
+    timed("dense.count_and_apply", count_and_apply, len(patches), bytes=len(contents))
+
+    def patchset():
+        patch.PatchSet(patches).apply(bytearray(contents))
+    timed("dense.patchset", patchset, len(patches), bytes=len(contents))
+
+    def patchset_mapped():
+        mapped = mappedfile.MappedFile(path)
+        patch.PatchSet(patches).apply(mapped)
+        mapped.close()
+    timed("dense.patchset.mappedfile", patchset_mapped, len(patches), bytes=len(contents))
+
+
+def bench_startup():
+    """Time starting each checker as far as --help, directly and through clovertool.py."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.devnull, "wb") as null:
+        def run(argv):
+            return lambda: subprocess.call([sys.executable] + argv + ["--help"], stdout=null, stderr=null)
+        for script, command in [("check-dsdt-patches.py", "check-dsdt"),
+                                ("check-kext-patches.py", "check-kext")]:
+            timed("startup." + os.path.splitext(script)[0], run([os.path.join(here, script)]))
+            timed("startup.clovertool." + command, run([os.path.join(here, "clovertool.py"), command]))
+
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, "wb") as null:
+            return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                           cwd=here, stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    def key(r):
+        return r["stage"], r.get("patches")
+    before = dict((key(r), r["best"]) for r in old["results"])
+    sys.stderr.write("\n%-36s %6s %10s %10s %7s\n" % ("stage", "patches", "old", "new", "ratio"))
+    for r in new["results"]:
+        b = before.get(key(r))
+        if b is None:
+            continue
+        ratio = r["best"] / b if b else float("inf")
+        sys.stderr.write("%-36s %6s %9.4fs %9.4fs %6.2fx\n" % (
+            r["stage"], "" if r.get("patches") is None else r["patches"], b, r["best"], ratio))
+
+
+def main(argv=None):
+    """Run benchmark.py with the given arguments.
+
+    :param argv: arguments, without the program name; None for sys.argv
+    """
+    global args, results
+    args = parser.parse_args(argv)
+    results = []
+    try:
+        patch_counts = sorted(set(int(n) for n in args.patches.split(",")))
+    except ValueError:
+        parser.error("--patches must be comma-separated numbers")
+    if not patch_counts or patch_counts[0] < 1 or args.patched_kexts < 1 or args.patched_kexts > args.kexts:
+        parser.error("need at least one patch and 1 to --kexts patched kexts")
+
+    if args.work_dir:
+        work = args.work_dir
+        if os.path.exists(work):
+            parser.error("work directory %s already exists" % work)
+    else:
+        work = tempfile.mkdtemp(prefix="clover-benchmark.")
+    try:
+        start = time.time()
+        inputs = generate(work, patch_counts)
+        sys.stderr.write("generated inputs in %s in %.1fs\n" % (work, time.time() - start))
+        bench_index(inputs, work)
+        bench_dense(work)
+        if not args.no_scripts:
+            bench_startup()
+        for n in patch_counts:
+            bench_config(inputs, n)
+            if not args.no_scripts:
+                bench_scripts(inputs, work, n)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "arguments": {"patches": patch_counts, "kexts": args.kexts,
+                      "patched_kexts": args.patched_kexts, "binary_mb": args.binary_mb,
+                      "aml_kb": args.aml_kb, "seed": args.seed, "repeat": args.repeat},
+        "results": results,
+    }
+    json.dump(report, args.output, indent=1, sort_keys=True, separators=(",", ": "))
+    args.output.write("\n")
+    if args.compare:
+        compare(json.load(args.compare), report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
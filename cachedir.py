@@ -0,0 +1,20 @@
+import os
+import sys
+
+# Where to keep persistent caches between runs.
+
+
+def cache_dir():
+    """Return (creating if needed) this project's per-user cache directory."""
+    if sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    path = os.path.join(base, "clover-config-plist-tools")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def cache_file(name):
+    return os.path.join(cache_dir(), name)
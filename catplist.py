@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
-import plistlib
-import plistmonkey
+import plistloader
+import plistwriter
 import argparse
 import sys
 
@@ -15,10 +15,13 @@ parser.add_argument("-n", "--normalize",
 parser.add_argument("plist", help="path to plist", nargs=1,
                     type=argparse.FileType("r"))
 
-args = parser.parse_args()
-plistmonkey.rehabManHouseStyle = args.short_data
-plistmonkey.sortItems = args.normalize
 
-pl = plistlib.readPlist(args.plist[0])
+def main(argv=None):
+    args = parser.parse_args(argv)
+    pl = plistloader.load(args.plist[0])
+    plistwriter.writePlist(pl, sys.stdout, rehabManHouseStyle=args.short_data,
+                           sortItems=args.normalize)
 
-plistlib.writePlist(pl, sys.stdout)
\ No newline at end of file
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/python2.7
+import argparse
+import json
+import logging
+import os.path
+import socket
+import sys
+import checkprotocol
+import expectwriter
+import logformat
+import patch
+import plistloader
+
+# Run checks in check-daemon.py and report them the way
+# check-kext-patches.py and check-dsdt-patches.py do.
+
+KEXTS_PATH = ("KernelAndKextPatches", "KextsToPatch")
+DSDT_PATH = ("ACPI", "DSDT", "Patches")
+
+parser = argparse.ArgumentParser(description="Check a config.plist using a running check-daemon.py")
+parser.add_argument("-s", "--socket", help="The daemon's socket (default in the cache directory)")
+subparsers = parser.add_subparsers(dest="command")
+
+kexts_parser = subparsers.add_parser("kexts", help="Check kext patches, like check-kext-patches.py")
+kexts_parser.add_argument("-a", "--enable-all",
+                          help="Pretend all patches are enabled, but do not do replacements for disabled ones",
+                          action="store_true")
+kexts_parser.add_argument("config", help="path to config.plist", default="config.plist")
+
+dsdt_parser = subparsers.add_parser("dsdt", help="Check ACPI patches, like check-dsdt-patches.py")
+dsdt_parser.add_argument("-c", "--config", default="config.plist",
+                         help="The clover config file. Defaults to config.plist.")
+dsdt_parser.add_argument("dsdt", nargs='+', metavar="DSDT.aml",
+                         help="One or more DSDT.aml/SSDT.aml files.")
+
+for p in [kexts_parser, dsdt_parser]:
+    p.add_argument("-v", "--verbose", help="Be more verbose, -vv for more", action="count")
+    p.add_argument("--expected", help="Produce a new plist on stdout with Expect counts", action="store_true")
+    p.add_argument("-i", "--in-place", help="With --expected, add Expect counts to the config file itself",
+                   action="store_true")
+
+subparsers.add_parser("ping", help="Print the daemon's status")
+subparsers.add_parser("reindex", help="Make the daemon index the Extensions directories again")
+
+
+def write_expected(config_path, patches_path, expects):
+    if args.in_place:
+        if expects:
+            expectwriter.write_expected_in_place(config_path, patches_path, expects)
+    else:
+        with open(config_path, "rb") as f:
+            expectwriter.write_expected(f.read(), patches_path, expects, sys.stdout)
+
+
+def check_kexts():
+    config = plistloader.load(args.config, [KEXTS_PATH])
+    patches = patch.FilePatch.list_from_clover_config(config)
+    response = request({"op": "check-kexts", "enable_all": args.enable_all,
+                        "patches": checkprotocol.to_json(config[KEXTS_PATH[0]][KEXTS_PATH[1]])})
+
+    results = response["patches"]
+    for p, r in zip(patches, results):
+        p.applied_count = len(r["offsets"])
+        p.applied_offsets = r["offsets"]
+        log.debug("Found patch %r", p)
+        if not r["checked"]:
+            continue
+        if not r["found"]:
+            log.warning("No file found for %r", p)
+            continue
+        count = p.applied_count
+        if count:
+            times = "s"[count == 1:]
+            log.info("Applied %d time%s: %s", count, times, p.comment)
+            log.debug("  at %s", patch.format_offsets(p.applied_offsets))
+
+    expects = {}
+    for i, (p, r) in enumerate(zip(patches, results)):
+        if not r["checked"]:
+            continue
+        if p.has_expected:
+            if p.applied_count != p.expected:
+                log.error("expected %d, got %d in: %s: %s", p.expected,
+                          p.applied_count, p.filename, p.comment)
+        elif p.applied_count == 0:
+            log.warning("applied 0 times %s: %s:", p.filename, p.comment)
+        else:
+            expects[i] = p.applied_count
+
+    if args.expected:
+        write_expected(args.config, KEXTS_PATH, expects)
+
+
+def check_dsdt():
+    config = plistloader.load(args.config, [DSDT_PATH])
+    patches = patch.Patch.list_from_clover_config(config)
+    targets = [os.path.abspath(name) for name in args.dsdt]
+    response = request({"op": "check-dsdt", "targets": targets,
+                        "patches": checkprotocol.to_json(config["ACPI"]["DSDT"]["Patches"])})
+
+    for name, f in zip(args.dsdt, response["files"]):
+        file_count = 0
+        file_patch_count = 0
+        for p, offsets in zip(patches, f["offsets"]):
+            count = len(offsets)
+            p.applied_count += count
+            file_patch_count += count
+            if count > 0:
+                p.applied_file_count += 1
+                file_count += 1
+            log.debug("  file %s, patch %s applied %d times", name, p.comment, count)
+            if count > 0:
+                log.debug("    at %s", patch.format_offsets(offsets))
+        log.info("file %s, %s patches applied %s times", name, file_count, file_patch_count)
+        if file_count == 0:
+            log.info("-- file %s, no patches matched", name)
+
+    expects = {}
+    for i, p in enumerate(patches):
+        log.debug("patch '%s' applied %d times to %d files",
+                  p.comment, p.applied_count, p.applied_file_count)
+        if p.applied_file_count == 0:
+            log.warn("patch did not apply to any files: %r", p)
+        elif p.has_expected:
+            if p.expected != p.applied_count:
+                matches = "s"[p.expected==1:]
+                log.error("patch expected %d time%s, got %d: %r ", p.expected,
+                          matches, p.applied_count, p)
+        else:
+            expects[i] = p.applied_count
+
+    if args.expected:
+        write_expected(args.config, DSDT_PATH, expects)
+
+
+def request(message):
+    try:
+        response = checkprotocol.send(socket_path, message)
+    except socket.error as e:
+        sys.exit("check-client.py: cannot reach check-daemon.py at %s: %s" % (socket_path, e))
+    except checkprotocol.ProtocolError as e:
+        sys.exit("check-client.py: %s" % e)
+    if "error" in response:
+        sys.exit("check-client.py: %s" % response["error"])
+    return response
+
+
+def main(argv=None):
+    global args, socket_path, log
+    args = parser.parse_args(argv)
+    socket_path = args.socket or checkprotocol.default_socket_path()
+
+    if args.command == "kexts":
+        logformat.basic_config("%(levelname)-10s %(message)s")
+        log = logging.getLogger("kernelkexts")
+    elif args.command == "dsdt":
+        logformat.basic_config("%(levelname)-16s %(message)s")
+        log = logging.getLogger("cloverbinpatch")
+    if args.command in ("kexts", "dsdt"):
+        if args.verbose == 1:
+            log.setLevel(logging.INFO)
+        elif args.verbose >= 2:
+            log.setLevel(logging.DEBUG)
+
+    if args.command == "kexts":
+        check_kexts()
+    elif args.command == "dsdt":
+        check_dsdt()
+    else:
+        json.dump(request({"op": args.command}), sys.stdout, indent=1, sort_keys=True,
+                  separators=(",", ": "))
+        sys.stdout.write("\n")
+    return 0
+
+
+# Set by main()
+args = None
+socket_path = None
+log = None
+
+if __name__ == "__main__":
+    sys.exit(main())
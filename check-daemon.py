@@ -0,0 +1,346 @@
+#!/usr/bin/python2.7
+import argparse
+import collections
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import cachedir
+import checkprotocol
+import kextindex
+import logformat
+import mappedfile
+import patch
+import plistloader
+import resultcache
+
+log = logging.getLogger("checkdaemon")
+
+# Keep the kext index and binaries loaded between checks.
+#
+# Each check-kext-patches.py run walks the Extensions directories, maps
+# the binaries it patches and throws it all away. This daemon does that
+# once and answers check requests from check-client.py over a Unix domain
+# socket, one thread per connection.
+#
+# Loaded binaries and AML files are shared between requests and never
+# written to. Each request patches its own MappedFile view or bytearray
+# copy, so concurrent checks can't see each other's replacements. The
+# index, the loaded-file caches and the result cache are guarded by one
+# lock, held only while they are looked up or updated, not while
+# patching.
+
+parser = argparse.ArgumentParser(description="Keep kexts loaded and answer check requests from check-client.py")
+parser.add_argument("-s", "--socket", help="Unix domain socket to listen on (default in the cache directory)")
+parser.add_argument("-e", "--extensions", action="append", metavar="DIR",
+                    help="Extensions directory to search; may be repeated. The default is /System/Library/Extensions and /Library/Extensions")
+parser.add_argument("-r", "--running", help="Index only kexts listed in running kernel caches",
+                    action="store_true")
+parser.add_argument("--cache-mb", help="Memory budget for loaded kext binaries, in MB (default 1024)",
+                    type=int, default=1024)
+parser.add_argument("--no-cache", help="Do not use or save cached results from earlier runs",
+                    action="store_true")
+parser.add_argument("--save-interval", help="Save the result cache at most every N seconds (default 30)",
+                    type=float, default=30, metavar="N")
+parser.add_argument("--ignore-kext-dupes", help="Don't warn about multiple kexts with the same name", action="store_true")
+parser.add_argument("-v", "--verbose", help="Be more verbose, -vv for more", action="count")
+
+
+class Loaded:
+    """A file loaded for sharing, and the stat it was loaded with."""
+
+    def __init__(self, path, contents):
+        self.path = path
+        self.contents = contents
+        self.stamp = stamp(path)
+        # resultcache.hash_contents(contents), when first needed
+        self.digest = None
+
+    def hash(self):
+        if self.digest is None:
+            self.digest = resultcache.hash_contents(self.contents)
+        return self.digest
+
+
+def stamp(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+class Checker:
+    """The warm state, and the checks run against it."""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        # Held by save(), so one snapshot is written before the next is taken
+        self.save_lock = threading.Lock()
+        self.extensions_dirs = args.extensions or ["/System/Library/Extensions", "/Library/Extensions"]
+        self.index = None
+        # Kext name to Loaded MappedFile, least recently used first
+        self.binaries = collections.OrderedDict()
+        self.binaries_size = 0
+        # AML path to Loaded str
+        self.amls = {}
+        self.result_cache = None
+        if not args.no_cache:
+            self.result_cache = resultcache.ResultCache(cachedir.cache_file("patch-results.json"))
+        self.last_save = time.time()
+        self.requests = 0
+        self.reindex()
+
+    def reindex(self):
+        index = kextindex.KextIndex(warn_dupes=not self.args.ignore_kext_dupes)
+        if self.args.running:
+            index.read_name_translations_from(
+                "/System/Library/Caches/com.apple.kext.caches/Directories/System/Library/Extensions/KextIdentifiers.plist.gz",
+                directory_prefix="/System/Library/Extensions/")
+            index.read_name_translations_from(
+                "/System/Library/Caches/com.apple.kext.caches/Directories/Library/Extensions/KextIdentifiers.plist.gz",
+                directory_prefix="/Library/Extensions/")
+        else:
+            dircache = kextindex.DirectoryCache(cachedir.cache_file("kext-directories.json"))
+            for extensions in self.extensions_dirs:
+                index.walk_for_kexts(extensions, dircache)
+            log.info("Kext index: listed %d directories, reused %d",
+                     dircache.listed, dircache.reused)
+            dircache.save()
+        with self.lock:
+            self.index = index
+            # Kexts may have moved
+            self.binaries.clear()
+            self.binaries_size = 0
+        return len(index.identifier_kext_to_kext_path)
+
+    def binary(self, name):
+        """The named kext's binary; patch a view() of its contents.
+
+        :raises KeyError: if there is no such kext
+        :rtype: Loaded
+        """
+        with self.lock:
+            path = self.index.binary_path(name)
+            loaded = self.binaries.pop(name, None)
+            if loaded and (loaded.path != path or loaded.stamp != stamp(path)):
+                log.info("%s changed, loading it again", path)
+                self.binaries_size -= len(loaded.contents)
+                loaded = None
+            if loaded is None:
+                loaded = Loaded(path, mappedfile.MappedFile(path))
+                self.binaries_size += len(loaded.contents)
+            self.binaries[name] = loaded
+            # Evicted binaries are unmapped once no request is using them
+            while self.binaries_size > self.args.cache_mb * 1024 * 1024 and len(self.binaries) > 1:
+                evicted = self.binaries.popitem(last=False)[1]
+                self.binaries_size -= len(evicted.contents)
+            return loaded
+
+    def aml(self, path):
+        with self.lock:
+            loaded = self.amls.get(path)
+            if loaded is None or loaded.stamp != stamp(path):
+                with open(path, "rb") as f:
+                    loaded = Loaded(path, f.read())
+                self.amls[path] = loaded
+            return loaded
+
+    def patch_target(self, patchset, loaded, contents):
+        """Apply patchset to contents, a copy of loaded.contents, or look up
+        the results of doing so."""
+        rc = self.result_cache
+        key = None
+        if rc:
+            key = rc.key(loaded.hash(), patchset.signature())
+            with self.lock:
+                results = rc.get(key)
+                if results is not None:
+                    rc.hits += 1
+                    return results
+        results = patchset.apply(contents)
+        if rc:
+            patched_hash = resultcache.hash_contents(contents)
+            with self.lock:
+                rc.misses += 1
+                rc.put(key, results, patched_hash)
+        return results
+
+    def save(self, force=False):
+        with self.save_lock:
+            snapshot = None
+            with self.lock:
+                if self.result_cache and (force or time.time() - self.last_save >= self.args.save_interval):
+                    snapshot = self.result_cache.snapshot()
+                    self.last_save = time.time()
+            # Requests go on while the snapshot is written
+            if snapshot is not None:
+                self.result_cache.write(snapshot)
+
+    def load_patches(self, request, path):
+        if "config" in request:
+            config = plistloader.load(request["config"], [path])
+            for key in path:
+                config = config[key]
+            return config
+        return checkprotocol.from_json(request["patches"])
+
+    def check_kexts(self, request):
+        """Check kext patches, as check-kext-patches.py does.
+
+        :return: for each patch, its "target", whether it was "checked"
+                 (false for disabled patches), whether the target was
+                 "found", and the match "offsets"; and the indexes of
+                 patches whose Expect was not met, as "mismatches"
+        """
+        enable_all = request.get("enable_all", False)
+        patches = map(patch.FilePatch,
+                      self.load_patches(request, ("KernelAndKextPatches", "KextsToPatch")))
+        targets = collections.OrderedDict()
+        for p in patches:
+            if enable_all or not p.disabled:
+                targets.setdefault(p.filename, []).append(p)
+        checked = set(p for group in targets.values() for p in group)
+        found = {}
+        offsets = {}
+        for name, group in targets.items():
+            try:
+                loaded = self.binary(name)
+            except KeyError:
+                found[name] = False
+                continue
+            found[name] = True
+            contents = loaded.contents.view()
+            patchset = patch.PatchSet(group, count_only=[p for p in group if p.disabled])
+            for p, o in zip(group, self.patch_target(patchset, loaded, contents)):
+                offsets[p] = o
+            contents.close()
+        out = []
+        mismatches = []
+        for i, p in enumerate(patches):
+            o = offsets.get(p, [])
+            out.append({"target": p.filename, "checked": p in checked,
+                        "found": found.get(p.filename, False), "offsets": o})
+            if p in checked and p.has_expected and p.expected != len(o):
+                mismatches.append(i)
+        return {"patches": out, "mismatches": mismatches}
+
+    def check_dsdt(self, request):
+        """Check ACPI patches against AML files, as check-dsdt-patches.py does.
+
+        :return: for each target file, its "name" and the match "offsets" of
+                 each patch, as "files"; and the indexes of patches whose
+                 Expect was not met, as "mismatches"
+        """
+        patches = map(patch.Patch, self.load_patches(request, ("ACPI", "DSDT", "Patches")))
+        patchset = patch.PatchSet(patches)
+        files = []
+        counts = [0] * len(patches)
+        for path in request["targets"]:
+            loaded = self.aml(path)
+            results = self.patch_target(patchset, loaded, bytearray(loaded.contents))
+            files.append({"name": path, "offsets": results})
+            for i, o in enumerate(results):
+                counts[i] += len(o)
+        mismatches = [i for i, p in enumerate(patches)
+                      if p.has_expected and p.expected != counts[i]]
+        return {"files": files, "mismatches": mismatches}
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "ping":
+            with self.lock:
+                return {"pid": os.getpid(), "requests": self.requests,
+                        "kexts": len(self.index.identifier_kext_to_kext_path),
+                        "binaries": len(self.binaries), "binaries_size": self.binaries_size,
+                        "result_cache": self.result_cache and {"hits": self.result_cache.hits,
+                                                               "misses": self.result_cache.misses}}
+        if op == "reindex":
+            return {"kexts": self.reindex()}
+        if op == "check-kexts":
+            return self.check_kexts(request)
+        if op == "check-dsdt":
+            return self.check_dsdt(request)
+        raise ValueError("unknown op %r" % op)
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        checker = self.server.checker
+        try:
+            request = json.loads(self.rfile.readline())
+            with checker.lock:
+                checker.requests += 1
+            response = checker.handle(request)
+        except (KeyError, ValueError, TypeError, SyntaxError, AssertionError, IOError, OSError) as e:
+            log.warning("request failed: %s: %s", e.__class__.__name__, e)
+            response = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        except Exception as e:
+            # Still answer, so the client doesn't wait on a dead thread
+            log.exception("request failed")
+            response = {"error": "%s: %s" % (e.__class__.__name__, e)}
+        self.wfile.write(json.dumps(response) + "\n")
+        checker.save()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    """Remove a socket left by a daemon that is gone; fail if it's running."""
+    if not os.path.exists(path):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.unlink(path)
+        return
+    finally:
+        s.close()
+    sys.exit("check-daemon.py: already running on %s" % path)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    logformat.basic_config("%(levelname)-10s %(message)s")
+    for logger in [log, kextindex.log]:
+        if args.verbose == 1:
+            logger.setLevel(logging.INFO)
+        elif args.verbose >= 2:
+            logger.setLevel(logging.DEBUG)
+    path = args.socket or checkprotocol.default_socket_path()
+    remove_stale_socket(path)
+
+    checker = Checker(args)
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(old_umask)
+    server.checker = checker
+    # serve_forever() returns after shutdown(), which must come from
+    # another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    log.warning("Listening on %s, %d kexts indexed", path,
+                len(checker.index.identifier_kext_to_kext_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        checker.save(force=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,21 +2,27 @@
 import argparse
 import logging
 import os.path
-import plistlib
 import sys
+import time
 import patch
-import logmonkey
-import plistmonkey
+import plistloader
+import cachedir
+import logformat
+import resultcache
 
-plistmonkey.rehabManHouseStyle = True
-plistmonkey.sortItems = False
-
-logging.basicConfig(format="%(levelname)-16s %(message)s")
 log = logging.getLogger("cloverbinpatch")
 
+# expectwriter, multiprocessing, stats, suggest and watch are imported
+# where they are used, so starting up costs only what the options given
+# need.
+
+
+# Where the patches are in config.plist
+PATCHES_PATH = ("ACPI", "DSDT", "Patches")
+
 
 def parse_config_plist(file_or_filename):
-    return plistlib.readPlist(file_or_filename)
+    return plistloader.load(file_or_filename, [PATCHES_PATH])
 
 
 parser = argparse.ArgumentParser(
@@ -29,70 +35,258 @@ parser.add_argument("-d", "--output-directory",
                     help="Write patched AML files to directory",
                     nargs=1)
 parser.add_argument("--expected", help="Produce a new plist on stdout with Expect counts", action="store_true")
+parser.add_argument("-i", "--in-place", help="With --expected, add Expect counts to the config file itself",
+                    action="store_true")
+parser.add_argument("-j", "--jobs", help="Patch N files at a time in worker processes",
+                    type=int, default=1, metavar="N")
+parser.add_argument("--no-cache", help="Do not use or save cached results from earlier runs",
+                    action="store_true")
+parser.add_argument("--watch", help="Stay running and check again whenever the config or an AML file changes",
+                    action="store_true")
+parser.add_argument("--suggest", nargs="?", const=0, type=int, metavar="K",
+                    help="For patches that apply 0 times, show the places in each file within K differing bytes of Find (default about a quarter of its length), with makebinpatch.py commands to patch them")
+parser.add_argument("--stats", nargs="?", const="table", choices=["table", "json"],
+                    help="Report time spent per phase, file and patch, as a table (default) or JSON")
+parser.add_argument("--stats-file", type=argparse.FileType("w"), default=sys.stderr, metavar="FILE",
+                    help="Write --stats here instead of stderr")
 parser.add_argument('-v', '--verbose', action='count', help="Increase verbosity level")
 parser.add_argument("dsdt", type=argparse.FileType("rb"), nargs='+', metavar="DSDT.aml",
                     help="One or more DSDT.aml/SSDT.aml files.")
 
-args = parser.parse_args()
+# Set by main()
+args = None
 output_dir = None
-if args.output_directory:
-    output_dir = args.output_directory[0]
-    if not os.path.isdir(output_dir):
-        parser.error("-d directory '{}' is not a directory".format(output_dir))
-# print repr(args)
-
-if args.verbose == 1:
-    log.setLevel(logging.INFO)
-elif args.verbose >= 2:
-    log.setLevel(logging.DEBUG)
-
-config_file = args.config
-if isinstance(config_file, list):
-    # I don't understand.
-    config_file = config_file[0]
-config_plist = parse_config_plist(config_file)
-
-patches = patch.Patch.list_from_clover_config(config_plist)
-
-for f in args.dsdt:
-    assert isinstance(f, file)
-    basename = os.path.basename(f.name)
-    unpatched = f.read()
-    f.close()
-    patched = unpatched
-    file_count = 0
-    file_patch_count = 0
-    for p in patches:
-        count = p.count(patched)
-        patched = p.apply(patched)
-        p.applied_count += count
-        file_patch_count += count
-        if count > 0:
-            p.applied_file_count += 1
-            file_count += 1
-        log.debug("  file %s, patch %s applied %d times", f.name, p.comment, count)
-    log.info("file %s, %s patches applied %s times", f.name, file_count, file_patch_count)
+result_cache = None
+
+# Kept between checks in --watch mode: the unpatched contents of each AML
+# file, and for each file the PatchSet signature and results of the last
+# time it was patched.
+aml_contents = {}
+file_memo = {}
+
+# Set by check(); module globals so -j workers inherit them
+patches = None
+patchset = None
+run_stats = None
+
+
+def read_aml(i):
+    f = args.dsdt[i]
+    if f.name not in aml_contents:
+        if f.closed:
+            f = open(f.name, "rb")
+        aml_contents[f.name] = f.read()
+        f.close()
+    return aml_contents[f.name]
+
+
+def patch_file(i):
+    """Patch the i'th AML file, writing it to the output directory if any.
+
+    This runs in a worker process with -j, so it returns results rather
+    than updating the patches.
+
+    :param i: index into args.dsdt
+    :type i: int
+    :return: match offsets for each patch, either True if they came
+             from the result cache or a (key, patched hash) entry to add to
+             it, and with --stats a profile for stats.Stats.add_target
+    :rtype: (list[list[int]], bool | (str, str), dict | None)
+    """
+    name = args.dsdt[i].name
+    profile = None
+    if run_stats:
+        profile = {"hash": 0.0, "patches": []}
+        t0 = time.time()
+    unpatched = read_aml(i)
+    patched = bytearray(unpatched)
+    if profile:
+        profile["load"] = time.time() - t0
+        profile["size"] = len(patched)
+        t0 = time.time()
+    cached = None
+    results = None
+    if result_cache:
+        key = result_cache.key(resultcache.hash_contents(patched), patchset.signature())
+        results = result_cache.get(key)
+    if profile:
+        profile["hash"] = time.time() - t0
+        t0 = time.time()
+    if results is not None:
+        cached = (key, None)
+        if output_dir:
+            patchset.replay(patched, results)
+    else:
+        results = patchset.apply(patched, profile["patches"] if profile else None)
+        if result_cache:
+            cached = (key, resultcache.hash_contents(patched))
+    if profile:
+        profile["patch"] = time.time() - t0
+        profile["cached"] = cached is not None and cached[1] is None
     assert len(unpatched) == len(patched)
-    if file_count == 0:
-        log.info("-- file %s, no patches matched", f.name)
     if output_dir:
-        output_filename = os.path.join(output_dir, basename)
+        output_filename = os.path.join(output_dir, os.path.basename(name))
         output_file = open(output_filename, "wb")
         output_file.write(patched)
         output_file.close()
+    return results, cached, profile
+
+
+def check(config):
+    """Check the patches in a config.plist against all the AML files.
+
+    Files already patched with the same sequence of patches by an earlier
+    call are not patched again.
 
-for p in patches:
-    log.debug("patch '%s' applied %d times to %d files",
-              p.comment, p.applied_count, p.applied_file_count)
-    if p.applied_file_count == 0:
-        log.warn("patch did not apply to any files: %r", p)
-    elif p.has_expected:
-        if p.expected != p.applied_count:
-            matches = "s"[p.expected==1:]
-            log.error("patch expected %d time%s, got %d: %r ", p.expected,
-                 matches, p.applied_count, p)
+    :param config: the config.plist file or path
+    """
+    config_path = getattr(config, "name", config)
+    global patches, patchset, run_stats
+    if args.stats:
+        import stats
+        run_stats = stats.Stats()
+    config_plist = parse_config_plist(config)
+    patches = patch.Patch.list_from_clover_config(config_plist)
+    patchset = patch.PatchSet(patches)
+    signature = patchset.signature()
+    if run_stats:
+        run_stats.lap("parse")
+
+    names = [f.name for f in args.dsdt]
+    indexes = [i for i, name in enumerate(names)
+               if file_memo.get(name, (None,))[0] != signature]
+    if len(indexes) < len(names):
+        log.info("%d of %d files unaffected by changes", len(names) - len(indexes), len(names))
+    if args.jobs > 1 and len(indexes) > 1:
+        # Read files here, so they are kept for the next --watch check
+        for i in indexes:
+            read_aml(i)
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs)
+        file_results = pool.map(patch_file, indexes)
+        pool.close()
+        pool.join()
     else:
-        p.dict["Expect"] = p.applied_count
+        file_results = map(patch_file, indexes)
+    if run_stats:
+        run_stats.lap("patch")
+
+    for i, (results, cached, profile) in zip(indexes, file_results):
+        if cached:
+            result_cache.record(cached, results)
+        file_memo[names[i]] = (signature, results)
+        if profile:
+            run_stats.add_target(names[i], profile, patches, results)
+
+    for name in names:
+        results = file_memo[name][1]
+        file_count = 0
+        file_patch_count = 0
+        for p, offsets in zip(patches, results):
+            count = len(offsets)
+            p.applied_count += count
+            file_patch_count += count
+            if count > 0:
+                p.applied_file_count += 1
+                file_count += 1
+            log.debug("  file %s, patch %s applied %d times", name, p.comment, count)
+            if count > 0:
+                log.debug("    at %s", patch.format_offsets(offsets))
+        log.info("file %s, %s patches applied %s times", name, file_count, file_patch_count)
+        if file_count == 0:
+            log.info("-- file %s, no patches matched", name)
+
+    if result_cache:
+        log.info("Result cache: %d hits, %d misses", result_cache.hits, result_cache.misses)
+        result_cache.save()
+    if run_stats:
+        run_stats.lap("report")
+
+    # Index in the patch array to new Expect count
+    expects = {}
+    for i, p in enumerate(patches):
+        log.debug("patch '%s' applied %d times to %d files",
+                  p.comment, p.applied_count, p.applied_file_count)
+        if p.applied_file_count == 0:
+            log.warn("patch did not apply to any files: %r", p)
+            if args.suggest is not None:
+                import suggest
+                for j, f in enumerate(args.dsdt):
+                    suggest.log_suggestions(log, p, f.name, read_aml(j),
+                                            args.suggest or None)
+        elif p.has_expected:
+            if p.expected != p.applied_count:
+                matches = "s"[p.expected==1:]
+                log.error("patch expected %d time%s, got %d: %r ", p.expected,
+                     matches, p.applied_count, p)
+        else:
+            p.dict["Expect"] = p.applied_count
+            expects[i] = p.applied_count
+
+    if args.expected:
+        import expectwriter
+        if args.in_place:
+            # Leave the file alone if nothing changed, not least for --watch
+            if expects:
+                expectwriter.write_expected_in_place(config_path, PATCHES_PATH, expects)
+        else:
+            with open(config_path, "rb") as f:
+                expectwriter.write_expected(f.read(), PATCHES_PATH, expects, sys.stdout)
+    if run_stats:
+        run_stats.lap("expected")
+        run_stats.write(args.stats_file, args.stats)
+        args.stats_file.flush()
+
+
+def main(argv=None):
+    """Run check-dsdt-patches.py with the given arguments.
+
+    :param argv: arguments, without the program name; None for sys.argv
+    """
+    global args, output_dir, result_cache
+    args = parser.parse_args(argv)
+    logformat.basic_config("%(levelname)-16s %(message)s")
+    output_dir = None
+    if args.output_directory:
+        output_dir = args.output_directory[0]
+        if not os.path.isdir(output_dir):
+            parser.error("-d directory '{}' is not a directory".format(output_dir))
+
+    if args.verbose == 1:
+        log.setLevel(logging.INFO)
+    elif args.verbose >= 2:
+        log.setLevel(logging.DEBUG)
+
+    config_file = args.config
+    if isinstance(config_file, list):
+        # I don't understand.
+        config_file = config_file[0]
+
+    result_cache = None
+    if not args.no_cache:
+        result_cache = resultcache.ResultCache(cachedir.cache_file("patch-results.json"))
+    aml_contents.clear()
+    file_memo.clear()
+
+    check(config_file)
+
+    if args.watch:
+        import watch
+        watcher = watch.Watcher([config_file.name] + [f.name for f in args.dsdt])
+        while True:
+            changed = watcher.wait()
+            for f in args.dsdt:
+                if os.path.abspath(f.name) in changed:
+                    aml_contents.pop(f.name, None)
+                    file_memo.pop(f.name, None)
+            log.warning("%s changed, checking again", ", ".join(sorted(changed)))
+            try:
+                check(config_file.name)
+            except (KeyError, ValueError, SyntaxError) as e:
+                # Probably caught the config half-written
+                log.error("cannot check %s: %s", config_file.name, e)
+    return 0
+
 
-if args.expected:
-    plistlib.writePlist(config_plist, sys.stdout)
+if __name__ == "__main__":
+    sys.exit(main())
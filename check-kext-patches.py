@@ -1,21 +1,26 @@
 #!/usr/bin/python
 
-import gzip
-import plistlib
+import collections
 import os.path
 import patch
+import plistloader
 import argparse
 import logging
+import resource
 import sys
-import plistmonkey
-import logmonkey
+import time
+import cachedir
+import kextindex
+import logformat
+import macho
+import mappedfile
+import resultcache
 
-plistmonkey.rehabManHouseStyle = True
-plistmonkey.sortItems = False
-
-logging.basicConfig(format="%(levelname)-10s %(message)s")
 log = logging.getLogger("kernelkexts")
 
+# expectwriter, kernelcache, multiprocessing, stats, suggest and watch
+# are imported where they are used, so starting up costs only what the
+# options given need.
 
 
 parser = argparse.ArgumentParser(description="Test if Clover kext patches would apply")
@@ -27,6 +32,34 @@ parser.add_argument("-r", "--running", help="Check against only kexts listed in
 parser.add_argument("-v", "--verbose", help="Be more verbose, -vv for more",
                     action="count")
 parser.add_argument("--expected", help="Produce a new plist on stdout with Expect counts", action="store_true")
+parser.add_argument("-i", "--in-place", help="With --expected, add Expect counts to the config file itself",
+                    action="store_true")
+parser.add_argument("-j", "--jobs", help="Check N kexts at a time in worker processes",
+                    type=int, default=1, metavar="N")
+parser.add_argument("--cache-mb", help="Memory budget for loaded kext binaries, in MB (default 256)",
+                    type=int, default=256)
+parser.add_argument("-e", "--extensions", action="append", metavar="DIR",
+                    help="Extensions directory to search; may be repeated. The default is /System/Library/Extensions and /Library/Extensions")
+parser.add_argument("-l", "--lazy", help="Only look for the kexts the config patches, instead of indexing every kext",
+                    action="store_true")
+parser.add_argument("--rebuild-index", help="Ignore saved kext directory listings and walk everything again",
+                    action="store_true")
+parser.add_argument("--no-cache", help="Do not use or save cached results from earlier runs",
+                    action="store_true")
+parser.add_argument("--watch", help="Stay running and check again whenever the config or a patched kext changes",
+                    action="store_true")
+parser.add_argument("--macho", help="Search only the x86_64 slice of universal binaries, as Clover loads it",
+                    action="store_true")
+parser.add_argument("--section", action="append", metavar="SEGMENT[,SECTION]", dest="sections",
+                    help="Search only this Mach-O segment or section of each kext, such as __TEXT,__text; may be repeated. Implies --macho")
+parser.add_argument("--kernelcache", metavar="FILE",
+                    help="Check against the kexts in a compressed prelinkedkernel or kernelcache instead of the kext binaries. KernelToPatch patches are not checked")
+parser.add_argument("--suggest", nargs="?", const=0, type=int, metavar="K",
+                    help="For patches that apply 0 times, show the places in the kext within K differing bytes of Find (default about a quarter of its length), with makebinpatch.py commands to patch them")
+parser.add_argument("--stats", nargs="?", const="table", choices=["table", "json"],
+                    help="Report time spent per phase, kext and patch, as a table (default) or JSON")
+parser.add_argument("--stats-file", type=argparse.FileType("w"), default=sys.stderr, metavar="FILE",
+                    help="Write --stats here instead of stderr")
 parser.add_argument("--ignore-kext-dupes", help="Don't warn about multiple kexts with the same name", action="store_true")
 output_group = parser.add_argument_group("Output kext", "Given a named kext, output the file before or after patching")
 output_group.add_argument("--output-kext", help="Name of kext to write", nargs=1, metavar="KEXT_NAME")
@@ -40,87 +73,23 @@ output_group.add_argument("--output-kext-after",
                     type=argparse.FileType("wb"))
 parser.add_argument("config", help="path to config.plist", default="config.plist")
 
-args = parser.parse_args()
-verbose = args.verbose
-
-if args.verbose == 1:
-    log.setLevel(logging.INFO)
-elif args.verbose >= 2:
-    log.setLevel(logging.DEBUG)
-
-warn_dupes = not args.ignore_kext_dupes
-
-# Examples:
-# identifier_kext_to_kext_path["AppleHDA.kext"] ->
-#     "/System/Library/Extensions/AppleHDA.kext"
-#
-# identifier_kext_to_kext_path["AppleHDAHardwareConfigDriver.kext"] ->
-#     "/System/Library/Extensions/AppleHDA.kext/Contents/PlugIns/AppleHDAHardwareConfigDriver.kext"
-
-identifier_kext_to_kext_path = {}
-
-# In case the normal kext name doesn't match, try case-insensitive comparisons via
-# a squashed-to-lowercase table
-
-lcase_identifier_kext_to_kext_path = {}
-
-def add_bundle(basename, path):
-    warned = False
-    e = identifier_kext_to_kext_path.get(basename)
-    if warn_dupes and e and e != path:
-        log.warning("duplicate kext identifier {} {}".format(path, basename))
-        warned = True
-    identifier_kext_to_kext_path[basename] = path
-    lcase_basename = basename.lower()
-    lower_e = lcase_identifier_kext_to_kext_path.get(lcase_basename)
-    if warn_dupes and not warned:
-        if lower_e and lower_e != path:
-            log.warning("kext identifier differs only in case {} {} {}".format(path, e, basename))
-    lcase_identifier_kext_to_kext_path[lcase_basename] = path
-
-
-def read_name_translations_from(filename, directory_prefix):
-    """Read the cache's KextIdentifiers list to get kext pathnames
+# Set by main()
+args = None
+use_macho = False
+index = None
+extensions_dirs = None
 
-    :param filename: Path of compressed KextIdentifiers.plist
-    :param directory_prefix: path prefix for kexts found here
-    """
-    with gzip.open(filename, "rb") as f:
-        plist = f.read()
-
-    d = plistlib.readPlistFromString(plist)
-
-    kextinfos = d["OSKextIdentifierCacheKextInfo"]
-
-    for kext in kextinfos:
-        path = kext["OSBundlePath"]
-        basename = os.path.basename(path)
-        path = directory_prefix + path
-        add_bundle(basename, path)
-
-def walk_for_kexts(directory_prefix):
-    for root, dirs, files in os.walk('/System/Library/Extensions'):
-        for d in dirs:
-            if d.endswith(".kext"):
-                path = root + "/" + d
-                basename = d.replace(".kext", "")
-                add_bundle(d, path)
-
-if args.running:
-    sle_path = "/System/Library/Caches/com.apple.kext.caches/Directories/System/Library/Extensions/KextIdentifiers.plist.gz"
-    le_path = "/System/Library/Caches/com.apple.kext.caches/Directories/Library/Extensions/KextIdentifiers.plist.gz"
-    read_name_translations_from(sle_path, directory_prefix="/System/Library/Extensions/")
-    read_name_translations_from(le_path, directory_prefix="/Library/Extensions/")
-else:
-    walk_for_kexts("/System/Library/Extensions")
-    walk_for_kexts("/Library/Extensions")
-
-
-config_path = args.config
+# Stats for the current check; the kext index is built before the first
+# check, so its time is recorded there too
+run_stats = None
 
-config_plist = plistlib.readPlist(config_path)
+# Where the patches are in config.plist
+PATCHES_PATH = ("KernelAndKextPatches", "KextsToPatch")
+# Patches to the kernel itself, which only --kernelcache could check
+KERNEL_PATCHES_PATH = ("KernelAndKextPatches", "KernelToPatch")
 
-patches = patch.FilePatch.list_from_clover_config(config_plist)
+# Kext names index.resolve() has looked for, with --lazy
+resolved_names = set()
 
 
 # Contents of the binary for each kext bundle
@@ -128,7 +97,7 @@ patches = patch.FilePatch.list_from_clover_config(config_plist)
 class Bundle:
     """A named kext.
 
-    Uses the identifier_kext_to_kext_path dict to find the base directory of the kext.
+    Uses the kext index to find the base directory of the kext.
     """
 
     def __init__(self, name):
@@ -136,52 +105,76 @@ class Bundle:
         self.kext_name = name + ".kext"
 
     def find_filename(self):
-        kext_path = identifier_kext_to_kext_path.get(self.kext_name)
-        if not kext_path:
-            lcase = self.kext_name.lower()
-            kext_path = lcase_identifier_kext_to_kext_path.get(lcase)
-            if kext_path:
-                log.error("Filename case error %s: %r", self.kext_name, self)
-        fn = kext_path + "/Contents/MacOS/" + self.name
-        if not os.path.exists(fn):
-            # IOGraphicsFamily, for example
-            fn = identifier_kext_to_kext_path[self.kext_name] + "/" + self.name
-        return fn
+        return index.binary_path(self.name)
 
     def load_contents(self):
-        with open(self.find_filename(), "rb") as f:
-            # noinspection PyAttributeOutsideInit
-            self.contents = f.read()
+        # noinspection PyAttributeOutsideInit
+        self.contents = mappedfile.MappedFile(self.find_filename())
 
-    # Class-wide cache for named bundles
-    bundles = {}
+    # Class-wide cache for named bundles; see BundleCache below
+    bundles = None
 
     @classmethod
     def get_contents(cls, name):
-        """Cache and return contents of the main binary file of a named kext."
+        """Cache and return contents of the main binary file of a named kext.
+
+        The binary is memory-mapped; patches are applied to the returned
+        object in place and kept as an overlay of edits.
 
         :param name: The name of the Bundle to look up, without ".kext"
         :type name: str
-        :rtype: Bundle
+        :rtype: mappedfile.MappedFile
         """
-        b = cls.bundles.get(name)
-        if b:
-            return b.contents
-        b = Bundle(name)
-        b.load_contents()
-        cls.bundles[name] = b
-        return b.contents
+        return cls.bundles.get(name).contents
 
     @classmethod
-    def set_contents(cls, name, new_contents):
-        """Replace the in-memory contents of the main binary file of a named kext
+    def release(cls, name):
+        """Drop a named kext from the cache and unmap its binary.
 
         :param name: The name of the Bundle, without ".kext"
-        :type: param: str
-        :param new_contents: The new binary contents
-        :type new_contents: str
+        :type name: str
         """
-        cls.bundles[name].contents = new_contents
+        cls.bundles.release(name)
+
+
+class BundleCache:
+    """Least-recently-used cache of loaded Bundles, within a byte budget."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.bundles = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        b = self.bundles.pop(name, None)
+        if b:
+            self.hits += 1
+        else:
+            self.misses += 1
+            b = Bundle(name)
+            b.load_contents()
+            self.size += len(b.contents)
+        self.bundles[name] = b
+        self.evict()
+        return b
+
+    def release(self, name):
+        b = self.bundles.pop(name, None)
+        if b:
+            self.size -= len(b.contents)
+            b.contents.close()
+
+    def evict(self):
+        # Never evict the bundle just asked for
+        while self.size > self.budget and len(self.bundles) > 1:
+            name, b = self.bundles.popitem(last=False)
+            self.size -= len(b.contents)
+            b.contents.close()
+            self.evictions += 1
+            log.debug("Evicted %s from bundle cache", name)
 
 
 def is_disabled(p):
@@ -196,50 +189,475 @@ def is_disabled(p):
         return False
     return p.disabled
 
-if args.output_kext_before:
-    before_binary = Bundle.get_contents(args.output_kext[0])
-    args.output_kext_before.write(before_binary)
-    args.output_kext_before.close()
 
-for p in patches:
-    log.debug("Found patch %r", p)
-    if is_disabled(p):
-        continue
+# Parsed Mach-O image of each kext binary, with --macho
+macho_images = {}
+
+
+def macho_image(name, contents=None):
+    """The x86_64 image of a kext's binary, or None if it isn't Mach-O.
+
+    :param contents: the binary, if loaded
+    :raises macho.MachOError: if it has no usable x86_64 image
+    """
+    if name not in macho_images:
+        if contents is None:
+            contents = mappedfile.MappedFile(Bundle(name).find_filename())
+            try:
+                macho_images[name] = macho.parse(contents)
+            finally:
+                contents.close()
+        else:
+            macho_images[name] = macho.parse(contents)
+    return macho_images[name]
+
+
+def search_ranges(name, contents):
+    """File ranges of a kext binary to search, or None for all of it."""
+    try:
+        image = macho_image(name, contents)
+    except macho.MachOError as e:
+        # Clover couldn't load it, so nothing would be patched
+        log.warning("%s: %s; not searching it", name, e)
+        return []
+    if image is None:
+        log.warning("%s is not a Mach-O binary; searching all of it", name)
+        return None
+    return image.ranges(args.sections)
+
+
+def check_target(name):
+    """Load a kext, apply its group of patches in config order, and release it.
+
+    This runs in a worker process with -j, so it returns results rather
+    than updating the patches.
+
+    :param name: The name of the target kext, without ".kext"
+    :type name: str
+    :return: None if the kext was not found; otherwise match offsets for
+             each patch in targets[name], either True if they came from the
+             result cache or a (key, patched hash) entry to add to it, and
+             with --stats a profile for stats.Stats.add_target
+    :rtype: (list[list[int]], bool | (str, str), dict | None) | None
+    """
+    group = targets[name]
+    profile = None
+    if run_stats:
+        profile = {"hash": 0.0, "patches": []}
+        t0 = time.time()
     try:
-        contents = Bundle.get_contents(p.filename)
+        contents = Bundle.get_contents(name)
     except KeyError:
-        log.warning("No file found for %r", p)
-        continue
-    count = p.count(contents)
-    if count:
-        times = "s"[count == 1:]
-        log.info("Applied %d time%s: %s", count, times, p.comment)
-        p.applied_count += count
-        if p.disabled:
-            # Even if we are ignoring Disabled for counting, do not apply
-            # the patch to our content cache
-            pass
+        return None
+    if profile:
+        profile["load"] = time.time() - t0
+        profile["size"] = len(contents)
+        t0 = time.time()
+    # Even if we are ignoring Disabled for counting, do not apply
+    # disabled patches to our content cache
+    patchset = patch.PatchSet(group, count_only=[p for p in group if p.disabled])
+    write_after = args.output_kext_after and name == args.output_kext[0]
+    ranges = None
+    scope = None
+    if use_macho:
+        ranges = search_ranges(name, contents)
+        scope = ",".join(sorted(args.sections or ["x86_64"]))
+    cached = None
+    results = None
+    if result_cache:
+        key = result_cache.key(resultcache.hash_contents(contents),
+                               patchset.signature(), scope)
+        results = result_cache.get(key)
+    if profile:
+        profile["hash"] = time.time() - t0
+        t0 = time.time()
+    if results is not None:
+        cached = (key, None)
+        if write_after:
+            patchset.replay(contents, results)
+    else:
+        if ranges is not None:
+            results = patchset.apply_within(contents, ranges, profile["patches"] if profile else None)
         else:
-            contents = p.apply(contents)
-            Bundle.set_contents(p.filename, contents)
-
-if args.output_kext_after:
-    after_binary = Bundle.get_contents(args.output_kext[0])
-    args.output_kext_after.write(after_binary)
-    args.output_kext_after.close()
-
-
-for p in patches:
-    if is_disabled(p):
-        continue
-    if p.has_expected:
-        if p.applied_count != p.expected:
-            log.error("expected %d, got %d in: %s: %s", p.expected,
-                p.applied_count, p.filename, p.comment)
-    elif p.applied_count == 0:
-        log.warning("applied 0 times %s: %s:", p.filename,p.comment)
+            results = patchset.apply(contents, profile["patches"] if profile else None)
+        if result_cache:
+            cached = (key, resultcache.hash_contents(contents))
+    if profile:
+        profile["patch"] = time.time() - t0
+        profile["cached"] = cached is not None and cached[1] is None
+    if write_after:
+        contents.write_to(args.output_kext_after)
+        args.output_kext_after.close()
+        args.output_kext_after = None
+    if args.watch:
+        # Keep the binary for the next check
+        contents.revert()
     else:
-        p.dict["Expect"] = p.applied_count
+        Bundle.release(name)
+    return results, cached, profile
+
+
+def check_kernelcache(names):
+    """Apply each kext's group of patches to its kext in the kernel cache.
 
-if args.expected:
-    plistlib.writePlist(config_plist, sys.stdout)
\ No newline at end of file
+    The cache is decompressed once, to a temporary file that is mapped
+    rather than read. As Clover does, each group only matches within its
+    kext's __TEXT and __DATA, found from the cache's prelink info.
+
+    :param names: the kexts to check
+    :return: check_target() results for each name, None for kexts not in
+             the cache
+    :rtype: dict
+    """
+    import kernelcache
+    import tempfile
+    contents = mappedfile.MappedFile(args.kernelcache)
+    try:
+        header = kernelcache.parse_header(contents)
+        log.info("Kernel cache %s: %s, %d bytes, %d uncompressed", args.kernelcache,
+                 header.compression, header.compressed_size, header.size)
+        uncompressed = tempfile.NamedTemporaryFile(prefix="kernelcache")
+        t0 = time.time()
+        kernelcache.decompress_to(contents, uncompressed, header)
+        uncompressed.flush()
+    finally:
+        contents.close()
+    load = time.time() - t0
+    image = mappedfile.MappedFile(uncompressed.name)
+    try:
+        kexts = kernelcache.prelinked_kexts(image)
+        by_lower = dict((k.lower(), k) for k in kexts)
+        results = {}
+        for name in names:
+            found = name if name in kexts else by_lower.get(name.lower())
+            if found is None:
+                results[name] = None
+                continue
+            t0 = time.time()
+            start, end = kexts[found]
+            executable = bytearray(image[start:end])
+            group = targets[name]
+            patchset = patch.PatchSet(group, count_only=[p for p in group if p.disabled])
+            found_at = patchset.apply_within(executable, kernelcache.kext_ranges(executable))
+            profile = None
+            if run_stats:
+                profile = {"size": end - start, "load": load, "hash": 0.0,
+                           "patch": time.time() - t0, "cached": False, "patches": []}
+            results[name] = ([[start + off for off in offsets] for offsets in found_at], None, profile)
+    finally:
+        image.close()
+        uncompressed.close()
+    return results
+
+
+# Set by main()
+result_cache = None
+
+# Kept between checks in --watch mode: for each kext, the PatchSet
+# signature and check_target() result of the last time it was patched.
+target_memo = {}
+
+# Set by check(); a module global so -j workers inherit it
+targets = None
+
+
+def check(config_path):
+    """Check the patches in a config.plist against the kexts they patch.
+
+    Kexts already patched with the same sequence of patches by an earlier
+    call are not patched again.
+
+    :param config_path: path to the config.plist
+    """
+    global targets, run_stats
+    if args.stats and run_stats is None:
+        import stats
+        run_stats = stats.Stats()
+    paths = [PATCHES_PATH, KERNEL_PATCHES_PATH] if args.kernelcache else [PATCHES_PATH]
+    config_plist = plistloader.load(config_path, paths)
+    patches = patch.FilePatch.list_from_clover_config(config_plist)
+    if args.kernelcache:
+        kernel_patches = config_plist.get(KERNEL_PATCHES_PATH[0], {}).get(KERNEL_PATCHES_PATH[1])
+        if kernel_patches:
+            log.warning("Not checking the %d KernelToPatch patches; only KextsToPatch are checked",
+                        len(kernel_patches))
+    if run_stats:
+        run_stats.lap("parse")
+
+    if args.lazy and not args.running and not args.kernelcache:
+        wanted = set(p.filename for p in patches)
+        if args.output_kext:
+            wanted.add(args.output_kext[0])
+        wanted -= resolved_names
+        if wanted:
+            listed = index.resolve(wanted, extensions_dirs)
+            log.info("Kext index: listed %d directories", listed)
+            resolved_names.update(wanted)
+        if run_stats:
+            run_stats.lap("resolve")
+
+    if args.output_kext_before:
+        Bundle.get_contents(args.output_kext[0]).write_to(args.output_kext_before)
+        args.output_kext_before.close()
+        args.output_kext_before = None
+
+    # Patches to different kexts are independent; group them by target so each
+    # kext is loaded, searched once for its whole patch sequence, and released.
+    targets = collections.OrderedDict()
+    for p in patches:
+        if not is_disabled(p):
+            targets.setdefault(p.filename, []).append(p)
+
+    signatures = {}
+    for name, group in targets.items():
+        signatures[name] = patch.PatchSet(group, count_only=[p for p in group if p.disabled]).signature()
+    names = list(targets)
+    todo = [n for n in names if target_memo.get(n, (None,))[0] != signatures[n]]
+    if len(todo) < len(names):
+        log.info("%d of %d kexts unaffected by changes", len(names) - len(todo), len(names))
+
+    if args.kernelcache:
+        target_results = check_kernelcache(todo)
+    elif args.jobs > 1 and len(todo) > 1:
+        # The output kext is written here, not in a worker
+        in_parent = [n for n in todo if args.output_kext_after and n == args.output_kext[0]]
+        in_workers = [n for n in todo if n not in in_parent]
+        if args.watch:
+            # Map binaries here, so they are kept for the next check
+            for name in in_workers:
+                try:
+                    Bundle.get_contents(name)
+                except KeyError:
+                    pass
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs)
+        target_results = dict(zip(in_workers, pool.imap(check_target, in_workers)))
+        pool.close()
+        pool.join()
+        for name in in_parent:
+            target_results[name] = check_target(name)
+    else:
+        target_results = dict((name, check_target(name)) for name in todo)
+    if run_stats:
+        run_stats.lap("patch")
+
+    for name in todo:
+        result = target_results[name]
+        if result is not None:
+            results, cached, profile = result
+            if cached:
+                result_cache.record(cached, results)
+            if profile:
+                run_stats.add_target(name, profile, targets[name], results)
+        target_memo[name] = (signatures[name], result)
+
+    missing = set()
+    for name in names:
+        result = target_memo[name][1]
+        if result is None:
+            missing.add(name)
+            continue
+        for p, offsets in zip(targets[name], result[0]):
+            p.applied_count += len(offsets)
+            p.applied_offsets = offsets
+
+    if args.output_kext_after:
+        # Not patched at all
+        Bundle.get_contents(args.output_kext[0]).write_to(args.output_kext_after)
+        args.output_kext_after.close()
+        args.output_kext_after = None
+
+    for p in patches:
+        log.debug("Found patch %r", p)
+        if is_disabled(p):
+            continue
+        if p.filename in missing:
+            log.warning("No file found for %r", p)
+            continue
+        count = p.applied_count
+        if count:
+            times = "s"[count == 1:]
+            log.info("Applied %d time%s: %s", count, times, p.comment)
+            if log.isEnabledFor(logging.DEBUG):
+                where = None
+                if use_macho:
+                    try:
+                        image = macho_image(p.filename)
+                    except macho.MachOError:
+                        image = None
+                    if image:
+                        where = image.section_at
+                log.debug("  at %s", patch.format_offsets(p.applied_offsets, where=where))
+
+    if result_cache:
+        log.info("Result cache: %d hits, %d misses", result_cache.hits, result_cache.misses)
+        result_cache.save()
+    cache = Bundle.bundles
+    log.info("Bundle cache: %d hits, %d misses, %d evictions",
+             cache.hits, cache.misses, cache.evictions)
+    for who, rusage in [("", resource.RUSAGE_SELF), (" of workers", resource.RUSAGE_CHILDREN)]:
+        if who and args.jobs <= 1:
+            continue
+        peak_rss = resource.getrusage(rusage).ru_maxrss
+        if sys.platform != "darwin":
+            # Linux reports KB, OS X bytes
+            peak_rss *= 1024
+        log.info("Peak RSS%s %.1f MB", who, peak_rss / (1024.0 * 1024))
+    if run_stats:
+        run_stats.lap("report")
+
+    # Index in the patch array to new Expect count
+    expects = {}
+    for i, p in enumerate(patches):
+        if is_disabled(p):
+            continue
+        if p.has_expected:
+            if p.applied_count != p.expected:
+                log.error("expected %d, got %d in: %s: %s", p.expected,
+                    p.applied_count, p.filename, p.comment)
+        elif p.applied_count == 0:
+            log.warning("applied 0 times %s: %s:", p.filename,p.comment)
+        else:
+            p.dict["Expect"] = p.applied_count
+            expects[i] = p.applied_count
+        if args.suggest is not None and p.applied_count == 0 and p.filename not in missing:
+            suggest_near(p)
+
+    if args.expected:
+        import expectwriter
+        if args.in_place:
+            # Leave the file alone if nothing changed, not least for --watch
+            if expects:
+                expectwriter.write_expected_in_place(config_path, PATCHES_PATH, expects)
+        else:
+            with open(config_path, "rb") as f:
+                expectwriter.write_expected(f.read(), PATCHES_PATH, expects, sys.stdout)
+    if run_stats:
+        run_stats.lap("expected")
+        run_stats.write(args.stats_file, args.stats)
+        args.stats_file.flush()
+        run_stats = None
+
+
+def suggest_near(p):
+    """Log where in its kext a patch that applies 0 times might apply."""
+    import suggest
+    contents = mappedfile.MappedFile(Bundle(p.filename).find_filename())
+    try:
+        suggest.log_suggestions(log, p, p.filename, contents,
+                                args.suggest or None,
+                                filename=p.filename)
+    finally:
+        contents.close()
+
+
+def binary_paths():
+    """Map the binary of each kext being patched to its name."""
+    paths = {}
+    if args.kernelcache:
+        return paths
+    for name in targets:
+        try:
+            paths[os.path.abspath(Bundle(name).find_filename())] = name
+        except KeyError:
+            pass
+    return paths
+
+
+def main(argv=None):
+    """Run check-kext-patches.py with the given arguments.
+
+    :param argv: arguments, without the program name; None for sys.argv
+    """
+    global args, use_macho, run_stats, index, extensions_dirs, result_cache
+    args = parser.parse_args(argv)
+    logformat.basic_config("%(levelname)-10s %(message)s")
+
+    for logger in [log, kextindex.log]:
+        if args.verbose == 1:
+            logger.setLevel(logging.INFO)
+        elif args.verbose >= 2:
+            logger.setLevel(logging.DEBUG)
+
+    config_path = args.config
+    use_macho = args.macho or bool(args.sections)
+
+    if args.kernelcache:
+        import kernelcache
+        if use_macho or args.output_kext or args.suggest is not None:
+            parser.error("--kernelcache cannot be used with --macho, --section, --output-kext or --suggest")
+        try:
+            if kernelcache.parse_header(mappedfile.MappedFile(args.kernelcache)) is None:
+                parser.error("%s is not a compressed kernel cache" % args.kernelcache)
+        except (IOError, kernelcache.KernelCacheError) as e:
+            parser.error("%s: %s" % (args.kernelcache, e))
+
+    run_stats = None
+    if args.stats:
+        import stats
+        run_stats = stats.Stats()
+
+    index = kextindex.KextIndex(warn_dupes=not args.ignore_kext_dupes)
+    extensions_dirs = args.extensions or ["/System/Library/Extensions", "/Library/Extensions"]
+
+    if args.kernelcache:
+        # The kexts are in the cache
+        pass
+    elif args.running:
+        sle_path = "/System/Library/Caches/com.apple.kext.caches/Directories/System/Library/Extensions/KextIdentifiers.plist.gz"
+        le_path = "/System/Library/Caches/com.apple.kext.caches/Directories/Library/Extensions/KextIdentifiers.plist.gz"
+        index.read_name_translations_from(sle_path, directory_prefix="/System/Library/Extensions/")
+        index.read_name_translations_from(le_path, directory_prefix="/Library/Extensions/")
+    elif args.lazy:
+        # Kexts are looked up as check() finds out which ones are patched
+        pass
+    else:
+        dircache = kextindex.DirectoryCache(cachedir.cache_file("kext-directories.json"),
+                                            rebuild=args.rebuild_index)
+        for extensions in extensions_dirs:
+            index.walk_for_kexts(extensions, dircache)
+        log.info("Kext index: listed %d directories, reused %d",
+                 dircache.listed, dircache.reused)
+        dircache.save()
+    if run_stats:
+        run_stats.lap("index")
+
+    Bundle.bundles = BundleCache(args.cache_mb * 1024 * 1024)
+    macho_images.clear()
+    resolved_names.clear()
+    target_memo.clear()
+    result_cache = None
+    if not args.no_cache:
+        result_cache = resultcache.ResultCache(cachedir.cache_file("patch-results.json"))
+
+    check(config_path)
+
+    if args.watch:
+        import watch
+        watcher = watch.Watcher([config_path] + ([args.kernelcache] if args.kernelcache else []))
+        watched_binaries = binary_paths()
+        watcher.add(watched_binaries)
+        while True:
+            changed = watcher.wait()
+            for path in changed:
+                if args.kernelcache and path == os.path.abspath(args.kernelcache):
+                    target_memo.clear()
+                name = watched_binaries.get(path)
+                if name:
+                    target_memo.pop(name, None)
+                    macho_images.pop(name, None)
+                    Bundle.release(name)
+            log.warning("%s changed, checking again", ", ".join(sorted(changed)))
+            try:
+                check(config_path)
+            except (KeyError, ValueError, SyntaxError) as e:
+                # Probably caught the config half-written
+                log.error("cannot check %s: %s", config_path, e)
+                continue
+            watched_binaries = binary_paths()
+            watcher.add(watched_binaries)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
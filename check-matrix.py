@@ -0,0 +1,276 @@
+#!/usr/bin/python2.7
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import cachedir
+import kextindex
+import logformat
+import mappedfile
+import patch
+import plistloader
+import resultcache
+
+log = logging.getLogger("checkmatrix")
+
+# Check several config.plists against several Extensions directories.
+#
+# Running check-kext-patches.py once per (config, directory) pair walks
+# and reads each directory once per config. Here each directory is
+# indexed once, and each kext binary is hashed once; directories from
+# different macOS builds share many identical binaries, and each distinct
+# binary is patched once per distinct sequence of patches applied to it,
+# however many (config, directory) pairs that covers.
+
+PATCHES_PATH = ("KernelAndKextPatches", "KextsToPatch")
+
+parser = argparse.ArgumentParser(description="Check kext patches of many configs against many Extensions directories")
+parser.add_argument("-e", "--extensions", action="append", metavar="[LABEL=]DIR", required=True,
+                    help="An Extensions directory, such as one from a macOS build; may be repeated. LABEL names its column")
+parser.add_argument("-a", "--enable-all",
+                    help="Pretend all patches are enabled, but do not do replacements for disabled ones",
+                    action="store_true")
+parser.add_argument("--json", help="Write the results as JSON instead of a table", action="store_true")
+parser.add_argument("--no-cache", help="Do not use or save cached results from earlier runs",
+                    action="store_true")
+parser.add_argument("--ignore-kext-dupes", help="Don't warn about multiple kexts with the same name", action="store_true")
+parser.add_argument("-v", "--verbose", help="Be more verbose, -vv for more", action="count")
+parser.add_argument("configs", nargs="+", metavar="config.plist", help="paths to config.plist files")
+
+
+class Root:
+    """An Extensions directory and its kext index."""
+
+    def __init__(self, spec, dircache):
+        label, sep, path = spec.partition("=")
+        if not sep:
+            label = path = spec
+        self.label = label
+        self.path = path
+        self.index = kextindex.KextIndex(warn_dupes=not args.ignore_kext_dupes)
+        self.index.walk_for_kexts(path, dircache)
+
+
+class Config:
+    """A config.plist's kext patches, grouped by the kext they patch."""
+
+    def __init__(self, path):
+        self.path = path
+        self.patches = patch.FilePatch.list_from_clover_config(plistloader.load(path, [PATCHES_PATH]))
+        self.groups = collections.OrderedDict()
+        # Each checked patch's place in its group
+        self.position = {}
+        for p in self.patches:
+            if args.enable_all or not p.disabled:
+                group = self.groups.setdefault(p.filename, [])
+                self.position[p] = len(group)
+                group.append(p)
+        self.patchsets = dict((name, patch.PatchSet(group, count_only=[p for p in group if p.disabled]))
+                              for name, group in self.groups.items())
+
+
+class Binaries:
+    """Content hashes of kext binaries, computed once per file."""
+
+    def __init__(self):
+        # (device, inode, size, mtime) to hash, so hard links and
+        # snapshots sharing a file are read once
+        self.hashes = {}
+        # Hash to a path with those contents
+        self.paths = {}
+        self.files = 0
+
+    def hash(self, path):
+        st = os.stat(path)
+        ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        digest = self.hashes.get(ident)
+        if digest is None:
+            contents = mappedfile.MappedFile(path)
+            try:
+                digest = resultcache.hash_contents(contents)
+            finally:
+                contents.close()
+            self.hashes[ident] = digest
+            self.files += 1
+        self.paths.setdefault(digest, path)
+        return digest
+
+
+def scan(binaries, jobs, result_cache):
+    """Apply each distinct patch sequence to each distinct binary once.
+
+    :param jobs: binary hash to {signature: PatchSet}
+    :return: (binary hash, signature) to match offsets for each patch
+    :rtype: dict
+    """
+    results = {}
+    scanned = 0
+    for digest, patchsets in jobs.items():
+        contents = None
+        try:
+            for signature, patchset in patchsets.items():
+                key = None
+                if result_cache:
+                    key = result_cache.key(digest, signature)
+                    offsets = result_cache.get(key)
+                    if offsets is not None:
+                        result_cache.hits += 1
+                        results[digest, signature] = offsets
+                        continue
+                if contents is None:
+                    contents = mappedfile.MappedFile(binaries.paths[digest])
+                view = contents.view()
+                offsets = patchset.apply(view)
+                scanned += 1
+                if result_cache:
+                    result_cache.misses += 1
+                    result_cache.put(key, offsets, resultcache.hash_contents(view))
+                view.close()
+                results[digest, signature] = offsets
+        finally:
+            if contents is not None:
+                contents.close()
+    log.info("Patched %d (binary, patch sequence) pairs", scanned)
+    return results
+
+
+def check_cell(config, root, binary_of, results):
+    """Compare one config's patches with what they did to one root's kexts.
+
+    :param binary_of: kext name to binary hash in this root, or None if
+                      the root has no such kext
+    :return: the patches whose Expect was not met, that matched nothing,
+             and whose kext is missing
+    :rtype: dict
+    """
+    cell = {"config": config.path, "root": root.label,
+            "mismatches": [], "zero": [], "missing": []}
+    for i, p in enumerate(config.patches):
+        if p not in config.position:
+            continue
+        entry = {"index": i, "target": p.filename, "comment": p.comment}
+        digest = binary_of.get(p.filename)
+        if digest is None:
+            cell["missing"].append(entry)
+            continue
+        signature = config.patchsets[p.filename].signature()
+        offsets = results[digest, signature][config.position[p]]
+        entry["count"] = len(offsets)
+        if p.has_expected:
+            if p.expected != len(offsets):
+                entry["expected"] = p.expected
+                cell["mismatches"].append(entry)
+        elif not offsets:
+            cell["zero"].append(entry)
+    return cell
+
+
+def format_cell(cell):
+    parts = []
+    for key, letter in [("mismatches", "E"), ("zero", "Z"), ("missing", "M")]:
+        if cell[key]:
+            parts.append("%s%d" % (letter, len(cell[key])))
+    return " ".join(parts) or "ok"
+
+
+def write_table(f, configs, roots, cells):
+    width = max(len(c.path) for c in configs)
+    widths = [max(len(r.label), max(len(format_cell(cells[c.path, r.label])) for c in configs))
+              for r in roots]
+    header = "%-*s" % (width, "config")
+    for r, w in zip(roots, widths):
+        header += "  %-*s" % (w, r.label)
+    f.write(header.rstrip() + "\n")
+    for c in configs:
+        row = "%-*s" % (width, c.path)
+        for r, w in zip(roots, widths):
+            row += "  %-*s" % (w, format_cell(cells[c.path, r.label]))
+        f.write(row.rstrip() + "\n")
+    f.write("\nE: Expect not met, Z: applied 0 times, M: kext not found\n")
+
+
+def log_cell(cell):
+    where = "%s on %s" % (cell["config"], cell["root"])
+    for e in cell["mismatches"]:
+        log.error("%s: expected %d, got %d in: %s: %s", where, e["expected"], e["count"],
+                  e["target"], e["comment"])
+    for e in cell["zero"]:
+        log.warning("%s: applied 0 times %s: %s", where, e["target"], e["comment"])
+    for e in cell["missing"]:
+        log.info("%s: no file found for %s: %s", where, e["target"], e["comment"])
+
+
+def main(argv=None):
+    global args
+    args = parser.parse_args(argv)
+    logformat.basic_config("%(levelname)-10s %(message)s")
+    for logger in [log, kextindex.log]:
+        if args.verbose == 1:
+            logger.setLevel(logging.INFO)
+        elif args.verbose >= 2:
+            logger.setLevel(logging.DEBUG)
+
+    dircache = kextindex.DirectoryCache(cachedir.cache_file("kext-directories.json"))
+    roots = [Root(spec, dircache) for spec in args.extensions]
+    labels = [r.label for r in roots]
+    if len(set(labels)) < len(labels):
+        parser.error("two Extensions directories have the same label")
+    log.info("Kext index: listed %d directories, reused %d", dircache.listed, dircache.reused)
+    dircache.save()
+    configs = [Config(path) for path in args.configs]
+
+    # What each root's copy of each patched kext is, and what patch
+    # sequences each distinct binary needs
+    binaries = Binaries()
+    binary_of = {}
+    jobs = collections.OrderedDict()
+    checks = 0
+    for r in roots:
+        names = {}
+        for c in configs:
+            for name, patchset in c.patchsets.items():
+                if name not in names:
+                    try:
+                        names[name] = binaries.hash(r.index.binary_path(name))
+                    except KeyError:
+                        names[name] = None
+                digest = names[name]
+                if digest is not None:
+                    jobs.setdefault(digest, {})[patchset.signature()] = patchset
+                    checks += 1
+        binary_of[r.label] = names
+    log.info("%d configs x %d roots: %d kext checks, %d files hashed, %d distinct binaries, %d pairs",
+             len(configs), len(roots), checks, binaries.files, len(jobs),
+             sum(len(j) for j in jobs.values()))
+
+    result_cache = None
+    if not args.no_cache:
+        result_cache = resultcache.ResultCache(cachedir.cache_file("patch-results.json"))
+    results = scan(binaries, jobs, result_cache)
+    if result_cache:
+        log.info("Result cache: %d hits, %d misses", result_cache.hits, result_cache.misses)
+        result_cache.save()
+
+    cells = collections.OrderedDict()
+    for c in configs:
+        for r in roots:
+            cell = check_cell(c, r, binary_of[r.label], results)
+            cells[c.path, r.label] = cell
+            log_cell(cell)
+    if args.json:
+        json.dump(cells.values(), sys.stdout, indent=1, sort_keys=True, separators=(",", ": "))
+        sys.stdout.write("\n")
+    else:
+        write_table(sys.stdout, configs, roots, cells)
+    if any(cell["mismatches"] for cell in cells.values()):
+        return 1
+    return 0
+
+
+# Set by main()
+args = None
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import base64
+import collections
+import json
+import plistlib
+import socket
+
+import cachedir
+
+# Messages between check-client.py and check-daemon.py.
+#
+# A client connects to the daemon's Unix domain socket, sends one request
+# as a line of JSON, and reads one JSON response; then the connection is
+# closed. Patches travel as their config.plist dicts, with <data> values
+# as {"data": base64}.
+#
+# Requests:
+#
+#   {"op": "ping"}
+#   {"op": "reindex"}
+#   {"op": "check-kexts", "patches": [...], "enable_all": false}
+#   {"op": "check-dsdt", "patches": [...], "targets": ["/path/DSDT.aml", ...]}
+#
+# "patches" may be replaced by "config", a path the daemon loads itself.
+# A response has "error" set if the request failed; see check-daemon.py
+# for what the rest contains.
+
+
+def default_socket_path():
+    return cachedir.cache_file("checker.sock")
+
+
+def to_json(value):
+    """Convert a plist value to something json can write."""
+    if isinstance(value, dict):
+        return dict((k, to_json(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    if isinstance(value, plistlib.Data):
+        return {"data": base64.b64encode(value.data)}
+    return value
+
+
+def from_json(value):
+    """Undo to_json, with strings as UTF-8 str as plistloader gives them."""
+    if isinstance(value, dict):
+        if value.keys() == ["data"]:
+            return plistlib.Data(base64.b64decode(value["data"]))
+        return collections.OrderedDict(
+            (k.encode("utf-8"), from_json(v)) for k, v in sorted(value.items()))
+    if isinstance(value, list):
+        return [from_json(v) for v in value]
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send(path, request):
+    """Send one request to the daemon at path and return its response.
+
+    :raises socket.error: if the daemon isn't there
+    :raises ProtocolError: if the daemon's reply is empty or not JSON
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(request) + "\n")
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+    data = "".join(chunks)
+    if not data:
+        raise ProtocolError("check-daemon.py closed the connection without replying")
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise ProtocolError("bad reply from check-daemon.py: %s" % e)
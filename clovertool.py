@@ -0,0 +1,92 @@
+#!/usr/bin/python2.7
+import imp
+import os.path
+import sys
+
+# One entry point for the tools: clovertool.py COMMAND [ARGS...].
+#
+# A command's script is only loaded when that command is run, so starting
+# up costs the imports of the one tool, not of all of them. Each script
+# has a main(argv) and does nothing when imported, so other programs can
+# run the tools in-process too:
+#
+#     import clovertool
+#     status = clovertool.run(["check-kext", "-l", "config.plist"])
+#
+# The tools share module state with whoever runs them: the loggers they
+# configure when the program has not, and module globals that last from
+# one run to the next the way they do between --watch checks.
+
+# Command name, script and description, in the order they are listed
+COMMANDS = [
+    ("check-dsdt", "check-dsdt-patches.py", "Apply ACPI patches to DSDT/SSDT files"),
+    ("check-kext", "check-kext-patches.py", "Test if kext patches would apply"),
+    ("check-matrix", "check-matrix.py", "Check kext patches of many configs against many Extensions directories"),
+    ("analyze", "analyze-patches.py", "Find patches whose results depend on their order"),
+    ("check-daemon", "check-daemon.py", "Keep kexts loaded and answer check requests"),
+    ("check-client", "check-client.py", "Check a config.plist using a running check daemon"),
+    ("makebinpatch", "makebinpatch.py", "Print plist binary patch stanzas"),
+    ("catplist", "catplist.py", "Cat (and normalize) a property list"),
+    ("diffplist", "diffplist.py", "Diff two normalized property lists"),
+]
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def load(command):
+    """Import a command's script, once.
+
+    :param command: a command name from COMMANDS
+    :return: the script as a module, with its parser and main()
+    :raises KeyError: if there is no such command
+    """
+    script = dict((name, script) for name, script, _ in COMMANDS)[command]
+    module_name = os.path.splitext(script)[0].replace("-", "_")
+    module = sys.modules.get(module_name)
+    if module is None:
+        if here not in sys.path:
+            # For the scripts' own imports
+            sys.path.insert(0, here)
+        module = imp.load_source(module_name, os.path.join(here, script))
+        module.parser.prog = "clovertool.py %s" % command
+    return module
+
+
+def run(argv):
+    """Run a command in this process.
+
+    :param argv: the command name and its arguments
+    :type argv: list[str]
+    :return: the exit status, as sys.exit() would take it
+    """
+    module = load(argv[0])
+    try:
+        return module.main(argv[1:])
+    except SystemExit as e:
+        return e.code
+
+
+def usage(f):
+    f.write("usage: clovertool.py COMMAND [ARGS...]\n\ncommands:\n")
+    for name, _, description in COMMANDS:
+        f.write("  %-14s %s\n" % (name, description))
+    f.write("\nclovertool.py COMMAND -h for a command's options\n")
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] in ("-h", "--help"):
+        usage(sys.stdout if argv else sys.stderr)
+        return 0 if argv else 2
+    try:
+        module = load(argv[0])
+    except KeyError:
+        sys.stderr.write("clovertool.py: unknown command %r\n\n" % argv[0])
+        usage(sys.stderr)
+        return 2
+    return module.main(argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
-import plistlib
-import plistmonkey
+import plistloader
+import plistwriter
 import argparse
 import sys
 import os.path
@@ -14,6 +14,10 @@ parser = argparse.ArgumentParser(description="Diff two normalized property lists
 
 Example: diff -U10 config1.plist config2.plist
 Example: diff config1.plist config2.plist -U 10
+
+With -t or --json, the plists are compared as trees without running diff.
+Patches in arrays are matched by Comment, or by Name and Find, so adding
+or reordering patches doesn't show every later patch as changed.
 """)
 
 parser.add_argument("-s", "--short-data",
@@ -25,6 +29,12 @@ parser.add_argument("-n", "--normalize",
 parser.add_argument("-g", "--git-diff",
                     help="Use git diff instead of diff",
                     action="store_true")
+parser.add_argument("-t", "--tree",
+                    help="Compare structurally and print changes by key path",
+                    action="store_true")
+parser.add_argument("--json",
+                    help="Like --tree, printing the changes as JSON",
+                    action="store_true")
 parser.add_argument("file1", help="path to first file", nargs=1,
                     type=argparse.FileType("r"))
 parser.add_argument("file2", help="path to second file", nargs=1,
@@ -39,34 +49,52 @@ def basename(f):
     fn = fn.replace(".plist", "")
     return fn
 
-(args, restargs) = parser.parse_known_args()
-
-file1 = args.file1[0]
-file2 = args.file2[0]
-plistmonkey.sortItems = args.normalize
-plistmonkey.rehabManHouseStyle = args.short_data
-
-file1basename = basename(file1)
-file2basename = basename(file2)
-
-plist1 = plistlib.readPlist(file1)
-plist2 = plistlib.readPlist(file2)
-
-
-with tempfile.NamedTemporaryFile(suffix=".plist", prefix=file1basename+".") as out1:
-    with tempfile.NamedTemporaryFile(suffix=".plist", prefix=file2basename+".") as out2:
-        plistlib.writePlist(plist1, out1)
-        out1.flush()
-        plistlib.writePlist(plist2, out2)
-        out2.flush()
-        if args.git_diff:
-            arglist = ["git", "diff", "--no-index"]
-            arglist += restargs
-            arglist.append("--")
-        else:
-            arglist = ["diff"]
-            arglist.extend(restargs)
-        arglist.extend([out1.name, out2.name])
-        result = subprocess.call(arglist)
-
-sys.exit(result)
+def main(argv=None):
+    (args, restargs) = parser.parse_known_args(argv)
+
+    file1 = args.file1[0]
+    file2 = args.file2[0]
+
+    file1basename = basename(file1)
+    file2basename = basename(file2)
+
+    plist1 = plistloader.load(file1)
+    plist2 = plistloader.load(file2)
+
+    if args.tree or args.json:
+        if restargs:
+            parser.error("unrecognized arguments: %s" % " ".join(restargs))
+        import plistdiff
+        changes = list(plistdiff.diff(plist1, plist2))
+        if args.json:
+            sys.stdout.write(plistdiff.format_json(changes))
+        elif changes:
+            sys.stdout.write(plistdiff.format_unified(changes, file1.name, file2.name,
+                                                      rehabManHouseStyle=args.short_data,
+                                                      sortItems=args.normalize))
+        # Exit status as diff's
+        return 1 if changes else 0
+
+    with tempfile.NamedTemporaryFile(suffix=".plist", prefix=file1basename+".") as out1:
+        with tempfile.NamedTemporaryFile(suffix=".plist", prefix=file2basename+".") as out2:
+            plistwriter.writePlist(plist1, out1, rehabManHouseStyle=args.short_data,
+                                   sortItems=args.normalize)
+            out1.flush()
+            plistwriter.writePlist(plist2, out2, rehabManHouseStyle=args.short_data,
+                                   sortItems=args.normalize)
+            out2.flush()
+            if args.git_diff:
+                arglist = ["git", "diff", "--no-index"]
+                arglist += restargs
+                arglist.append("--")
+            else:
+                arglist = ["diff"]
+                arglist.extend(restargs)
+            arglist.extend([out1.name, out2.name])
+            result = subprocess.call(arglist)
+
+    return result
+
+
+if __name__ == "__main__":
+    sys.exit(main())
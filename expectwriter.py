@@ -0,0 +1,178 @@
+import os
+import tempfile
+import xml.parsers.expat
+
+# Write Expect counts into a config.plist without re-serializing it.
+#
+# plistlib.writePlist rewrites the whole file, reformatting sections
+# nobody touched. Instead, find the byte offsets of each patch <dict> in
+# the original file and copy the file through, splicing in
+#
+#     <key>Expect</key>
+#     <integer>N</integer>
+#
+# before the </dict> of each patch that needs one (or replacing the
+# <integer> of an existing Expect).
+
+
+class PatchSpan:
+    """Where a patch <dict> and its parts are in the source bytes."""
+
+    def __init__(self, start):
+        self.start = start
+        self.end = None
+        self.first_key = None
+        # [start, end) of the value element after <key>Expect</key>
+        self.expect_start = None
+        self.expect_end = None
+
+
+def find_patch_spans(src, array_path):
+    """Find each <dict> in the array at array_path.
+
+    :param src: the plist source
+    :type src: str
+    :param array_path: dict keys leading to the patch array, such as
+                       ("ACPI", "DSDT", "Patches")
+    :type array_path: tuple[str]
+    :return: a PatchSpan for each element of the array, in order
+    :rtype: list[PatchSpan]
+    """
+    parser = xml.parsers.expat.ParserCreate()
+    # Frames are [tag, path, last key]; the path is None outside dicts
+    # and arrays on the way to array_path
+    stack = [["plist", (), None]]
+    spans = []
+    state = {"text": None, "span": None, "expect": False}
+
+    def start_element(name, attrs):
+        here = parser.CurrentByteIndex
+        parent = stack[-1]
+        if name == "key":
+            state["text"] = []
+            if state["span"] and parent[0] == "dict" and len(stack) == state["depth"]:
+                if state["span"].first_key is None:
+                    state["span"].first_key = here
+            return
+        span = state["span"]
+        if span and len(stack) == state["depth"] and state["expect"]:
+            span.expect_start = here
+        path = None
+        if parent[1] is not None and parent[0] != "array":
+            if parent[0] == "dict":
+                path = parent[1] + (parent[2],)
+            else:
+                path = ()
+            if array_path[:len(path)] != path:
+                path = None
+        if name == "dict" and parent[0] == "array" and parent[1] == array_path:
+            span = PatchSpan(here)
+            spans.append(span)
+            state["span"] = span
+            state["depth"] = len(stack) + 1
+        stack.append([name, path, None])
+
+    def end_element(name):
+        here = parser.CurrentByteIndex
+        if name == "key":
+            key = "".join(state["text"])
+            state["text"] = None
+            stack[-1][2] = key
+            state["expect"] = (state["span"] is not None and
+                               len(stack) == state["depth"] and key == "Expect")
+            return
+        stack.pop()
+        span = state["span"]
+        if not span:
+            return
+        if len(stack) == state["depth"] and state["expect"]:
+            # The Expect value just ended
+            if src.startswith("</", here):
+                here = src.index(">", here) + 1
+            else:
+                # <integer/> and friends
+                here = src.index("/>", here) + 2
+            span.expect_end = here
+            state["expect"] = False
+        elif len(stack) == state["depth"] - 1 and name == "dict":
+            span.end = here
+            state["span"] = None
+
+    def character_data(data):
+        if state["text"] is not None:
+            state["text"].append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    parser.Parse(src, True)
+    return spans
+
+
+def _line_before(src, offset):
+    """What precedes offset on its line."""
+    line_start = src.rfind("\n", 0, offset) + 1
+    return src[line_start:offset]
+
+
+def _indent(line):
+    return line[:len(line) - len(line.lstrip())]
+
+
+def write_expected(src, array_path, expects, out):
+    """Copy src to out, setting Expect in the given patches.
+
+    :param src: the plist source
+    :type src: str
+    :param array_path: dict keys leading to the patch array
+    :param expects: index in the patch array to Expect count
+    :type expects: dict[int, int]
+    :param out: file to write to
+    """
+    spans = find_patch_spans(src, array_path)
+    edits = []
+    for i, count in sorted(expects.items()):
+        span = spans[i]
+        value = "<integer>%d</integer>" % count
+        if span.expect_start is not None:
+            edits.append((span.expect_start, span.expect_end, value))
+            continue
+        before_end = _line_before(src, span.end)
+        if before_end.strip():
+            # </dict> is not on a line of its own, so neither is Expect
+            edits.append((span.end, span.end, "<key>Expect</key>" + value))
+            continue
+        # Indent like the first key, if it starts its line, else one level
+        # in from the <dict>
+        indent = None
+        if span.first_key is not None:
+            before_key = _line_before(src, span.first_key)
+            if not before_key.strip():
+                indent = before_key
+        if indent is None:
+            indent = _indent(_line_before(src, span.start)) + "\t"
+        line_start = span.end - len(before_end)
+        edits.append((line_start, line_start,
+                      "%s<key>Expect</key>\n%s%s\n" % (indent, indent, value)))
+    pos = 0
+    for start, end, text in edits:
+        out.write(src[pos:start])
+        out.write(text)
+        pos = end
+    out.write(src[pos:])
+
+
+def write_expected_in_place(path, array_path, expects):
+    """Like write_expected, replacing the file at path atomically."""
+    with open(path, "rb") as f:
+        src = f.read()
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".", suffix=".plist")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            write_expected(src, array_path, expects, out)
+        os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,630 @@
+import posixpath
+import struct
+import xml.etree.cElementTree as ElementTree
+import zlib
+
+import macho
+
+# Decompress a prelinkedkernel or kernelcache a chunk at a time.
+#
+# What boots is not the kexts in /System/Library/Extensions but a kernel
+# cache: the kernel with its kexts prelinked, compressed in a "comp"
+# container, sometimes inside a universal file with only an x86_64 slice.
+# The container is a big-endian header:
+#
+#   "comp", "lzss" or "lzvn", adler32 and size of the uncompressed data,
+#   size of the compressed data, 44 reserved bytes, 64 bytes of platform
+#   name, 256 bytes of root path
+#
+# and the compressed data right after it, at offset 0x180.
+#
+# decompress() yields the uncompressed data in chunks, keeping only as
+# much of it as back-references can reach, so a 50 MB cache never has to
+# be in memory at once. The compressed data is read a block at a time, so
+# a MappedFile of the cache isn't read into memory either.
+#
+# What comes out is a Mach-O kernel. Its __PRELINK_TEXT segment holds the
+# kexts' executables, and __PRELINK_INFO,__info an XML plist listing them,
+# with where each one's executable was put. prelinked_kexts() reads that,
+# so a kext's patches can be matched only within the kext, as Clover
+# matches them.
+#
+# compress_lzss(), compress_lzvn(), build() and build_prelinked() write
+# caches for trying this out without a Mac.
+
+COMP_MAGIC = "comp"
+HEADER_SIZE = 0x180
+
+CHUNK_SIZE = 1024 * 1024
+# Compressed bytes read at a time
+_BLOCK = 64 * 1024
+
+
+class KernelCacheError(ValueError):
+    pass
+
+
+class Header:
+    def __init__(self, compression, adler32, size, compressed_size, offset, platform):
+        self.compression = compression
+        self.adler32 = adler32
+        self.size = size
+        self.compressed_size = compressed_size
+        # Of the compressed data, from the start of the file
+        self.offset = offset
+        self.platform = platform
+
+    def __repr__(self):
+        return "<Header %s %d -> %d bytes>" % (self.compression, self.compressed_size, self.size)
+
+
+def parse_header(buf):
+    """Find the comp container in buf.
+
+    :param buf: the file contents
+    :type buf: str | mappedfile.MappedFile
+    :return: None if buf is not a compressed kernel cache
+    :rtype: Header | None
+    :raises KernelCacheError: if it is one, but is truncated
+    """
+    base = 0
+    try:
+        fat_slice = macho.x86_64_slice(buf)
+    except macho.MachOError:
+        return None
+    if fat_slice is not None:
+        base = fat_slice[0]
+    header = bytes(buf[base:base + HEADER_SIZE])
+    if header[:4] != COMP_MAGIC:
+        return None
+    if len(header) < HEADER_SIZE:
+        raise KernelCacheError("truncated header")
+    _, compression, adler32, size, compressed_size = struct.unpack(">4s4sIII", header[:20])
+    platform = header[64:128].split("\0", 1)[0]
+    if base + HEADER_SIZE + compressed_size > len(buf):
+        raise KernelCacheError("truncated compressed data")
+    return Header(compression, adler32, size, compressed_size, base + HEADER_SIZE, platform)
+
+
+def decompress(buf, header=None, chunk_size=CHUNK_SIZE):
+    """Yield the uncompressed contents of a kernel cache in chunks.
+
+    Every chunk but the last is chunk_size bytes.
+
+    :param header: from parse_header(buf), if already parsed
+    :raises KernelCacheError: if buf is not a kernel cache we can
+                              decompress, or the data is corrupt
+    """
+    if header is None:
+        header = parse_header(buf)
+        if header is None:
+            raise KernelCacheError("not a compressed kernel cache")
+    if header.compression == "lzss":
+        decoder = lzss_chunks
+    elif header.compression == "lzvn":
+        decoder = lzvn_chunks
+    else:
+        raise KernelCacheError("unknown compression %r" % header.compression)
+    adler32 = 1
+    for chunk in decoder(buf, header.offset, header.offset + header.compressed_size,
+                         header.size, chunk_size):
+        adler32 = zlib.adler32(chunk, adler32)
+        yield chunk
+    if adler32 & 0xffffffff != header.adler32:
+        raise KernelCacheError("checksum mismatch")
+
+
+def decompress_to(buf, f, header=None):
+    """Write the uncompressed contents of a kernel cache to file f.
+
+    :raises KernelCacheError: as decompress() does
+    """
+    for chunk in decompress(buf, header):
+        f.write(chunk)
+
+
+def parse_prelink_info(xml):
+    """The kexts listed in a __PRELINK_INFO plist.
+
+    It is a plist without the <plist> element, in which a value may have
+    an ID attribute and an empty element with an IDREF attribute stands
+    for the value with that ID. Integers may be in hex.
+
+    :rtype: list[dict]
+    :raises KernelCacheError: if it can't be parsed
+    """
+    try:
+        root = ElementTree.fromstring(xml.split("\0", 1)[0])
+    except SyntaxError as e:
+        raise KernelCacheError("bad prelink info: %s" % e)
+    ids = {}
+
+    def value(elem):
+        ref = elem.get("IDREF")
+        if ref is not None:
+            if ref not in ids:
+                raise KernelCacheError("prelink info refers to unknown ID %s" % ref)
+            return ids[ref]
+        text = (elem.text or "").strip()
+        if elem.tag == "dict":
+            children = list(elem)
+            v = dict((k.text or "", value(e)) for k, e in zip(children[::2], children[1::2]))
+        elif elem.tag == "array":
+            v = [value(e) for e in elem]
+        elif elem.tag == "integer":
+            try:
+                v = int(text, 16) if text.lower().startswith("0x") else int(text)
+            except ValueError:
+                raise KernelCacheError("bad integer %r in prelink info" % text)
+        elif elem.tag in ("true", "false"):
+            v = elem.tag == "true"
+        else:
+            v = elem.text or ""
+        if elem.get("ID") is not None:
+            ids[elem.get("ID")] = v
+        return v
+
+    if root.tag == "plist" and len(root):
+        root = root[0]
+    info = value(root)
+    if not isinstance(info, dict):
+        raise KernelCacheError("prelink info is not a dict")
+    return info.get("_PrelinkInfoDictionary", [])
+
+
+def prelinked_kexts(buf):
+    """Where each prelinked kext's executable is in an uncompressed cache.
+
+    :param buf: the uncompressed cache
+    :type buf: str | bytearray | mappedfile.MappedFile
+    :return: kext name, as KextsToPatch names it (AppleHDA for
+             .../AppleHDA.kext), to the [start, end) file offsets of its
+             executable; kexts without one are left out
+    :rtype: dict[str, (int, int)]
+    :raises KernelCacheError: if buf is not a prelinked kernel
+    """
+    try:
+        image = macho.parse(buf)
+    except macho.MachOError as e:
+        raise KernelCacheError("kernel: %s" % e)
+    if image is None:
+        raise KernelCacheError("not a Mach-O kernel")
+    info = [s for s in image.sections if s.name == "__PRELINK_INFO,__info"]
+    if not info:
+        raise KernelCacheError("no __PRELINK_INFO,__info section")
+    kexts = {}
+    for d in parse_prelink_info(bytes(buf[info[0].offset:info[0].offset + info[0].size])):
+        path = d.get("_PrelinkBundlePath")
+        address = d.get("_PrelinkExecutableSourceAddr", d.get("_PrelinkExecutableLoadAddr"))
+        size = d.get("_PrelinkExecutableSize")
+        if not path or address is None or not size:
+            continue
+        name = posixpath.basename(path.rstrip("/"))
+        if name.endswith(".kext"):
+            name = name[:-len(".kext")]
+        start = image.file_offset(address)
+        if start is None or start + size > len(buf):
+            raise KernelCacheError("%s is outside the cache" % path)
+        # Plugins may share a name with another kext; keep the first
+        kexts.setdefault(name, (start, start + size))
+    return kexts
+
+
+def kext_ranges(executable, names=("__TEXT", "__DATA")):
+    """The ranges of a prelinked kext's executable to search.
+
+    :param executable: the kext's executable, as cut from the cache at the
+                       extent prelinked_kexts() gives
+    :param names: segments or sections to search, as for macho.MachO.ranges
+    :return: their ranges in executable, or all of it if its Mach-O header
+             can't be read
+    :rtype: list[(int, int)]
+    """
+    try:
+        image = macho.parse(executable)
+    except macho.MachOError:
+        image = None
+    if image is not None:
+        ranges = [(start, min(end, len(executable))) for start, end in image.ranges(list(names))
+                  if start < len(executable)]
+        if ranges:
+            return ranges
+    return [(0, len(executable))]
+
+
+def _block(buf, pos, end, slack):
+    """The next block of compressed data to decode, as a bytearray.
+
+    The block holds slack bytes beyond the limit returned with it, or runs
+    to end, so anything that starts before the limit can be decoded from
+    it.
+
+    :rtype: (bytearray, int)
+    """
+    block = bytearray(buf[pos:min(end, pos + _BLOCK + slack)])
+    limit = len(block)
+    if pos + len(block) < end:
+        limit = _BLOCK
+    return block, limit
+
+
+class _Output:
+    """Decompressed bytes, handed out a chunk at a time.
+
+    out holds the last history bytes handed out, up to window of them,
+    which back-references may copy from, followed by the bytes decoded
+    since.
+    """
+
+    def __init__(self, initial, window, chunk_size, size):
+        self.out = bytearray(initial)
+        self.history = len(initial)
+        self.window = window
+        self.chunk_size = chunk_size
+        self.size = size
+        self.handed_out = 0
+
+    def position(self):
+        """Number of bytes decoded so far."""
+        return self.handed_out + len(self.out) - self.history
+
+    def drain(self, final=False):
+        """Take full chunks, or with final everything, from out."""
+        out = self.out
+        start = self.history
+        # Anything decoded beyond size is dropped
+        end = min(len(out), start + self.size - self.handed_out)
+        chunks = []
+        while end - start >= self.chunk_size or (final and end > start):
+            chunk = str(out[start:min(end, start + self.chunk_size)])
+            chunks.append(chunk)
+            start += len(chunk)
+        self.handed_out += start - self.history
+        keep = min(self.window, start)
+        del out[:start - keep]
+        self.history = keep
+        return chunks
+
+    def finish(self):
+        """The remaining chunks, up to size bytes in all."""
+        if self.position() < self.size:
+            raise KernelCacheError("truncated: %d bytes of %d" % (self.position(), self.size))
+        return self.drain(final=True)
+
+
+def _copy(out, distance, length):
+    """Append length bytes from distance back, repeating if they overlap."""
+    start = len(out) - distance
+    if distance >= length:
+        out += out[start:start + length]
+    else:
+        pattern = out[start:]
+        out += (pattern * (length // distance + 1))[:length]
+
+
+# LZSS, as in Okumura's LZSS.C: a flag byte for each 8 items, with bit set
+# for a literal byte and clear for a 2-byte reference to up to 18 bytes
+# in a 4096-byte ring buffer. The ring starts out filled with spaces, and
+# is written from 18 bytes before its end.
+
+LZSS_N = 4096
+LZSS_F = 18
+LZSS_THRESHOLD = 2
+
+
+def lzss_chunks(buf, start, end, size, chunk_size=CHUNK_SIZE):
+    """Yield the LZSS-compressed buf[start:end], size bytes, in chunks."""
+    N = LZSS_N
+    # The ring buffer before anything is written to it, as the history
+    # before the first byte: byte N - F is written first
+    output = _Output("\0" * LZSS_F + " " * (N - LZSS_F), N, chunk_size, size)
+    pos = start
+    while pos < end:
+        block, limit = _block(buf, pos, end, 17)
+        out = output.out
+        # Ring index of the next byte written, less len(out)
+        ring_base = N - LZSS_F + output.handed_out - output.history
+        i = 0
+        n = len(block)
+        while i < limit:
+            flags = block[i]
+            i += 1
+            if flags == 0xff and i + 8 <= n:
+                out += block[i:i + 8]
+                i += 8
+                continue
+            for _ in range(8):
+                if i >= n:
+                    break
+                if flags & 1:
+                    out.append(block[i])
+                    i += 1
+                else:
+                    if i + 1 >= n:
+                        i = n
+                        break
+                    ring = block[i] | (block[i + 1] & 0xf0) << 4
+                    length = (block[i + 1] & 0x0f) + LZSS_THRESHOLD + 1
+                    i += 2
+                    # Referring to where the ring is being written is
+                    # referring to a whole ring back
+                    distance = (ring_base + len(out) - ring) % N or N
+                    _copy(out, distance, length)
+                flags >>= 1
+        for chunk in output.drain():
+            yield chunk
+        if output.position() >= size:
+            break
+        pos += i
+    for chunk in output.finish():
+        yield chunk
+
+
+# LZVN, as in Apple's LZFSE sources: a byte-aligned stream of opcodes,
+# each some literal bytes copied from the input and/or a match copied
+# from up to 65535 bytes back. The opcode's top bits say which kind:
+#
+#   LLMMMDDD DDDDDDDD           sml_d: L literals, M+3 from D back
+#   LLMMM110                    pre_d: L literals, M+3 from the last D
+#   LLMMM111 DDDDDDDD DDDDDDDD  lrg_d
+#   101LLMMM DDDDDDMM DDDDDDDD  med_d
+#   1110LLLL                    sml_l: L literals
+#   11100000 LLLLLLLL           lrg_l: L+16 literals
+#   1111MMMM                    sml_m: M from the last D
+#   11110000 MMMMMMMM           lrg_m: M+16 from the last D
+#
+# 0x06 (followed by 7 zero bytes) ends the stream, 0x0e and 0x16 do
+# nothing, and the rest of the opcodes are undefined.
+
+LZVN_EOS = 0x06
+LZVN_NOPS = (0x0e, 0x16)
+# History a match can reach
+LZVN_WINDOW = 0xffff
+# Opcode plus literals
+_LZVN_MAX = 2 + 255 + 16
+
+
+def _lzvn_undefined(op):
+    return (op < 0x40 and op & 7 == 6 and op not in (LZVN_EOS,) + LZVN_NOPS
+            or 0x70 <= op < 0x80 or 0xd0 <= op < 0xe0)
+
+
+def lzvn_chunks(buf, start, end, size, chunk_size=CHUNK_SIZE):
+    """Yield the LZVN-compressed buf[start:end], size bytes, in chunks."""
+    output = _Output("", LZVN_WINDOW, chunk_size, size)
+    distance = 0
+    pos = start
+    done = False
+    while pos < end:
+        block, limit = _block(buf, pos, end, _LZVN_MAX)
+        out = output.out
+        i = 0
+        n = len(block)
+        try:
+            while i < limit:
+                op = block[i]
+                if op >= 0xe0:
+                    if op >= 0xf0:
+                        if op == 0xf0:
+                            length = block[i + 1] + 16
+                            i += 2
+                        else:
+                            length = op & 0xf
+                            i += 1
+                        literals = 0
+                    else:
+                        if op == 0xe0:
+                            literals = block[i + 1] + 16
+                            i += 2
+                        else:
+                            literals = op & 0xf
+                            i += 1
+                        length = 0
+                elif 0xa0 <= op < 0xc0:
+                    b1 = block[i + 1]
+                    literals = (op >> 3) & 3
+                    length = ((op & 7) << 2 | (b1 & 3)) + 3
+                    distance = block[i + 2] << 6 | b1 >> 2
+                    i += 3
+                elif _lzvn_undefined(op):
+                    raise KernelCacheError("undefined LZVN opcode 0x%02x" % op)
+                else:
+                    literals = op >> 6
+                    length = ((op >> 3) & 7) + 3
+                    low = op & 7
+                    if low == 7:
+                        distance = block[i + 1] | block[i + 2] << 8
+                        i += 3
+                    elif low < 6:
+                        distance = low << 8 | block[i + 1]
+                        i += 2
+                    elif op == LZVN_EOS:
+                        done = True
+                        break
+                    elif op in LZVN_NOPS:
+                        i += 1
+                        continue
+                    else:
+                        # pre_d
+                        i += 1
+                if literals:
+                    if i + literals > n:
+                        raise KernelCacheError("truncated LZVN literals")
+                    out += block[i:i + literals]
+                    i += literals
+                if length:
+                    if not 0 < distance <= len(out):
+                        raise KernelCacheError("LZVN match distance %d out of range" % distance)
+                    _copy(out, distance, length)
+        except IndexError:
+            raise KernelCacheError("truncated LZVN opcode")
+        for chunk in output.drain():
+            yield chunk
+        if done or output.position() >= size:
+            break
+        pos += i
+    for chunk in output.finish():
+        yield chunk
+
+
+def build(data, compression="lzvn", platform="PLATFORM", fat=False):
+    """Build a compressed kernel cache holding data.
+
+    :param fat: wrap it in a universal file, as some macOS versions do
+    :rtype: str
+    """
+    if compression == "lzss":
+        compressed = compress_lzss(data)
+    else:
+        compressed = compress_lzvn(data)
+    header = struct.pack(">4s4sIII44x64s256x", COMP_MAGIC, compression,
+                         zlib.adler32(data) & 0xffffffff, len(data), len(compressed), platform)
+    cache = header + compressed
+    if fat:
+        cache = macho.build_fat([(macho.CPU_TYPE_X86_64, cache)])
+    return cache
+
+
+def build_prelinked(kexts, kernel="\xcf\xfa\xed\xfe"):
+    """Build an uncompressed prelinked kernel, for build().
+
+    :param kexts: (bundle path, executable) of each kext, in order
+    :param kernel: the kernel's own __TEXT
+    :rtype: str
+    """
+    kernel_text = ("__TEXT", "__text", kernel)
+    # The kexts' addresses depend on where __PRELINK_TEXT lands, which
+    # depends on the size of the load commands only
+    layout = macho.parse(macho.build([kernel_text, ("__PRELINK_TEXT", "__text", "".join(e for _, e in kexts)),
+                                      ("__PRELINK_INFO", "__info", "")]))
+    address = dict((s.name, s.offset) for s in layout.sections)["__PRELINK_TEXT,__text"]
+    entries = []
+    for path, executable in kexts:
+        entries.append("<dict><key>_PrelinkBundlePath</key><string>%s</string>"
+                       "<key>_PrelinkExecutableSourceAddr</key><integer size=\"64\">0x%x</integer>"
+                       "<key>_PrelinkExecutableSize</key><integer size=\"64\">0x%x</integer></dict>"
+                       % (path, address, len(executable)))
+        address += len(executable)
+    info = "<dict><key>_PrelinkInfoDictionary</key><array>%s</array></dict>\0" % "".join(entries)
+    return macho.build([kernel_text, ("__PRELINK_TEXT", "__text", "".join(e for _, e in kexts)),
+                        ("__PRELINK_INFO", "__info", info)])
+
+
+def _matches(data, max_distance, max_length):
+    """Yield (position, distance, length) of greedy matches of 3 or more
+    bytes, finding each by the last few places its first 3 bytes were."""
+    recent = {}
+    pos = 0
+    n = len(data)
+    while pos + 3 <= n:
+        key = data[pos:pos + 3]
+        best = (0, 0)
+        for candidate in reversed(recent.get(key, ())):
+            distance = pos - candidate
+            if distance > max_distance:
+                break
+            length = 3
+            while length < max_length and pos + length < n and data[candidate + length] == data[pos + length]:
+                length += 1
+            if length > best[1]:
+                best = (distance, length)
+        step = best[1] or 1
+        for p in range(pos, min(pos + step, n - 2)):
+            chain = recent.setdefault(data[p:p + 3], [])
+            chain.append(p)
+            del chain[:-8]
+        if best[1]:
+            yield pos, best[0], best[1]
+        pos += step
+
+
+def compress_lzss(data):
+    """LZSS-compress data for lzss_chunks()."""
+    N = LZSS_N
+    out = []
+    items = []
+
+    def flush():
+        flags = 0
+        for bit, item in enumerate(items):
+            if len(item) == 1:
+                flags |= 1 << bit
+        out.append(chr(flags) + "".join(items))
+        del items[:]
+
+    def add(item):
+        items.append(item)
+        if len(items) == 8:
+            flush()
+
+    pos = 0
+    for match_pos, distance, length in _matches(data, N - LZSS_F, LZSS_F):
+        for c in data[pos:match_pos]:
+            add(c)
+        ring = (N - LZSS_F + match_pos - distance) % N
+        add(chr(ring & 0xff) + chr((ring >> 4) & 0xf0 | (length - LZSS_THRESHOLD - 1)))
+        pos = match_pos + length
+    for c in data[pos:]:
+        add(c)
+    if items:
+        flush()
+    return "".join(out)
+
+
+# Longest match sml_d, pre_d and lrg_d can have with 0-3 literals
+_LZVN_LONGEST_D = (10, 8, 6, 4)
+
+
+def compress_lzvn(data):
+    """LZVN-compress data for lzvn_chunks(), using each kind of opcode."""
+    out = []
+    last_distance = [0]
+
+    def literals(s):
+        while len(s) > 3:
+            n = min(len(s) - 3, 15 + 256)
+            if n > 15:
+                out.append(chr(0xe0) + chr(n - 16))
+            else:
+                out.append(chr(0xe0 | n))
+            out.append(s[:n])
+            s = s[n:]
+        return s
+
+    def match(lits, distance, length):
+        L = len(lits)
+        # Longer ones would be other opcodes
+        longest = _LZVN_LONGEST_D[L]
+        if distance == last_distance[0] and L:
+            m = min(length, longest)
+            out.append(chr(L << 6 | (m - 3) << 3 | 6))
+        elif distance < 0x600 and length <= longest:
+            m = length
+            out.append(chr(L << 6 | (m - 3) << 3 | distance >> 8) + chr(distance & 0xff))
+        elif distance < 0x4000:
+            m = min(length, 34)
+            out.append(chr(0xa0 | L << 3 | (m - 3) >> 2) + chr((distance & 0x3f) << 2 | (m - 3) & 3)
+                       + chr(distance >> 6))
+        else:
+            m = min(length, longest)
+            out.append(chr(L << 6 | (m - 3) << 3 | 7) + chr(distance & 0xff) + chr(distance >> 8))
+        out.append(lits)
+        last_distance[0] = distance
+        length -= m
+        while length:
+            m = min(length, 15 + 256)
+            if m > 15:
+                out.append(chr(0xf0) + chr(m - 16))
+            else:
+                out.append(chr(0xf0 | m))
+            length -= m
+
+    pos = 0
+    for match_pos, distance, length in _matches(data, LZVN_WINDOW, 1024):
+        match(literals(data[pos:match_pos]), distance, length)
+        pos = match_pos + length
+    rest = literals(data[pos:])
+    if rest:
+        out.append(chr(0xe0 | len(rest)) + rest)
+    out.append(chr(LZVN_NOPS[0]) + chr(LZVN_EOS) + "\0" * 7)
+    return "".join(out)
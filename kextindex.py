@@ -0,0 +1,239 @@
+import collections
+import gzip
+import json
+import logging
+import os
+import plistlib
+import tempfile
+
+log = logging.getLogger("kextindex")
+
+
+class KextIndex:
+    """Map kext names to the paths of their bundles.
+
+    Examples:
+
+    index.identifier_kext_to_kext_path["AppleHDA.kext"] ->
+        "/System/Library/Extensions/AppleHDA.kext"
+
+    index.identifier_kext_to_kext_path["AppleHDAHardwareConfigDriver.kext"] ->
+        "/System/Library/Extensions/AppleHDA.kext/Contents/PlugIns/AppleHDAHardwareConfigDriver.kext"
+    """
+
+    def __init__(self, warn_dupes=True):
+        self.warn_dupes = warn_dupes
+        self.identifier_kext_to_kext_path = {}
+        # In case the normal kext name doesn't match, try case-insensitive
+        # comparisons via a squashed-to-lowercase table
+        self.lcase_identifier_kext_to_kext_path = {}
+
+    def add_bundle(self, basename, path):
+        warned = False
+        e = self.identifier_kext_to_kext_path.get(basename)
+        if self.warn_dupes and e and e != path:
+            log.warning("duplicate kext identifier {} {}".format(path, basename))
+            warned = True
+        self.identifier_kext_to_kext_path[basename] = path
+        lcase_basename = basename.lower()
+        lower_e = self.lcase_identifier_kext_to_kext_path.get(lcase_basename)
+        if self.warn_dupes and not warned:
+            if lower_e and lower_e != path:
+                log.warning("kext identifier differs only in case {} {} {}".format(path, e, basename))
+        self.lcase_identifier_kext_to_kext_path[lcase_basename] = path
+
+    def binary_path(self, name):
+        """Path of the main binary of a named kext.
+
+        :param name: kext name, without ".kext"
+        :raises KeyError: if the kext is not in the index
+        """
+        kext_name = name + ".kext"
+        kext_path = self.identifier_kext_to_kext_path.get(kext_name)
+        if not kext_path:
+            kext_path = self.lcase_identifier_kext_to_kext_path.get(kext_name.lower())
+            if not kext_path:
+                raise KeyError(kext_name)
+            log.error("Filename case error %s: %s", kext_name, kext_path)
+        fn = kext_path + "/Contents/MacOS/" + name
+        if not os.path.exists(fn):
+            # IOGraphicsFamily, for example
+            fn = kext_path + "/" + name
+        return fn
+
+    def read_name_translations_from(self, filename, directory_prefix):
+        """Read the cache's KextIdentifiers list to get kext pathnames
+
+        :param filename: Path of compressed KextIdentifiers.plist
+        :param directory_prefix: path prefix for kexts found here
+        """
+        with gzip.open(filename, "rb") as f:
+            plist = f.read()
+
+        d = plistlib.readPlistFromString(plist)
+
+        kextinfos = d["OSKextIdentifierCacheKextInfo"]
+
+        for kext in kextinfos:
+            path = kext["OSBundlePath"]
+            basename = os.path.basename(path)
+            path = directory_prefix + path
+            self.add_bundle(basename, path)
+
+    def walk_for_kexts(self, directory_prefix, dircache=None):
+        """Find every kext under directory_prefix, including PlugIns.
+
+        :param directory_prefix: an Extensions directory
+        :param dircache: directory listings saved from earlier runs
+        :type dircache: DirectoryCache
+        """
+        if dircache is None:
+            dircache = DirectoryCache(None)
+        for root, dirs in dircache.walk(directory_prefix):
+            for d in dirs:
+                if d.endswith(".kext"):
+                    path = root + "/" + d
+                    self.add_bundle(d, path)
+
+    def resolve(self, names, roots, max_depth=2):
+        """Index just the named kexts, looking where they are likely to be.
+
+        Each root is listed once and the wanted kexts picked out of it,
+        ignoring case. Kexts not found there are looked for in the
+        Contents/PlugIns of only those kexts whose names are prefixes of
+        a wanted name (AppleHDA.kext for AppleHDAController.kext, for
+        example), nested at most max_depth deep. If the first level of
+        PlugIns has none of them, deeper ones are not looked in.
+
+        :param names: kext names, without ".kext"
+        :type names: collections.Iterable[str]
+        :param roots: Extensions directories to search, in order
+        :type roots: list[str]
+        :return: number of directories listed
+        :rtype: int
+        """
+        wanted = set(name.lower() + ".kext" for name in names)
+        listed = [0]
+        found = set()
+
+        def probe(directory):
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                return []
+            listed[0] += 1
+            kexts = []
+            for entry in entries:
+                if not entry.endswith(".kext"):
+                    continue
+                kexts.append(directory + "/" + entry)
+                if entry.lower() in wanted:
+                    self.add_bundle(entry, directory + "/" + entry)
+                    found.add(entry.lower())
+            return kexts
+
+        parents = collections.deque()
+        for root in roots:
+            parents.extend((path, 1) for path in probe(root))
+        found_in_roots = len(found)
+
+        def likely(parent):
+            stem = os.path.basename(parent).lower().replace(".kext", "")
+            return any(name.startswith(stem) for name in wanted - found)
+
+        while parents and found != wanted:
+            parent, depth = parents.popleft()
+            if depth > 1 and len(found) == found_in_roots:
+                break
+            if not likely(parent):
+                continue
+            plugins = probe(parent + "/Contents/PlugIns")
+            if depth < max_depth:
+                parents.extend((path, depth + 1) for path in plugins)
+        for kext in sorted(wanted - found):
+            log.debug("kext %s not found", kext)
+        return listed[0]
+
+
+class DirectoryCache:
+    """Directory listings, saved between runs and keyed by directory mtime.
+
+    A directory's mtime changes when entries are added to or removed from
+    it, so a directory whose mtime is unchanged has the same subdirectories
+    as last time and need not be listed again. Only the directories whose
+    mtimes moved are re-read.
+
+    The file holds a JSON dict of directory path to [mtime, subdirectories,
+    subdirectories to descend into].
+    """
+
+    version = 1
+
+    def __init__(self, filename, rebuild=False):
+        self.filename = filename
+        self.dirs = {}
+        self.listed = 0
+        self.reused = 0
+        self.dirty = False
+        if filename and not rebuild:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                d = json.load(f)
+        except (IOError, ValueError):
+            return
+        if d.get("version") == self.version:
+            self.dirs = d["dirs"]
+
+    def save(self):
+        if not (self.filename and self.dirty):
+            return
+        # A temporary file of our own, in case another process is saving too
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)),
+                                   prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                json.dump({"version": self.version, "dirs": self.dirs}, f)
+            os.rename(tmp, self.filename)
+        except:
+            os.unlink(tmp)
+            raise
+        self.dirty = False
+
+    def listing(self, path):
+        """Return (subdirectories, subdirectories to descend into) of path."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], []
+        entry = self.dirs.get(path)
+        if entry and entry[0] == mtime:
+            self.reused += 1
+            return entry[1], entry[2]
+        self.listed += 1
+        dirs = []
+        descend = []
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        for name in names:
+            sub = os.path.join(path, name)
+            if os.path.isdir(sub):
+                dirs.append(name)
+                # os.walk does not follow symlinks by default
+                if not os.path.islink(sub):
+                    descend.append(name)
+        self.dirs[path] = [mtime, dirs, descend]
+        self.dirty = True
+        return dirs, descend
+
+    def walk(self, top):
+        """Like os.walk(top), but yield only (root, dirs)."""
+        dirs, descend = self.listing(top)
+        yield top, dirs
+        for name in descend:
+            for x in self.walk(os.path.join(top, name)):
+                yield x
@@ -0,0 +1,43 @@
+import logging
+
+# Log output for the tools: on a terminal, WARNING and higher level names
+# are shown in red.
+#
+# This is a Formatter on the handler the tools install, not a change to
+# logging.StreamHandler, so running a tool inside another program leaves
+# that program's logging alone.
+
+emphasis_on = "\x1b[31m"
+emphasis_off = "\x1b[0m\x00"
+
+
+class EmphasisFormatter(logging.Formatter):
+    """Formatter that colors the level names of warnings and errors."""
+
+    def format(self, record):
+        levelname = record.levelname
+        if record.levelno > logging.INFO:
+            record.levelname = emphasis_on + levelname + emphasis_off
+        else:
+            record.levelname = emphasis_off + levelname + emphasis_off
+        try:
+            return logging.Formatter.format(self, record)
+        finally:
+            record.levelname = levelname
+
+
+def basic_config(format):
+    """logging.basicConfig(format=format), emphasizing on a terminal.
+
+    Like basicConfig, does nothing if the root logger has handlers
+    already, so a program that runs a tool in-process keeps its own.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    if handler.stream.isatty():
+        handler.setFormatter(EmphasisFormatter(format))
+    else:
+        handler.setFormatter(logging.Formatter(format))
+    root.addHandler(handler)
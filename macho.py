@@ -0,0 +1,249 @@
+import struct
+
+# Just enough Mach-O to find where a kext's x86_64 code and data are.
+#
+# A kext binary may be universal (fat), with slices for other
+# architectures; Clover only ever loads and patches the x86_64 one. Within
+# that slice, patches are meant for code or data sections, not the symbol
+# table or __LINKEDIT. parse() finds the x86_64 image and its sections so
+# the checkers can limit matching to them.
+#
+# build() and build_fat() write minimal binaries for trying this out
+# without a Mac.
+
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+MH_MAGIC_64 = 0xfeedfacf
+CPU_TYPE_X86_64 = 0x01000007
+LC_SEGMENT_64 = 0x19
+
+# Section types with no bytes in the file
+_ZEROFILL_TYPES = (0x1, 0xc, 0x12)
+
+
+class MachOError(ValueError):
+    pass
+
+
+class Section:
+    def __init__(self, segname, sectname, offset, size):
+        self.segname = segname
+        self.sectname = sectname
+        # From the start of the file, not the slice
+        self.offset = offset
+        self.size = size
+
+    @property
+    def name(self):
+        return "%s,%s" % (self.segname, self.sectname)
+
+    def __repr__(self):
+        return "<Section %s 0x%x+0x%x>" % (self.name, self.offset, self.size)
+
+
+class MachO:
+    """The x86_64 image in a (possibly universal) Mach-O file."""
+
+    def __init__(self, slice_offset, slice_size, segments, sections, mappings=()):
+        self.slice_offset = slice_offset
+        self.slice_size = slice_size
+        # (name, file offset, file size) of each segment
+        self.segments = segments
+        self.sections = sections
+        # (address, file offset, file size) of each segment
+        self.mappings = list(mappings)
+
+    def ranges(self, names=None):
+        """File offset ranges to search.
+
+        :param names: "SEGMENT" or "SEGMENT,section" names, such as
+                      "__TEXT,__text" or "__DATA"; None for the whole slice
+        :type names: list[str] | None
+        :return: sorted, non-overlapping [start, end) ranges
+        :rtype: list[(int, int)]
+        """
+        if names is None:
+            return [(self.slice_offset, self.slice_offset + self.slice_size)]
+        ranges = []
+        for name in names:
+            if "," in name:
+                ranges.extend((s.offset, s.offset + s.size) for s in self.sections if s.name == name)
+            else:
+                ranges.extend((off, off + size) for segname, off, size in self.segments
+                              if segname == name)
+        merged = []
+        for start, end in sorted(r for r in ranges if r[0] < r[1]):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def file_offset(self, address):
+        """File offset of a virtual address, or None if no segment's file
+        contents hold it."""
+        for vmaddr, offset, size in self.mappings:
+            if vmaddr <= address < vmaddr + size:
+                return offset + address - vmaddr
+        return None
+
+    def section_at(self, offset):
+        """Name of the section holding a file offset, or None."""
+        for s in self.sections:
+            if s.offset <= offset < s.offset + s.size:
+                return s.name
+        for segname, off, size in self.segments:
+            if off <= offset < off + size:
+                return segname
+        return None
+
+
+def _cstring(b):
+    return b.split("\0", 1)[0]
+
+
+def x86_64_slice(buf):
+    """Find the x86_64 slice of a universal file.
+
+    :return: (offset, size) of the slice, or None if buf is not universal
+    :rtype: (int, int) | None
+    :raises MachOError: if it is, but has no x86_64 slice or is truncated
+    """
+    if len(buf) < 8:
+        return None
+    magic, nfat = struct.unpack(">II", bytes(buf[0:8]))
+    # Java class files start with 0xcafebabe too, followed by a
+    # version number much larger than any architecture count
+    if magic not in (FAT_MAGIC, FAT_MAGIC_64) or nfat > 32:
+        return None
+    if magic == FAT_MAGIC:
+        fmt, entry = ">iiIII", 20
+    else:
+        fmt, entry = ">iiQQII", 32
+    for i in range(nfat):
+        raw = bytes(buf[8 + i * entry:8 + (i + 1) * entry])
+        if len(raw) < entry:
+            raise MachOError("truncated universal header")
+        arch = struct.unpack(fmt, raw)
+        if arch[0] == CPU_TYPE_X86_64:
+            if arch[2] + arch[3] > len(buf):
+                raise MachOError("x86_64 slice runs past the end of the file")
+            return arch[2], arch[3]
+    raise MachOError("no x86_64 slice")
+
+
+def parse(buf):
+    """Find the x86_64 image in buf.
+
+    :param buf: the file contents
+    :type buf: str | bytearray | mappedfile.MappedFile
+    :return: None if buf is not a Mach-O or universal file
+    :rtype: MachO | None
+    :raises MachOError: if it is one, but has no x86_64 image or is truncated
+    """
+    size = len(buf)
+    if size < 8:
+        return None
+    fat_slice = x86_64_slice(buf)
+    if fat_slice is not None:
+        return _parse_image(buf, fat_slice[0], fat_slice[1])
+    magic, = struct.unpack("<I", bytes(buf[0:4]))
+    if magic == MH_MAGIC_64:
+        return _parse_image(buf, 0, size)
+    return None
+
+
+def _parse_image(buf, base, size):
+    header = bytes(buf[base:base + 32])
+    if len(header) < 32:
+        raise MachOError("truncated Mach-O header")
+    magic, cputype, _, _, ncmds, sizeofcmds, _, _ = struct.unpack("<IiiIIIII", header)
+    if magic != MH_MAGIC_64:
+        raise MachOError("bad Mach-O magic 0x%08x at 0x%x" % (magic, base))
+    if cputype != CPU_TYPE_X86_64:
+        raise MachOError("not an x86_64 image")
+    commands = bytes(buf[base + 32:base + 32 + sizeofcmds])
+    if len(commands) < sizeofcmds:
+        raise MachOError("truncated load commands")
+    segments = []
+    sections = []
+    mappings = []
+    pos = 0
+    for _ in range(ncmds):
+        if pos + 8 > len(commands):
+            raise MachOError("truncated load command")
+        cmd, cmdsize = struct.unpack("<II", commands[pos:pos + 8])
+        if cmdsize < 8 or pos + cmdsize > len(commands):
+            raise MachOError("bad load command size")
+        if cmd == LC_SEGMENT_64:
+            if cmdsize < 72:
+                raise MachOError("bad segment command size")
+            segname, vmaddr, _, fileoff, filesize, _, _, nsects, _ = struct.unpack(
+                "<16sQQQQiiII", commands[pos + 8:pos + 72])
+            segname = _cstring(segname)
+            if filesize:
+                segments.append((segname, base + fileoff, filesize))
+                mappings.append((vmaddr, base + fileoff, filesize))
+            for i in range(nsects):
+                s = pos + 72 + i * 80
+                if s + 80 > pos + cmdsize:
+                    raise MachOError("truncated section")
+                sectname, sect_segname, _, sect_size, offset, _, _, _, flags, _, _, _ = struct.unpack(
+                    "<16s16sQQIIIIIIII", commands[s:s + 80])
+                if flags & 0xff in _ZEROFILL_TYPES or not sect_size:
+                    continue
+                sections.append(Section(_cstring(sect_segname), _cstring(sectname),
+                                        base + offset, sect_size))
+        pos += cmdsize
+    return MachO(base, size, segments, sections, mappings)
+
+
+def build(sections, cputype=CPU_TYPE_X86_64):
+    """Build a thin 64-bit Mach-O image.
+
+    Each segment's address is its file offset.
+
+    :param sections: (segment name, section name, contents) in file order;
+                     consecutive sections with the same segment name share
+                     a segment
+    :rtype: str
+    """
+    segments = []
+    for segname, sectname, contents in sections:
+        if not segments or segments[-1][0] != segname:
+            segments.append((segname, []))
+        segments[-1][1].append((sectname, contents))
+    sizeofcmds = sum(72 + 80 * len(s[1]) for s in segments)
+    offset = 32 + sizeofcmds
+    commands = []
+    data = []
+    for segname, sects in segments:
+        fileoff = offset
+        headers = []
+        for sectname, contents in sects:
+            headers.append(struct.pack("<16s16sQQIIIIIIII", sectname, segname, offset,
+                                       len(contents), offset, 0, 0, 0, 0, 0, 0, 0))
+            data.append(contents)
+            offset += len(contents)
+        commands.append(struct.pack("<II16sQQQQiiII", LC_SEGMENT_64, 72 + 80 * len(sects),
+                                    segname, fileoff, offset - fileoff, fileoff,
+                                    offset - fileoff, 7, 5, len(sects), 0))
+        commands.extend(headers)
+    header = struct.pack("<IiiIIIII", MH_MAGIC_64, cputype, 3, 0xb,
+                         len(segments), sizeofcmds, 0, 0)
+    return header + "".join(commands) + "".join(data)
+
+
+def build_fat(slices, align=12):
+    """Build a universal file from (cputype, image) pairs."""
+    out = struct.pack(">II", FAT_MAGIC, len(slices))
+    offset = 8 + 20 * len(slices)
+    images = []
+    for cputype, image in slices:
+        offset = (offset + (1 << align) - 1) & ~((1 << align) - 1)
+        out += struct.pack(">iiIII", cputype, 3, offset, len(image), align)
+        images.append((offset, image))
+        offset += len(image)
+    for offset, image in images:
+        out += "\0" * (offset - len(out)) + image
+    return out
@@ -1,16 +1,19 @@
 #!/usr/bin/python2.7
 import sys
+import json
 import plistlib
 import argparse
-import plistmonkey
-
-from io import BytesIO
+import tempfile
+import shutil
+import plistwriter
 
 def parsestr(s):
+    """Decode the backslash escapes of a Python string literal's body.
+
+    :raises ValueError: on a malformed escape
+    """
     assert isinstance(s, str)
-    s = s.replace("'", "\\'")
-    s = "b'" + s + "'"
-    return eval(s)
+    return s.decode("string_escape")
 
 def parsehex(s):
     assert isinstance(s, str)
@@ -19,7 +22,19 @@ def parsehex(s):
 
 parser = argparse.ArgumentParser(
     description="Print plist binary patch stanzas",
-    epilog="example: makebinpatch.py 'ABC\\x00' '\\x80EF\\xFF' 'Change ABC to EF'")
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    epilog="""example: makebinpatch.py 'ABC\\x00' '\\x80EF\\xFF' 'Change ABC to EF'
+
+With --batch, patches are read one per line from a file (- for stdin)
+instead of the command line, either tab-separated
+
+    find<TAB>replace[<TAB>comment[<TAB>file]]
+
+or as JSON objects with "find", "replace", "comment" and "file" keys.
+The first record decides which, unless --batch-format says. Blank lines
+and lines starting with # are skipped. Records with a file are kext
+patches; --file gives the file for records without one. --whole writes a
+plist whose root is the array of patches.""")
 
 parser.add_argument("--hex", "-x",
                     help="Interpret arguments as hex rather than Python string syntax",
@@ -38,41 +53,199 @@ group.add_argument("--clover",
 parser.add_argument("-s", "--short-data",
                     help="Use single-line <data> when possible",
                     action="store_true")
-parser.add_argument("find", help="Python syntax string to find")
-parser.add_argument("replace", help="Python syntax string to replace")
+parser.add_argument("--batch", "-b", metavar="FILE",
+                    help="Read find/replace/comment/file records from FILE",
+                    type=argparse.FileType("r"))
+parser.add_argument("--batch-format", choices=["tsv", "json"],
+                    help="Format of the --batch records (default: JSON if the first one starts with {)")
+parser.add_argument("find", help="Python syntax string to find", nargs='?')
+parser.add_argument("replace", help="Python syntax string to replace", nargs='?')
 parser.add_argument("comment", help="Comment for patch", nargs='?' )
 
-args = parser.parse_args()
-plistmonkey.rehabManHouseStyle = args.short_data
+# Set by main()
+args = None
+
+
+def parse_record(line, is_json):
+    """Split a batch line into [find, replace, comment, file]."""
+    if is_json:
+        r = json.loads(line)
+        if not isinstance(r, dict):
+            raise ValueError("not a JSON object")
+        fields = [r.get(k) for k in ("find", "replace", "comment", "file")]
+        fields = [v.encode("utf-8") if isinstance(v, unicode) else v for v in fields]
+    else:
+        fields = line.split("\t")
+        if len(fields) > 4:
+            raise ValueError("too many fields")
+        fields += [None] * (4 - len(fields))
+    for name, v in zip(("find", "replace", "comment", "file"), fields):
+        if v is None and name in ("find", "replace"):
+            raise ValueError("find and replace are required")
+        if v is not None and not isinstance(v, str):
+            raise ValueError("%s must be a string, not %s" % (name, type(v).__name__))
+    return fields[:2] + [v or None for v in fields[2:]]
+
+
+class BatchWriter:
+    """Write patch stanzas as they come, in the shape makebinpatch prints one.
+
+    With --clover, ACPI patches are written out as they arrive; kext
+    patches belong after them, so they are spooled to a temporary file
+    until the end.
+    """
+
+    def __init__(self, out, clover, whole, short_data):
+        self.out = out
+        self.clover = clover
+        self.whole = whole
+        self.short_data = short_data
+        self.acpi_started = False
+        self.kexts = None
+
+    def _write(self, f, value, level):
+        f.write(plistwriter.writeValueToString(value, indentLevel=level,
+                                               rehabManHouseStyle=self.short_data))
+
+    def _lines(self, f, lines):
+        w = plistwriter.PlistWriter()
+        for line, level in lines:
+            w.writeln(line, level)
+        f.write(w.getvalue())
+
+    def start(self):
+        if self.clover or self.whole:
+            self.out.write(plistwriter.PLISTHEADER)
+            self._lines(self.out, [("<plist version=\"1.0\">", 0)])
+        if self.clover:
+            self._lines(self.out, [("<dict>", 0)])
+        elif self.whole:
+            self._lines(self.out, [("<array>", 0)])
+
+    def add(self, d):
+        if not self.clover:
+            self._write(self.out, d, 1 if self.whole else 4)
+        elif "Name" in d:
+            if self.kexts is None:
+                self.kexts = tempfile.TemporaryFile()
+            self._write(self.kexts, d, 3)
+        else:
+            if not self.acpi_started:
+                self._lines(self.out, [("<key>ACPI</key>", 1), ("<dict>", 1),
+                                       ("<key>DSDT</key>", 2), ("<dict>", 2),
+                                       ("<key>Patches</key>", 3), ("<array>", 3)])
+                self.acpi_started = True
+            self._write(self.out, d, 4)
 
-if args.hex:
-    find = parsehex(args.find)
-    replace = parsehex(args.replace)
-else:
-    find = parsestr(args.find)
-    replace = parsestr(args.replace)
+    def finish(self):
+        if self.clover:
+            if self.acpi_started:
+                self._lines(self.out, [("</array>", 3), ("</dict>", 2), ("</dict>", 1)])
+            if self.kexts is not None:
+                self._lines(self.out, [("<key>KernelAndKextPatches</key>", 1), ("<dict>", 1),
+                                       ("<key>KextsToPatch</key>", 2), ("<array>", 2)])
+                self.kexts.seek(0)
+                shutil.copyfileobj(self.kexts, self.out)
+                self.kexts.close()
+                self._lines(self.out, [("</array>", 2), ("</dict>", 1)])
+            self._lines(self.out, [("</dict>", 0)])
+        elif self.whole:
+            self._lines(self.out, [("</array>", 0)])
+        if self.clover or self.whole:
+            self._lines(self.out, [("</plist>", 0)])
 
-d = dict(Find=plistlib.Data(find), Replace=plistlib.Data(replace)) # , Disabled=False)
-if args.comment:
-    d["Comment"] = args.comment
 
-if args.file:
-    d["Name"] = args.file
+def batch(f):
+    parse = parsehex if args.hex else parsestr
+    writer = BatchWriter(sys.stdout, args.clover, args.whole, args.short_data)
+    writer.start()
+    seen = set()
+    errors = 0
+    is_json = None if args.batch_format is None else args.batch_format == "json"
+
+    def complain(lineno, message):
+        sys.stderr.write("%s:%d: %s\n" % (f.name, lineno, message))
+
+    for lineno, line in enumerate(f, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.startswith("#"):
+            continue
+        if is_json is None:
+            is_json = line.lstrip().startswith("{")
+        try:
+            find, replace, comment, filename = parse_record(line, is_json)
+            find = parse(find)
+            replace = parse(replace)
+        except ValueError as e:
+            complain(lineno, "can't parse: %s" % e)
+            errors += 1
+            continue
+        if not find:
+            complain(lineno, "empty find")
+            errors += 1
+            continue
+        filename = filename or args.file
+        if len(find) != len(replace):
+            complain(lineno, "Warning: find and replace lengths do not match")
+        if (filename, find) in seen:
+            complain(lineno, "Warning: duplicate find %r" % find)
+        seen.add((filename, find))
+
+        d = dict(Find=plistlib.Data(find), Replace=plistlib.Data(replace))
+        if comment:
+            d["Comment"] = comment
+        if filename:
+            d["Name"] = filename
+        writer.add(d)
+
+    writer.finish()
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    global args
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        if args.find is not None:
+            parser.error("find and replace are read from the --batch file")
+        return batch(args.batch)
+    if args.batch_format:
+        parser.error("--batch-format is for --batch")
+
+    if args.find is None or args.replace is None:
+        parser.error("find and replace are required")
+
+    parse = parsehex if args.hex else parsestr
+    try:
+        find = parse(args.find)
+        replace = parse(args.replace)
+    except ValueError as e:
+        parser.error("can't parse: %s" % e)
+
+    d = dict(Find=plistlib.Data(find), Replace=plistlib.Data(replace)) # , Disabled=False)
+    if args.comment:
+        d["Comment"] = args.comment
 
-if args.clover:
     if args.file:
-        d = dict(KernelAndKextPatches=dict(KextsToPatch=[d]))
+        d["Name"] = args.file
+
+    if args.clover:
+        if args.file:
+            d = dict(KernelAndKextPatches=dict(KextsToPatch=[d]))
+        else:
+            d = dict(ACPI=dict(DSDT=dict(Patches=[d])))
+
+    if args.whole or args.clover:
+        plistwriter.writePlist(d, sys.stdout, rehabManHouseStyle=args.short_data)
     else:
-        d = dict(ACPI=dict(DSDT=dict(Patches=[d])))
-
-if args.whole or args.clover:
-    plistlib.writePlist(d, sys.stdout)
-else:
-    f = BytesIO()
-    # We don't want the stuff at the top of a full plist
-    plw = plistlib.PlistWriter(f, writeHeader=False, indentLevel=4)
-    plw.writeValue(d)
-    sys.stdout.write(f.getvalue())
-
-if len(find) != len(replace):
-    print ("Warning: find and replace lengths do not match")
+        # We don't want the stuff at the top of a full plist
+        sys.stdout.write(plistwriter.writeValueToString(d, indentLevel=4,
+                                                        rehabManHouseStyle=args.short_data))
+
+    if len(find) != len(replace):
+        print ("Warning: find and replace lengths do not match")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
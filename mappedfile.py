@@ -0,0 +1,223 @@
+import bisect
+import copy
+import mmap
+
+# A binary file opened read-only with mmap, plus a sparse overlay of edits.
+#
+# Kext binaries are big and patches touch a few bytes of them. Rather
+# than read each binary into a string and copy it for every patch, map
+# it and keep only the patched regions in memory. The object supports
+# the small part of the bytearray interface that patch.Patch and
+# patch.PatchSet use: len(), slicing, slice assignment of the same
+# length, and find().
+#
+# view() gives another MappedFile on the same mapping with its own
+# edits, so one mapped binary can be patched by several users at once.
+#
+# Patches that match thousands of times leave thousands of small edits,
+# and searching through the overlay then costs more than a copy of the
+# file would. Past max_edits, the file is copied into a bytearray and
+# edited there.
+
+
+class MappedFile:
+    """A file mapped read-only, edited through an overlay.
+
+    Edits are kept as sorted, merged ranges in the overlay. Once there
+    are more than max_edits of them, the whole file is copied into a
+    bytearray and edited there instead, so from then on it takes as
+    much memory as the file's size (see edit_size()). Views made with
+    view() keep the limit.
+    """
+
+    def __init__(self, filename, max_edits=256):
+        """
+        :param filename: the file to map
+        :param max_edits: separate edited ranges to keep in the overlay
+                          before copying the file; None for no limit
+        :type max_edits: int | None
+        """
+        self.filename = filename
+        self.max_edits = max_edits
+        with open(filename, "rb") as f:
+            try:
+                self.base = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Can't map an empty file
+                self.base = ""
+        self.size = len(self.base)
+        # Views don't unmap the file when closed
+        self.owner = True
+        # Non-overlapping, non-adjacent edits, sorted by offset
+        self.edit_starts = []
+        self.edit_ends = []
+        self.edit_data = []
+        # The whole file as edited, once there are too many edits
+        self.flat = None
+        # Until the next edit: find length to the merged windows around
+        # the edits, and string to its matches in them
+        self.windows = {}
+        self.window_matches = {}
+
+    def close(self):
+        if self.owner and isinstance(self.base, mmap.mmap):
+            self.base.close()
+        self.base = ""
+        self.revert()
+
+    def view(self):
+        """Another MappedFile sharing this one's mapping, with no edits.
+
+        The mapping stays open until this object is closed, or until it
+        and every view are garbage.
+        """
+        v = copy.copy(self)
+        v.owner = False
+        v.revert()
+        return v
+
+    def revert(self):
+        """Drop all edits."""
+        self.edit_starts = []
+        self.edit_ends = []
+        self.edit_data = []
+        self.flat = None
+        self.windows = {}
+        self.window_matches = {}
+
+    def edit_size(self):
+        """Number of bytes held in the overlay."""
+        if self.flat is not None:
+            return len(self.flat)
+        return sum(map(len, self.edit_data))
+
+    def __len__(self):
+        return self.size
+
+    def _slice(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("MappedFile only supports slices")
+        start, end, step = index.indices(self.size)
+        assert step == 1
+        return start, max(start, end)
+
+    def __getitem__(self, index):
+        start, end = self._slice(index)
+        if self.flat is not None:
+            return bytes(self.flat[start:end])
+        out = bytearray(self.base[start:end])
+        i = bisect.bisect_right(self.edit_ends, start)
+        while i < len(self.edit_starts) and self.edit_starts[i] < end:
+            s = self.edit_starts[i]
+            lo = max(s, start)
+            hi = min(self.edit_ends[i], end)
+            out[lo - start:hi - start] = self.edit_data[i][lo - s:hi - s]
+            i += 1
+        return bytes(out)
+
+    def __setitem__(self, index, data):
+        start, end = self._slice(index)
+        if len(data) != end - start:
+            raise ValueError("MappedFile edits must not change the file length")
+        if self.flat is not None:
+            self.flat[start:end] = data
+            return
+        self.windows = {}
+        self.window_matches = {}
+        i = bisect.bisect_left(self.edit_ends, start)
+        j = bisect.bisect_right(self.edit_starts, end)
+        if i < j:
+            # Merge with the edits we overlap or touch
+            merged_start = min(start, self.edit_starts[i])
+            merged_end = max(end, self.edit_ends[j - 1])
+            merged = bytearray(self[merged_start:merged_end])
+            merged[start - merged_start:end - merged_start] = data
+            start, end = merged_start, merged_end
+        else:
+            merged = bytearray(data)
+        self.edit_starts[i:j] = [start]
+        self.edit_ends[i:j] = [end]
+        self.edit_data[i:j] = [merged]
+        if self.max_edits is not None and len(self.edit_starts) > self.max_edits:
+            self.flat = bytearray(self[0:self.size])
+            self.edit_starts = []
+            self.edit_ends = []
+            self.edit_data = []
+
+    def _overlaps_edit(self, start, end):
+        i = bisect.bisect_right(self.edit_ends, start)
+        return i < len(self.edit_starts) and self.edit_starts[i] < end
+
+    def _windows(self, n):
+        """The bytes within n - 1 of an edit, as merged windows.
+
+        Any match of n bytes that touches an edit lies in one of them.
+
+        :return: window starts, ends and contents
+        :rtype: (list[int], list[int], list[str])
+        """
+        w = self.windows.get(n)
+        if w is None:
+            starts = []
+            ends = []
+            for s, e in zip(self.edit_starts, self.edit_ends):
+                ws = max(0, s - n + 1)
+                we = min(self.size, e + n - 1)
+                if ends and ws <= ends[-1]:
+                    ends[-1] = max(ends[-1], we)
+                else:
+                    starts.append(ws)
+                    ends.append(we)
+            w = self.windows[n] = (starts, ends, [self[ws:we] for ws, we in zip(starts, ends)])
+        return w
+
+    def _window_matches(self, sub):
+        """Sorted offsets of every match of sub that touches an edit."""
+        matches = self.window_matches.get(sub)
+        if matches is None:
+            n = len(sub)
+            matches = []
+            for ws, we, data in zip(*self._windows(n)):
+                k = data.find(sub)
+                while k >= 0:
+                    if self._overlaps_edit(ws + k, ws + k + n):
+                        matches.append(ws + k)
+                    k = data.find(sub, k + 1)
+            self.window_matches[sub] = matches
+        return matches
+
+    def find(self, sub, start=0, end=None):
+        """Like str.find, on the file as edited."""
+        if end is None or end > self.size:
+            end = self.size
+        if self.flat is not None:
+            return self.flat.find(sub, start, end)
+        if not self.edit_starts:
+            return self.base.find(sub, start, end)
+        n = len(sub)
+
+        # The first match touching an edit
+        first = -1
+        matches = self._window_matches(sub)
+        i = bisect.bisect_left(matches, start)
+        if i < len(matches) and matches[i] + n <= end:
+            first = matches[i]
+
+        # Matches in the unedited bytes before that
+        limit = end if first < 0 else min(end, first + n - 1)
+        pos = start
+        while True:
+            k = self.base.find(sub, pos, limit)
+            if k < 0:
+                return first
+            if not self._overlaps_edit(k, k + n):
+                return k
+            pos = k + 1
+
+    def write_to(self, f, chunk_size=1024 * 1024):
+        """Write the edited file to f without materializing all of it."""
+        if self.flat is not None:
+            f.write(self.flat)
+            return
+        for off in range(0, self.size, chunk_size):
+            f.write(self[off:off + chunk_size])
@@ -1,8 +1,17 @@
+import bisect
+import collections
 import logging
+import re
+import time
 
 log = logging.getLogger("patch")
 
 class Patch:
+    # Scanning a bytearray, split the rest of it on Find once this many
+    # matches have come at least one per this many bytes
+    split_after = 64
+    split_bytes_per_match = 1024
+
     def __init__(self, p):
         assert isinstance(p, dict)
         self.dict = p
@@ -14,6 +23,11 @@ class Patch:
         except KeyError:
             log.error("malformed patch %r", p)
             raise KeyError("malformed patch")
+        # MaskFind: only the bits set in it must match Find.
+        # MaskReplace: only the bits set in it are taken from Replace.
+        # None when absent, or when every bit is set, as that is the same.
+        self.mask_find = self._mask(p, "MaskFind")
+        self.mask_replace = self._mask(p, "MaskReplace")
         self.comment = p.get("Comment")
         if self.comment is not None:
             assert isinstance(self.comment, str)
@@ -28,7 +42,28 @@ class Patch:
             self.has_expected = True
         self.applied_count = 0
         self.applied_file_count = 0
+        self.applied_offsets = []
         self.check()
+        self.masked_find = None
+        if self.mask_find is not None:
+            self.masked_find = _MaskedFind(self.find, self.mask_find)
+        n = len(self.find)
+        # If two matches can overlap, as "aa" does in "aaa"
+        self.overlaps_itself = any(self.find[i:] == self.find[:n - i] for i in range(1, n))
+        # PatchSet searches once for patches with the same search_key
+        self.search_key = self.find
+        if self.mask_find is not None:
+            self.search_key = (self.find, self.mask_find)
+
+    @staticmethod
+    def _mask(p, key):
+        mask = p.get(key)
+        if mask is None:
+            return None
+        mask = mask.data
+        if mask == "\xff" * len(mask):
+            return None
+        return mask
 
     def check(self):
         if self.comment is None:
@@ -37,19 +72,176 @@ class Patch:
             log.error("Patch find/replace lengths do not match in %r", self)
             log.error("This program is almost certainly broken for that case")
             raise ValueError
+        for mask in (self.mask_find, self.mask_replace):
+            if mask is not None and len(mask) != len(self.find):
+                log.error("Patch mask and find lengths do not match in %r", self)
+                raise ValueError
+
+    def changes_nothing(self):
+        """True if applying this patch never changes a byte."""
+        return (self.find == self.replace and self.mask_find is None
+                and self.mask_replace is None)
 
     def count(self, s):
         # if self.disabled:
         #     return 0
+        if self.masked_find:
+            return len(self.find_offsets(s))
         return s.count(self.find)
 
     def apply(self, s):
         # if self.disabled:
         #     return s
+        if self.masked_find or self.mask_replace is not None:
+            buf = bytearray(s)
+            self.count_and_apply(buf)
+            return str(buf)
         rv = s.replace(self.find, self.replace)
         assert len(rv) == len(s)
         return rv
 
+    def replace_at(self, buf, offsets):
+        """Overwrite each match in buf with Replace, under MaskReplace."""
+        n = len(self.find)
+        if self.mask_replace is None:
+            for off in offsets:
+                buf[off:off + n] = self.replace
+            return
+        keep = bytearray(~m & 0xff for m in bytearray(self.mask_replace))
+        put = bytearray(r & m for r, m in zip(bytearray(self.replace), bytearray(self.mask_replace)))
+        for off in offsets:
+            old = bytearray(buf[off:off + n])
+            buf[off:off + n] = bytes(bytearray(o & k | r for o, k, r in zip(old, keep, put)))
+
+    def count_and_apply(self, buf, replace=True):
+        """Count and apply this patch with a single scan of buf.
+
+        Matches are found the way str.count and str.replace find them, then
+        overwritten in place.
+
+        :param buf: the target contents
+        :type buf: bytearray | mappedfile.MappedFile
+        :param replace: if False, only count
+        :return: the match count and the offset of each match
+        :rtype: (int, list[int])
+        """
+        replace = replace and not self.changes_nothing()
+        if self.masked_find is None and self.mask_replace is None and isinstance(buf, bytearray):
+            offsets = self._scan(buf, replace)
+        else:
+            offsets = self.find_offsets(buf)
+            if replace:
+                self.replace_at(buf, offsets)
+        return len(offsets), offsets
+
+    def find_all(self, buf, start=0, end=None):
+        """Offsets of all matches in buf[start:end], including overlaps."""
+        if self.masked_find:
+            return self.masked_find.find_all(buf, start, end)
+        if not self.overlaps_itself and start == 0 and end is None and isinstance(buf, bytearray):
+            # No two matches can overlap
+            return self._scan(buf, False)
+        return _find_all(buf, self.find, start, end)
+
+    def find_offsets(self, buf):
+        """Offsets of non-overlapping matches, as str.count would find them."""
+        n = len(self.find)
+        if self.masked_find:
+            return first_fit(self.masked_find.find_all(buf), n)
+        if isinstance(buf, bytearray):
+            return self._scan(buf, False)
+        offsets = []
+        i = buf.find(self.find)
+        while i >= 0:
+            offsets.append(i)
+            i = buf.find(self.find, i + n)
+        return offsets
+
+    def _scan(self, buf, replace):
+        """find_offsets() of a bytearray without masks, replacing them too
+        if replace is true.
+
+        Where Find turns out to be common, the rest of buf is split on it
+        (and joined again with Replace), which costs a copy of the rest
+        but no Python call per match.
+        """
+        n = len(self.find)
+        offsets = []
+        i = buf.find(self.find)
+        while i >= 0:
+            offsets.append(i)
+            if len(offsets) == self.split_after and i < self.split_after * self.split_bytes_per_match:
+                if replace:
+                    self.replace_at(buf, offsets)
+                pieces = str(buf[i + n:]).split(self.find)
+                if replace:
+                    buf[i + n:] = self.replace.join(pieces)
+                add = offsets.append
+                for length in map(len, pieces[:-1]):
+                    i += n + length
+                    add(i)
+                return offsets
+            i = buf.find(self.find, i + n)
+        if replace:
+            self.replace_at(buf, offsets)
+        return offsets
+
+    def differences(self, buf, offset):
+        """Where buf at offset differs from Find, under MaskFind if any.
+
+        :return: (index into Find, Find's byte, buf's byte) of each
+                 difference
+        :rtype: list[(int, int, int)]
+        """
+        here = bytearray(buf[offset:offset + len(self.find)])
+        find = bytearray(self.find)
+        if self.mask_find is None:
+            return [(i, f, b) for i, (f, b) in enumerate(zip(find, here)) if f != b]
+        return [(i, f, b) for i, (f, b, m) in enumerate(zip(find, here, bytearray(self.mask_find)))
+                if (f ^ b) & m]
+
+    def find_near(self, buf, k, limit=None):
+        """The places in buf that differ from Find in at most k bytes.
+
+        If a place differs in at most k bytes, then of Find split into k + 1
+        pieces, at least one occurs there exactly. So only where a piece
+        is found is the whole of Find compared. If Find has no more than k
+        bytes to compare, every place would do, and there are none.
+
+        :return: (offset, differences()) of each place, fewest differences
+                 first, then by offset
+        :rtype: list[(int, list[(int, int, int)])]
+        """
+        n = len(self.find)
+        size = len(buf)
+        if size < n:
+            return []
+        mask = self.mask_find or "\xff" * n
+        # Only bytes MaskFind compares can differ, so each piece must hold
+        # some of them
+        compared = [i for i in range(n) if mask[i] != "\0"]
+        if len(compared) <= k:
+            return []
+        candidates = set()
+        for j in range(k + 1):
+            first = compared[j * len(compared) // (k + 1)]
+            last = compared[(j + 1) * len(compared) // (k + 1) - 1] + 1
+            piece = self.find[first:last]
+            end = size - (n - last)
+            if self.mask_find is None:
+                found = _find_all(buf, piece, first, end)
+            else:
+                found = _MaskedFind(piece, mask[first:last]).find_all(buf, first, end)
+            # A piece found near either end may have no room for Find
+            candidates.update(off - first for off in found if first <= off <= size - n + first)
+        near = []
+        for offset in sorted(candidates):
+            diffs = self.differences(buf, offset)
+            if len(diffs) <= k:
+                near.append((len(diffs), offset, diffs))
+        near.sort()
+        return [(offset, diffs) for _, offset, diffs in near[:limit]]
+
     def matches_expected(self, count):
         if not self.has_expected:
             return True
@@ -58,6 +250,10 @@ class Patch:
     def _repr_list(self):
         l = ["Find", repr(self.find), "Replace", repr(self.replace),
             "Disabled", repr(self.disabled)]
+        if self.mask_find is not None:
+            l += ["MaskFind", repr(self.mask_find)]
+        if self.mask_replace is not None:
+            l += ["MaskReplace", repr(self.mask_replace)]
         if self.has_expected:
             l += ["Expect", repr(self.expected)]
         if self.comment:
@@ -132,3 +328,335 @@ class FilePatch(Patch):
             raise KeyError("config.plist file is missing KernelAndKextPatches/KextToPatch section")
         filepatches = map(FilePatch, kexts_to_patch)
         return filepatches
+
+
+class PatchSet:
+    """A sequence of patches for one target, applied the way Clover does.
+
+    Clover applies patches one after another, so a later patch sees the
+    bytes an earlier one wrote.  A Find used by only one patch is counted
+    and applied with one scan of the buffer as it is by then, as
+    Patch.count_and_apply does.  A Find shared by several patches is
+    located once, every occurrence; when a later patch uses it again,
+    occurrences that the replacements since overwrote are dropped and only
+    the bytes near those replacements are searched again.  If so many were
+    made that a scan would be cheaper, that Find is scanned for afresh at
+    each of its later uses instead.
+
+    So each distinct Find still costs a scan of the buffer.  A single
+    regular expression alternating between all of them is no faster: re
+    tries the alternatives one at a time at every byte, where str.find
+    skips through the buffer in C.
+    """
+
+    # Searching near each of many small replacements costs a Python call
+    # apiece; past one per this many bytes of buffer, scan all of it.
+    rescan_bytes_per_range = 4096
+
+    def __init__(self, patches, count_only=()):
+        """
+        :param patches: patches sharing a target, in config order
+        :type patches: list[patch.Patch]
+        :param count_only: patches to count but not apply
+        :type count_only: collections.Iterable[patch.Patch]
+        """
+        self.patches = list(patches)
+        self.count_only = set(count_only)
+        # The first patch with each search key, to search with
+        self.finds = collections.OrderedDict()
+        for p in self.patches:
+            self.finds.setdefault(p.search_key, p)
+
+    def signature(self):
+        """What apply() depends on: each patch's Find, Replace, whether
+        it is only counted, and its MaskFind and MaskReplace, in order.
+
+        :rtype: tuple
+        """
+        return tuple((p.find, p.replace, p in self.count_only,
+                      p.mask_find or "", p.mask_replace or "")
+                     for p in self.patches)
+
+    def locate(self, buf, times=None):
+        """Find every occurrence, overlapping or not, of every distinct Find.
+
+        :param buf: the unpatched target
+        :param times: if given, filled in with the seconds taken for each
+                      search key
+        :type times: dict
+        :return: dict of search key to sorted list of offsets
+        :rtype: dict
+        """
+        found = {}
+        for key, p in self.finds.items():
+            if times is not None:
+                t0 = time.time()
+            found[key] = p.find_all(buf)
+            if times is not None:
+                times[key] = time.time() - t0
+        return found
+
+    def apply(self, buf, profile=None):
+        """Apply all patches in order, in place.
+
+        :param buf: the target contents
+        :type buf: bytearray | mappedfile.MappedFile
+        :param profile: if given, a (seconds, bytes scanned) tuple is
+                        appended for each patch
+        :type profile: list[(float, int)]
+        :return: for each patch, the offsets where it matched
+        :rtype: list[list[int]]
+        """
+        size = len(buf)
+        uses = collections.Counter(p.search_key for p in self.patches)
+        # (offsets, length) of the replacements made so far, by patch
+        writes = []
+        # Search key to (every occurrence, len(writes) when they were current)
+        found = {}
+        # Search keys whose occurrences were not worth keeping up to date
+        plain = set()
+        result = []
+        for p in self.patches:
+            if profile is not None:
+                t0 = time.time()
+            n = len(p.find)
+            key = p.search_key
+            uses[key] -= 1
+            replace = not (p in self.count_only or p.changes_nothing())
+            # Whether to keep its occurrences for a later use
+            keep = uses[key] and key not in plain
+            occurrences = None
+            if key in found:
+                occurrences, seen = found.pop(key)
+                pending = writes[seen:]
+                if sum(len(offsets) for offsets, _ in pending) * self.rescan_bytes_per_range > size:
+                    # As much work as a scan; scan at each use from now on
+                    occurrences = None
+                    keep = False
+                    plain.add(key)
+                else:
+                    occurrences, scanned = self._update(buf, p, occurrences, pending)
+            elif keep and (p.masked_find or p.overlaps_itself):
+                occurrences = p.find_all(buf)
+                scanned = size
+            if occurrences is not None:
+                offsets = first_fit(occurrences, n)
+                if replace:
+                    p.replace_at(buf, offsets)
+            else:
+                offsets = p.count_and_apply(buf, replace)[1]
+                scanned = size
+                if keep:
+                    # No two can overlap, so these are all the occurrences
+                    occurrences = offsets
+            if keep:
+                found[key] = (occurrences, len(writes))
+            result.append(offsets)
+            if offsets and replace:
+                writes.append((offsets, n))
+            if profile is not None:
+                profile.append((time.time() - t0, scanned))
+        return result
+
+    def _update(self, buf, p, occurrences, writes):
+        """Every occurrence of p's Find, given those before some writes.
+
+        :param occurrences: sorted offsets of every occurrence before the
+                            writes
+        :param writes: (offsets, length) of the replacements since
+        :return: the sorted offsets now, and the bytes searched
+        :rtype: (list[int], int)
+        """
+        if not writes:
+            return occurrences, 0
+        size = len(buf)
+        n = len(p.find)
+        written = _Ranges.merged((off, off + length) for offsets, length in writes for off in offsets)
+        # Where a match may have appeared: within n - 1 bytes of a write
+        near = _Ranges.merged((max(0, start - n + 1), min(size, end + n - 1)) for start, end in written)
+        now = [off for off in occurrences if not written.overlaps(off, off + n)]
+        scanned = 0
+        for start, end in near:
+            now.extend(p.find_all(buf, start, end))
+            scanned += end - start
+        return sorted(set(now)), scanned
+
+    def apply_within(self, buf, ranges, profile=None):
+        """Like apply(), but only matching wholly inside one of ranges.
+
+        Ranges don't interact, so each is patched on its own as a
+        separate buffer and the results combined.
+
+        :param ranges: sorted, non-overlapping [start, end) byte ranges
+        :type ranges: list[(int, int)]
+        :param profile: as for apply(), summed over the ranges
+        """
+        result = [[] for p in self.patches]
+        for start, end in ranges:
+            window = bytearray(buf[start:end])
+            window_profile = [] if profile is not None else None
+            for offsets, found in zip(result, self.apply(window, window_profile)):
+                offsets.extend(start + off for off in found)
+            if profile is not None:
+                if not profile:
+                    profile.extend(window_profile)
+                else:
+                    profile[:] = [(s1 + s2, b1 + b2) for (s1, b1), (s2, b2)
+                                  in zip(profile, window_profile)]
+        self.replay(buf, result)
+        return result
+
+    def replay(self, buf, results):
+        """Apply patches in place at offsets an earlier apply() returned.
+
+        This reproduces apply() on the same contents without searching.
+
+        :param buf: the target contents, as they were before apply()
+        :type buf: bytearray | mappedfile.MappedFile
+        :param results: what apply() returned
+        :type results: list[list[int]]
+        """
+        for p, offsets in zip(self.patches, results):
+            if p in self.count_only or p.changes_nothing():
+                continue
+            p.replace_at(buf, offsets)
+
+
+def format_offsets(offsets, limit=8, where=None):
+    """Format match offsets for logging, e.g. "0x1a2c, 0x3f00".
+
+    :param where: if given, a function of an offset returning a name to
+                  show with it, such as its Mach-O section
+    """
+    if where:
+        l = ["0x%x (%s)" % (off, where(off)) for off in offsets[:limit]]
+    else:
+        l = ["0x%x" % off for off in offsets[:limit]]
+    if len(offsets) > limit:
+        l.append("... (%d more)" % (len(offsets) - limit))
+    return ", ".join(l)
+
+
+def _find_all(buf, s, start=0, end=None):
+    """Offsets of all occurrences of s in buf[start:end], including overlaps."""
+    if end is None:
+        end = len(buf)
+    offsets = []
+    i = buf.find(s, start, end)
+    while i >= 0:
+        offsets.append(i)
+        i = buf.find(s, i + 1, end)
+    return offsets
+
+
+def first_fit(offsets, n):
+    """The non-overlapping matches a left-to-right scan would take."""
+    taken = []
+    next_free = 0
+    for off in offsets:
+        if off >= next_free:
+            taken.append(off)
+            next_free = off + n
+    return taken
+
+
+class _MaskedFind:
+    """Search for Find under MaskFind.
+
+    Where a run of Find's bytes is wholly compared, occurrences of the
+    longest such run are found with the buffer's own find() and only
+    those candidates are checked against the mask. Otherwise the pattern
+    is compiled to a regular expression, one character class per byte,
+    and the buffer searched a chunk at a time. Either way the scanning of
+    the bulk of the buffer is done in C.
+    """
+
+    # Shorter literals match too often in binaries to be worth filtering on
+    min_literal = 3
+    chunk_size = 1024 * 1024
+
+    def __init__(self, find, mask):
+        self.n = len(find)
+        self.mask = bytearray(mask)
+        self.want = bytearray(f & m for f, m in zip(bytearray(find), self.mask))
+        best = (0, 0)
+        run_start = None
+        for i, m in enumerate(self.mask + bytearray([0])):
+            if m == 0xff:
+                if run_start is None:
+                    run_start = i
+            elif run_start is not None:
+                if i - run_start > best[1] - best[0]:
+                    best = (run_start, i)
+                run_start = None
+        self.literal_offset = best[0]
+        self.literal = find[best[0]:best[1]]
+        parts = []
+        for w, m in zip(self.want, self.mask):
+            if m == 0xff:
+                parts.append(re.escape(chr(w)))
+            elif m == 0:
+                parts.append(".")
+            else:
+                parts.append("[%s]" % "".join(re.escape(chr(v)) for v in range(256) if v & m == w))
+        # A lookahead, so overlapping matches are all found
+        self.regex = re.compile("(?=%s)" % "".join(parts), re.DOTALL)
+
+    def matches(self, b):
+        for x, m, w in zip(bytearray(b), self.mask, self.want):
+            if x & m != w:
+                return False
+        return True
+
+    def find_all(self, buf, start=0, end=None):
+        if end is None:
+            end = len(buf)
+        n = self.n
+        offsets = []
+        if end - start < n:
+            return offsets
+        if len(self.literal) >= self.min_literal:
+            k = self.literal_offset
+            for c in _find_all(buf, self.literal, start + k, end - n + k + len(self.literal)):
+                if self.matches(buf[c - k:c - k + n]):
+                    offsets.append(c - k)
+            return offsets
+        pos = start
+        while pos <= end - n:
+            chunk_end = min(end, pos + self.chunk_size + n - 1)
+            for m in self.regex.finditer(bytes(buf[pos:chunk_end])):
+                if m.start() >= self.chunk_size:
+                    break
+                offsets.append(pos + m.start())
+            pos += self.chunk_size
+        return offsets
+
+
+class _Ranges:
+    """Sorted, merged set of half-open [start, end) byte ranges."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    @classmethod
+    def merged(cls, ranges):
+        """The union of ranges, in any order."""
+        r = cls()
+        for start, end in sorted(ranges):
+            if r.ends and start <= r.ends[-1]:
+                r.ends[-1] = max(r.ends[-1], end)
+            else:
+                r.starts.append(start)
+                r.ends.append(end)
+        return r
+
+    def overlaps(self, start, end):
+        i = bisect.bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
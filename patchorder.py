@@ -0,0 +1,137 @@
+import bisect
+
+import patch
+
+# How the patches for one target interact.
+#
+# Clover applies patches in order, so a Replace can make or break a
+# match for a later Find. analyze() compares what each patch matches in
+# the unpatched target, on its own, with what it matches in sequence,
+# and puts any difference down to the earlier patches that wrote over
+# it.
+#
+# Nothing is searched more than PatchSet does: each distinct Find is
+# located once in the unpatched target, and the sequence is applied once
+# with PatchSet.apply(). The rest works on the match offsets, with
+# sorted interval lists, so thousands of patches on one target cost
+# little more than applying them.
+
+
+class Finding:
+    """Something to know about a patch in its sequence.
+
+    kind is one of:
+
+      "changes-nothing"  Find and Replace are the same
+      "duplicate"        same Find, masks and Replace as an earlier patch
+      "overlap"          on its own, it matches where earlier patches do
+      "order"            in sequence it matches differently than on its own,
+                         because of what the other patches wrote
+      "shadowed"         it matches on its own, but not in sequence
+    """
+
+    def __init__(self, kind, index, others=(), created=(), destroyed=(), overlaps=()):
+        self.kind = kind
+        # Index of the patch in the sequence
+        self.index = index
+        # Indexes of the patches involved
+        self.others = sorted(others)
+        # Offsets of matches in sequence but not on its own, and the reverse
+        self.created = list(created)
+        self.destroyed = list(destroyed)
+        # Offsets where an "overlap" match overlaps another patch's
+        self.overlaps = list(overlaps)
+
+    def as_dict(self):
+        d = {"kind": self.kind, "index": self.index, "others": self.others}
+        for key in ["created", "destroyed", "overlaps"]:
+            if getattr(self, key):
+                d[key] = getattr(self, key)
+        return d
+
+    def __repr__(self):
+        return "<Finding %s %d %r>" % (self.kind, self.index, self.others)
+
+
+class _Intervals:
+    """[start, start + length) intervals tagged with a patch index,
+    searchable by overlap."""
+
+    def __init__(self, items):
+        # (start, end, index)
+        self.items = sorted(items)
+        self.starts = [start for start, _, _ in self.items]
+        self.longest = max([end - start for start, end, _ in self.items] or [0])
+
+    def overlapping(self, start, end):
+        """Indexes of the intervals overlapping [start, end)."""
+        i = bisect.bisect_right(self.starts, start - self.longest)
+        j = bisect.bisect_left(self.starts, end)
+        return [index for s, e, index in self.items[i:j] if e > start]
+
+
+def analyze(buf, patches, count_only=()):
+    """Find out how the patches for one target depend on each other.
+
+    :param buf: the unpatched target; not changed
+    :type buf: str | bytearray | mappedfile.MappedFile
+    :param patches: in the order Clover applies them
+    :type patches: list[patch.Patch]
+    :param count_only: patches counted but not applied
+    :return: the findings, by patch
+    :rtype: list[Finding]
+    """
+    count_only = set(count_only)
+    patchset = patch.PatchSet(patches, count_only)
+    found = patchset.locate(buf)
+    alone = [patch.first_fit(found[p.search_key], len(p.find)) for p in patches]
+    if hasattr(buf, "view"):
+        patched = buf.view()
+    else:
+        patched = bytearray(buf)
+    in_sequence = patchset.apply(patched)
+    del patched
+
+    # What each applied patch wrote, and where each matches on its own
+    writes = _Intervals((off, off + len(p.find), i)
+                        for i, p in enumerate(patches)
+                        if not (p in count_only or p.changes_nothing())
+                        for off in in_sequence[i])
+    regions = _Intervals((off, off + len(p.find), i)
+                         for i, p in enumerate(patches) for off in alone[i])
+
+    findings = []
+    first_seen = {}
+    for i, p in enumerate(patches):
+        n = len(p.find)
+        if p.changes_nothing():
+            findings.append(Finding("changes-nothing", i))
+        key = (p.find, p.mask_find, p.replace, p.mask_replace)
+        if key in first_seen:
+            findings.append(Finding("duplicate", i, [first_seen[key]]))
+        else:
+            first_seen[key] = i
+
+        others = set()
+        overlaps = []
+        for off in alone[i]:
+            # Each overlapping pair is reported once, for the later patch
+            hit = set(j for j in regions.overlapping(off, off + n) if j < i)
+            if hit:
+                others |= hit
+                overlaps.append(off)
+        if others:
+            findings.append(Finding("overlap", i, others, overlaps=overlaps))
+
+        alone_set = set(alone[i])
+        sequence_set = set(in_sequence[i])
+        created = sorted(sequence_set - alone_set)
+        destroyed = sorted(alone_set - sequence_set)
+        if created or destroyed:
+            writers = set()
+            for off in created + destroyed:
+                writers.update(w for w in writes.overlapping(off, off + n) if w < i)
+            kind = "shadowed" if alone[i] and not in_sequence[i] else "order"
+            findings.append(Finding(kind, i, writers, created, destroyed))
+    return findings
+
@@ -0,0 +1,218 @@
+import base64
+import bisect
+import datetime
+import difflib
+import json
+import plistlib
+
+import plistwriter
+
+# Structural diff of two parsed plists.
+#
+# Dicts are compared key by key. Arrays of patches are matched up by
+# identity (Comment, or Name and Find) rather than by position, so one
+# inserted patch is one addition and not a change to every patch after
+# it. Other arrays are matched with difflib.
+#
+# Changes are (op, path, old, new) tuples. op is "added", "removed",
+# "changed" or "moved"; path is a tuple of dict keys and "[label]" array
+# elements. For "moved", old and new are array indexes.
+
+
+def _freeze(v):
+    """A hashable stand-in for a plist value, equal when the values are."""
+    if isinstance(v, dict):
+        return ("dict",) + tuple(sorted((k, _freeze(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)):
+        return ("array",) + tuple(_freeze(x) for x in v)
+    if isinstance(v, plistlib.Data):
+        return ("data", v.data)
+    return v
+
+
+def _kind(v):
+    # True == 1, but <true/> and <integer>1</integer> differ
+    if isinstance(v, basestring):
+        return basestring
+    if isinstance(v, plistlib.Data):
+        return plistlib.Data
+    return type(v)
+
+
+def _identity(v):
+    """What identifies a patch in an array, or None."""
+    if not isinstance(v, dict):
+        return None
+    if v.get("Comment"):
+        return ("Comment", v["Comment"])
+    if "Find" in v:
+        return ("Find", v.get("Name"), _freeze(v["Find"]))
+    return None
+
+
+def _label(v, i):
+    if isinstance(v, dict):
+        label = v.get("Comment") or v.get("Name")
+        if label:
+            return "[%s]" % label
+    return "[%d]" % i
+
+
+def _keyed(array):
+    """Identity of each element, with duplicates told apart by occurrence."""
+    seen = {}
+    keys = []
+    for v in array:
+        ident = _identity(v)
+        n = seen.get(ident, 0)
+        seen[ident] = n + 1
+        keys.append((ident, n))
+    return keys
+
+
+def _longest_increasing(seq):
+    """Indexes into seq of a longest strictly increasing subsequence."""
+    tails = []
+    tail_index = []
+    prev = [None] * len(seq)
+    for i, x in enumerate(seq):
+        j = bisect.bisect_left(tails, x)
+        if j == len(tails):
+            tails.append(x)
+            tail_index.append(i)
+        else:
+            tails[j] = x
+            tail_index[j] = i
+        prev[i] = tail_index[j - 1] if j else None
+    result = []
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        result.append(i)
+        i = prev[i]
+    return set(result)
+
+
+def diff(a, b, path=()):
+    """Generate the changes that turn a into b.
+
+    :rtype: collections.Iterable[(str, tuple, object, object)]
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        for change in _diff_dict(a, b, path):
+            yield change
+    elif isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        for change in _diff_array(a, b, path):
+            yield change
+    elif _kind(a) != _kind(b) or _freeze(a) != _freeze(b):
+        yield ("changed", path, a, b)
+
+
+def _diff_dict(a, b, path):
+    for k, v in a.items():
+        if k not in b:
+            yield ("removed", path + (k,), v, None)
+        else:
+            for change in diff(v, b[k], path + (k,)):
+                yield change
+    for k, v in b.items():
+        if k not in a:
+            yield ("added", path + (k,), None, v)
+
+
+def _diff_array(a, b, path):
+    a_keys = _keyed(a)
+    b_keys = _keyed(b)
+    if all(k[0] is not None for k in a_keys + b_keys):
+        for change in _diff_by_identity(a, b, a_keys, b_keys, path):
+            yield change
+        return
+    matcher = difflib.SequenceMatcher(None, [_freeze(v) for v in a],
+                                      [_freeze(v) for v in b], autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal":
+            continue
+        common = min(i2 - i1, j2 - j1) if op == "replace" else 0
+        for k in range(common):
+            for change in diff(a[i1 + k], b[j1 + k], path + (_label(b[j1 + k], j1 + k),)):
+                yield change
+        for i in range(i1 + common, i2):
+            yield ("removed", path + (_label(a[i], i),), a[i], None)
+        for j in range(j1 + common, j2):
+            yield ("added", path + (_label(b[j], j),), None, b[j])
+
+
+def _diff_by_identity(a, b, a_keys, b_keys, path):
+    b_index = dict((k, j) for j, k in enumerate(b_keys))
+    matched = []
+    for i, k in enumerate(a_keys):
+        j = b_index.get(k)
+        if j is None:
+            yield ("removed", path + (_label(a[i], i),), a[i], None)
+        else:
+            matched.append((i, j))
+    in_order = _longest_increasing([j for i, j in matched])
+    a_index = set(a_keys)
+    for n, (i, j) in enumerate(matched):
+        p = path + (_label(b[j], j),)
+        if n not in in_order:
+            yield ("moved", p, i, j)
+        for change in diff(a[i], b[j], p):
+            yield change
+    for j, k in enumerate(b_keys):
+        if k not in a_index:
+            yield ("added", path + (_label(b[j], j),), None, b[j])
+
+
+def format_path(path):
+    s = ""
+    for p in path:
+        if p.startswith("["):
+            s += p
+        else:
+            s += "/" + p if s else p
+    return s
+
+
+def format_unified(changes, name1, name2, rehabManHouseStyle=False, sortItems=False):
+    """Format changes like a unified diff, with plist XML as the lines."""
+
+    def lines(sign, value):
+        xml = plistwriter.writeValueToString(value, rehabManHouseStyle=rehabManHouseStyle,
+                                             sortItems=sortItems)
+        return [sign + line for line in xml.splitlines()]
+
+    out = ["--- " + name1, "+++ " + name2]
+    for op, path, old, new in changes:
+        out.append("@@ %s @@" % format_path(path))
+        if op == "moved":
+            out.append(" moved from %d to %d" % (old, new))
+            continue
+        if op != "added":
+            out.extend(lines("-", old))
+        if op != "removed":
+            out.extend(lines("+", new))
+    return "\n".join(out) + "\n"
+
+
+def _jsonable(v):
+    if isinstance(v, dict):
+        return dict((k, _jsonable(x)) for k, x in v.items())
+    if isinstance(v, (list, tuple)):
+        return [_jsonable(x) for x in v]
+    if isinstance(v, plistlib.Data):
+        return {"data": base64.b64encode(v.data)}
+    if isinstance(v, datetime.datetime):
+        return v.isoformat() + "Z"
+    return v
+
+
+def format_json(changes):
+    l = []
+    for op, path, old, new in changes:
+        d = {"op": op, "path": list(path)}
+        if op != "added":
+            d["old"] = old if op == "moved" else _jsonable(old)
+        if op != "removed":
+            d["new"] = new if op == "moved" else _jsonable(new)
+        l.append(d)
+    return json.dumps(l, indent=1, sort_keys=True, separators=(",", ": ")) + "\n"
@@ -0,0 +1,138 @@
+import binascii
+import collections
+import plistlib
+import xml.etree.cElementTree as ElementTree
+
+# Load only the parts of a plist we need.
+#
+# plistlib.readPlist builds the whole tree and decodes every <data>. The
+# checkers only look at one section of config.plist. This loader streams
+# the XML with iterparse, skips over subtrees outside the wanted paths
+# without building them, and leaves <data> as base64 until it is used.
+#
+# Dicts are OrderedDicts, so key order is preserved; plistwriter writes
+# them back in the same order. plistlib itself is left alone.
+
+
+class LazyData(plistlib.Data):
+    """plistlib.Data whose base64 is only decoded when .data is used."""
+
+    def __init__(self, base64):
+        self.base64 = base64 or ""
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = binascii.a2b_base64(self.base64)
+        return self._data
+
+    def __cmp__(self, other):
+        if isinstance(other, plistlib.Data):
+            return cmp(self.data, other.data)
+        return plistlib.Data.__cmp__(self, other)
+
+
+def _text(elem):
+    text = elem.text or ""
+    if isinstance(text, unicode):
+        try:
+            text = text.encode("ascii")
+        except UnicodeError:
+            pass
+    return text
+
+
+_scalars = {
+    "string": _text,
+    "integer": lambda e: int(e.text),
+    "real": lambda e: float(e.text),
+    "true": lambda e: True,
+    "false": lambda e: False,
+    "date": lambda e: plistlib._dateFromString(e.text),
+    "data": lambda e: LazyData(e.text),
+}
+
+
+class _Frame:
+    """A dict or array being built, or a subtree being skipped."""
+
+    def __init__(self, value, path):
+        self.value = value
+        self.path = path
+        self.key = None
+
+
+def load(pathOrFile, paths=None):
+    """Load a plist, keeping only the subtrees at the given key paths.
+
+    :param pathOrFile: plist file name or file object
+    :param paths: key paths to keep, such as [("ACPI", "DSDT", "Patches")];
+                  None for everything
+    :type paths: list[tuple[str]] | None
+    :return: the root object; dicts on the way to a wanted path contain
+             only the keys leading there
+    """
+
+    def wanted(path):
+        if paths is None:
+            return True
+        for p in paths:
+            n = min(len(p), len(path))
+            if p[:n] == path[:n]:
+                return True
+        return False
+
+    root = []
+    stack = [_Frame(root, ())]
+    skip_depth = 0
+    elems = []
+    for event, elem in ElementTree.iterparse(pathOrFile, events=("start", "end")):
+        if event == "start":
+            elems.append(elem)
+            if skip_depth:
+                skip_depth += 1
+                continue
+            frame = stack[-1]
+            tag = elem.tag
+            if tag in ("plist", "key"):
+                continue
+            path = frame.path
+            if isinstance(frame.value, dict):
+                path = path + (frame.key,)
+            if not wanted(path):
+                skip_depth = 1
+            elif tag == "dict":
+                stack.append(_Frame(collections.OrderedDict(), path))
+            elif tag == "array":
+                stack.append(_Frame([], path))
+            continue
+
+        # "end"
+        elems.pop()
+        if elems:
+            # Finished with this element; don't let the tree grow
+            elems[-1].remove(elem)
+        if skip_depth:
+            skip_depth -= 1
+            if skip_depth == 0 and isinstance(stack[-1].value, dict):
+                stack[-1].key = None
+            continue
+        tag = elem.tag
+        if tag == "plist":
+            continue
+        if tag == "key":
+            stack[-1].key = _text(elem)
+            continue
+        if tag in ("dict", "array"):
+            value = stack.pop().value
+        else:
+            value = _scalars[tag](elem)
+        elem.clear()
+        frame = stack[-1]
+        if isinstance(frame.value, dict):
+            frame.value[frame.key] = value
+            frame.key = None
+        else:
+            frame.value.append(value)
+    return root[0] if root else None
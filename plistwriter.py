@@ -0,0 +1,148 @@
+import base64
+import collections
+import datetime
+import plistlib
+import re
+
+# Write XML property lists, producing the same bytes as plistlib.writePlist
+# with the old plistmonkey writeData patch, without patching plistlib.
+#
+# Output is accumulated in a list and written with a single write().
+#
+# rehabManHouseStyle: RehabMan's plists express short data as
+#
+#     <data>fOoBaR==</data>
+#
+# rather than
+#
+#    <data>
+#    fOoBaR==
+#    </data>
+#
+# sortItems: write ordered dicts' keys sorted too. Plain dicts are
+# always sorted, as plistlib does.
+
+PLISTHEADER = plistlib.PLISTHEADER
+
+# Control chars, except for \t \n and \r
+_controlCharPat = re.compile(
+    r"[\x00\x01\x02\x03\x04\x05\x06\x07\x08\x0b\x0c\x0e\x0f"
+    r"\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f]")
+
+
+def _escapeAndEncode(text):
+    if _controlCharPat.search(text) is not None:
+        raise ValueError("strings can't contains control characters; "
+                         "use plistlib.Data instead")
+    text = text.replace("\r\n", "\n")
+    text = text.replace("\r", "\n")
+    text = text.replace("&", "&amp;")
+    text = text.replace("<", "&lt;")
+    text = text.replace(">", "&gt;")
+    return text.encode("utf-8")
+
+
+class PlistWriter:
+    def __init__(self, indentLevel=0, indent="\t",
+                 rehabManHouseStyle=False, sortItems=False):
+        self.out = []
+        self.indentLevel = indentLevel
+        self.indent = indent
+        self.indents = [""]
+        self.rehabManHouseStyle = rehabManHouseStyle
+        self.sortItems = sortItems
+
+    def getvalue(self):
+        return "".join(self.out)
+
+    def _indent(self, level):
+        while len(self.indents) <= level:
+            self.indents.append(self.indents[-1] + self.indent)
+        return self.indents[level]
+
+    def writeln(self, line, level):
+        self.out.append(self._indent(level) + line + "\n")
+
+    def writeValue(self, value, level=None):
+        if level is None:
+            level = self.indentLevel
+        if isinstance(value, (str, unicode)):
+            self.writeln("<string>%s</string>" % _escapeAndEncode(value), level)
+        elif isinstance(value, bool):
+            # bool before int, as bool is a subclass of int
+            self.writeln("<true/>" if value else "<false/>", level)
+        elif isinstance(value, (int, long)):
+            self.writeln("<integer>%d</integer>" % value, level)
+        elif isinstance(value, float):
+            self.writeln("<real>%r</real>" % value, level)
+        elif isinstance(value, dict):
+            self.writeDict(value, level)
+        elif isinstance(value, plistlib.Data):
+            self.writeData(value, level)
+        elif isinstance(value, datetime.datetime):
+            self.writeln("<date>%s</date>" % plistlib._dateToString(value), level)
+        elif isinstance(value, (tuple, list)):
+            self.writeArray(value, level)
+        else:
+            raise TypeError("unsuported type: %s" % type(value))
+
+    def writeData(self, data, level):
+        maxlinelength = max(16, 76 - len(self.indent.replace("\t", " " * 8)) * level)
+        # Encode in one go and split into lines, rather than encoding
+        # each line separately; whole lines are a multiple of 3 bytes,
+        # so the result is the same
+        linelength = (maxlinelength // 4) * 4
+        db64 = base64.b64encode(data.data)
+        indent = self._indent(level)
+        if self.rehabManHouseStyle and len(db64) <= linelength:
+            self.out.append("%s<data>%s</data>\n" % (indent, db64))
+            return
+        self.out.append(indent + "<data>\n")
+        for i in range(0, len(db64), linelength):
+            self.out.append(indent + db64[i:i + linelength] + "\n")
+        self.out.append(indent + "</data>\n")
+
+    def writeDict(self, d, level):
+        self.writeln("<dict>", level)
+        if self.sortItems or not isinstance(d, collections.OrderedDict):
+            items = sorted(d.items())
+        else:
+            items = d.items()
+        for key, value in items:
+            if not isinstance(key, (str, unicode)):
+                raise TypeError("keys must be strings")
+            self.writeln("<key>%s</key>" % _escapeAndEncode(key), level + 1)
+            self.writeValue(value, level + 1)
+        self.writeln("</dict>", level)
+
+    def writeArray(self, array, level):
+        self.writeln("<array>", level)
+        for value in array:
+            self.writeValue(value, level + 1)
+        self.writeln("</array>", level)
+
+
+def writePlistToString(rootObject, rehabManHouseStyle=False, sortItems=False):
+    w = PlistWriter(rehabManHouseStyle=rehabManHouseStyle, sortItems=sortItems)
+    w.out.append(PLISTHEADER)
+    w.writeln("<plist version=\"1.0\">", 0)
+    w.writeValue(rootObject)
+    w.writeln("</plist>", 0)
+    return w.getvalue()
+
+
+def writePlist(rootObject, pathOrFile, rehabManHouseStyle=False, sortItems=False):
+    """Write rootObject to a plist file name or (writable) file object."""
+    s = writePlistToString(rootObject, rehabManHouseStyle, sortItems)
+    if isinstance(pathOrFile, (str, unicode)):
+        with open(pathOrFile, "w") as f:
+            f.write(s)
+    else:
+        pathOrFile.write(s)
+
+
+def writeValueToString(value, indentLevel=0, rehabManHouseStyle=False, sortItems=False):
+    """Write a fragment of a plist, with no header or <plist> element."""
+    w = PlistWriter(indentLevel, rehabManHouseStyle=rehabManHouseStyle, sortItems=sortItems)
+    w.writeValue(value)
+    return w.getvalue()
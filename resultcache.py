@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Remember what a sequence of patches did to a target binary.
+#
+# Entries are keyed by the sha256 of the unpatched target and the ordered
+# Find/Replace pairs applied to it, and hold the match offsets of each
+# patch plus the sha256 of the patched result. Offsets are enough to
+# replay the patches without searching (see patch.PatchSet.replay).
+#
+# The file may be shared by several processes (the checkers and
+# check-daemon.py). Each saves to its own temporary file and renames it
+# into place, so a reader sees one whole save or another, never a mix.
+# A ResultCache object is not itself thread-safe.
+#
+# Each entry records when it was last used, for evicting the least
+# recently used ones, and its size in the file, measured once when it is
+# put. "used" is only moved forward by more than touch_interval, so runs
+# that only hit recently used entries leave the file alone.
+#
+# A file whose "version" is not this one is ignored and replaced on the
+# next save; bump the version whenever keys or entries change.
+
+
+def hash_contents(buf, chunk_size=1024 * 1024):
+    """sha256 hex digest of a bytearray or mappedfile.MappedFile."""
+    h = hashlib.sha256()
+    for off in range(0, len(buf), chunk_size):
+        h.update(buf[off:off + chunk_size])
+    return h.hexdigest()
+
+
+class ResultCache:
+    version = 1
+    # Seconds "used" may lag behind the latest use
+    touch_interval = 3600
+
+    def __init__(self, filename, max_bytes=64 * 1024 * 1024):
+        """
+        :param filename: JSON file to keep entries in, or None to keep nothing
+        :param max_bytes: approximate size limit of the file
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.entries = {}
+        # Callers count these, since lookups may happen in worker processes
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        if filename:
+            self.load()
+
+    @staticmethod
+    def key(contents_hash, signature, scope=None):
+        """Cache key for applying a PatchSet to contents.
+
+        :param contents_hash: from hash_contents() of the unpatched target
+        :param signature: from patch.PatchSet.signature()
+        :param scope: what part of the contents was searched, if not all
+        :type scope: str | None
+        """
+        h = hashlib.sha256(contents_hash)
+        if scope is not None:
+            h.update("scope:%d:%s" % (len(scope), scope))
+        for find, replace, count_only, mask_find, mask_replace in signature:
+            h.update("%d:%d:%d:" % (len(find), len(replace), count_only))
+            h.update(find)
+            h.update(replace)
+            h.update("mask:%d:%d:" % (len(mask_find), len(mask_replace)))
+            h.update(mask_find)
+            h.update(mask_replace)
+        return h.hexdigest()
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                d = json.load(f)
+        except (IOError, ValueError):
+            return
+        if d.get("version") == self.version:
+            self.entries = d["entries"]
+
+    def save(self):
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            self.write(snapshot)
+
+    def snapshot(self):
+        """Copy what save() would write, or return None if nothing changed.
+
+        The copy can be written by write() while this object is in use,
+        so a caller that shares it between threads need only lock around
+        snapshot(), not the whole save.
+        """
+        if not (self.filename and self.dirty):
+            return None
+        self.evict()
+        self.dirty = False
+        return {"version": self.version,
+                "entries": dict((k, dict(e)) for k, e in self.entries.items())}
+
+    def write(self, snapshot):
+        """Write a snapshot() to the file."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)),
+                                   prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                json.dump(snapshot, f)
+            os.rename(tmp, self.filename)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        """Drop least recently used entries until under max_bytes."""
+        total = sum(e["size"] for e in self.entries.values())
+        if total <= self.max_bytes:
+            return
+        for k in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries.pop(k)["size"]
+            self.dirty = True
+
+    def get(self, key):
+        """Return the offsets list for each patch, or None on a miss.
+
+        :rtype: list[list[int]] | None
+        """
+        e = self.entries.get(key)
+        if e is None:
+            return None
+        self.touch(key)
+        return e["offsets"]
+
+    def touch(self, key):
+        """Record that the entry for key was used now.
+
+        For a hit found by a worker process with its own copy of the cache.
+        """
+        e = self.entries.get(key)
+        now = time.time()
+        if e is not None and now - e["used"] > self.touch_interval:
+            e["used"] = now
+            self.dirty = True
+
+    def put(self, key, offsets, patched_hash):
+        e = {"offsets": offsets, "patched": patched_hash, "used": time.time()}
+        e["size"] = len(json.dumps(e))
+        self.entries[key] = e
+        self.dirty = True
+
+    def record(self, outcome, offsets):
+        """Count and keep the outcome of a lookup done on another copy of
+        the cache, as in a worker process.
+
+        :param outcome: (key, None) for a hit, (key, sha256 of the patched
+                        contents) for a miss
+        :param offsets: the results looked up or found
+        """
+        key, patched_hash = outcome
+        if patched_hash is None:
+            self.hits += 1
+            self.touch(key)
+        else:
+            self.misses += 1
+            self.put(key, offsets, patched_hash)
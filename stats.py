@@ -0,0 +1,95 @@
+import json
+import time
+
+# Timings for --stats.
+#
+# Nothing here runs unless --stats is given: the checkers keep stats as
+# None otherwise, and PatchSet.apply only times patches when handed a
+# list to fill in.
+#
+# A check records:
+#
+#   phases: wall-clock seconds of each step of the run, in order
+#   targets: for each file or kext patched, its size, the time to load
+#            it, hash it for the result cache and patch it, and whether
+#            the results came from the cache
+#   patches: for each patch on each target, the time spent finding and
+#            applying it, the bytes searched and the matches found
+
+
+class Stats:
+    def __init__(self):
+        self.phases = []
+        self.targets = []
+        self.patches = []
+        self.started = self.last = time.time()
+
+    def lap(self, phase):
+        """Record the time since the last lap (or the start) as phase."""
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def add_target(self, name, profile, patches, results):
+        """Record one target from the profile dict made while patching it.
+
+        :param name: file or kext name
+        :param profile: dict with "size", "load", "hash" and "patch"
+                        seconds, "cached", and "patches", a list of
+                        (seconds, bytes scanned) per patch, empty if cached
+        :param patches: the patches applied, in order
+        :type patches: list[patch.Patch]
+        :param results: match offsets for each patch
+        :type results: list[list[int]]
+        """
+        self.targets.append({
+            "target": name,
+            "size": profile["size"],
+            "load_seconds": profile["load"],
+            "hash_seconds": profile["hash"],
+            "patch_seconds": profile["patch"],
+            "cached": profile["cached"],
+        })
+        timings = profile["patches"] or [(0.0, 0)] * len(patches)
+        for p, (seconds, scanned), offsets in zip(patches, timings, results):
+            self.patches.append({
+                "target": name,
+                "comment": p.comment,
+                "seconds": seconds,
+                "bytes_scanned": scanned,
+                "matches": len(offsets),
+            })
+
+    def as_dict(self):
+        return {
+            "total_seconds": self.last - self.started,
+            "phases": [{"phase": name, "seconds": s} for name, s in self.phases],
+            "targets": self.targets,
+            "patches": self.patches,
+        }
+
+    def write(self, f, format):
+        if format == "json":
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+        else:
+            self.write_table(f)
+
+    def write_table(self, f):
+        """Write phases in order, then targets and patches, slowest first."""
+        f.write("%-24s %10s\n" % ("phase", "seconds"))
+        for name, s in self.phases:
+            f.write("%-24s %10.4f\n" % (name, s))
+        f.write("%-24s %10.4f\n\n" % ("total", self.last - self.started))
+
+        f.write("%10s %10s %10s %12s  %s\n" % ("patch s", "load s", "hash s", "size", "target"))
+        for t in sorted(self.targets, key=lambda t: -(t["patch_seconds"] + t["load_seconds"])):
+            f.write("%10.4f %10.4f %10.4f %12d  %s%s\n" % (
+                t["patch_seconds"], t["load_seconds"], t["hash_seconds"], t["size"],
+                t["target"], " (cached)" if t["cached"] else ""))
+        f.write("\n")
+
+        f.write("%10s %12s %8s  %s\n" % ("seconds", "scanned", "matches", "target: patch"))
+        for p in sorted(self.patches, key=lambda p: -p["seconds"]):
+            f.write("%10.4f %12d %8d  %s: %s\n" % (
+                p["seconds"], p["bytes_scanned"], p["matches"], p["target"], p["comment"]))
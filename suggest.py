@@ -0,0 +1,81 @@
+import collections
+import pipes
+
+import patch
+
+# Where a patch that applies 0 times may have gone.
+#
+# After an OS update a Find often still occurs with a byte or two
+# changed: a new register, offset or constant. patch.Patch.find_near()
+# looks for the places within k differing bytes of Find, searching for
+# k + 1 pieces of Find with the buffer's own find(). That is close to
+# linear in the size of the buffer as long as the pieces are long enough
+# to be rare, which default_distance() sees to.
+
+
+def default_distance(n):
+    """Differing bytes to allow in a Find of n bytes: pieces of at least 4."""
+    return max(1, n // 4 - 1)
+
+
+def updated(p, diffs):
+    """Find and Replace for a patch, changed where the binary differs.
+
+    Bytes the patch replaces keep their Replace; bytes it leaves alone
+    take the binary's value in Replace as well as in Find.
+    """
+    find = bytearray(p.find)
+    replace = bytearray(p.replace)
+    for i, _, b in diffs:
+        if replace[i] == find[i]:
+            replace[i] = b
+        find[i] = b
+    return str(find), str(replace)
+
+
+def makebinpatch_command(find, replace, comment, filename=None):
+    """A makebinpatch.py command line printing a stanza for a patch."""
+    words = ["makebinpatch.py", "-x"]
+    if filename:
+        words += ["-f", filename]
+    words += [find.encode("hex"), replace.encode("hex")]
+    if comment:
+        words.append(comment)
+    return " ".join(pipes.quote(w) for w in words)
+
+
+def log_suggestions(log, p, name, buf, k=None, limit=3, filename=None):
+    """Log the places in buf nearest to p's Find, and how to patch them.
+
+    Places that differ from Find in the same way are logged together.
+
+    :param log: the checker's logger
+    :param name: what buf is, for the log
+    :param k: differing bytes to allow, or None for default_distance()
+    :param limit: how many different ways of differing to log
+    :param filename: the kext name for makebinpatch.py -f, if a kext patch
+    """
+    if k is None:
+        k = default_distance(len(p.find))
+    # Any more and everywhere is near
+    compared = len(p.find) - (p.mask_find or "").count("\0")
+    k = min(k, compared - 1)
+    if k < 0:
+        log.warning("  Find compares no bytes, so nothing is near it")
+        return
+    ways = collections.OrderedDict()
+    for offset, diffs in p.find_near(buf, k):
+        ways.setdefault(tuple(diffs), []).append(offset)
+    if not ways:
+        log.warning("  nothing in %s within %d byte%s of Find", name, k, "s"[k == 1:])
+        return
+    for diffs, offsets in ways.items()[:limit]:
+        where = "%s at %s" % (name, patch.format_offsets(offsets))
+        if not diffs:
+            log.warning("  %s matches before patching; an earlier patch changes it", where)
+            continue
+        log.warning("  %s differs in %d byte%s: %s", where, len(diffs), "s"[len(diffs) == 1:],
+                    ", ".join("+%d %02x->%02x" % d for d in diffs))
+        if p.mask_find is None and p.mask_replace is None:
+            find, replace = updated(p, diffs)
+            log.warning("    %s", makebinpatch_command(find, replace, p.comment, filename))
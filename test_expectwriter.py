@@ -0,0 +1,73 @@
+import plistlib
+import StringIO
+import unittest
+
+import expectwriter
+
+PATH = ("ACPI", "DSDT", "Patches")
+
+
+def plist(patches):
+    return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<plist version=\"1.0\">\n<dict>\n"
+            "\t<key>ACPI</key>\n\t<dict>\n\t\t<key>DSDT</key>\n\t\t<dict>\n"
+            "\t\t\t<key>Patches</key>\n\t\t\t<array>\n%s\t\t\t</array>\n"
+            "\t\t</dict>\n\t</dict>\n</dict>\n</plist>\n" % patches)
+
+
+def write(src, expects):
+    out = StringIO.StringIO()
+    expectwriter.write_expected(src, PATH, expects, out)
+    return out.getvalue()
+
+
+def expects_of(src):
+    return [p.get("Expect") for p in plistlib.readPlistFromString(src)["ACPI"]["DSDT"]["Patches"]]
+
+
+class WriteExpectedTest(unittest.TestCase):
+    def test_multi_line(self):
+        src = plist("\t\t\t\t<dict>\n\t\t\t\t\t<key>Comment</key>\n\t\t\t\t\t<string>a</string>\n"
+                    "\t\t\t\t</dict>\n")
+        self.assertEqual(write(src, {0: 2}), plist(
+            "\t\t\t\t<dict>\n\t\t\t\t\t<key>Comment</key>\n\t\t\t\t\t<string>a</string>\n"
+            "\t\t\t\t\t<key>Expect</key>\n\t\t\t\t\t<integer>2</integer>\n\t\t\t\t</dict>\n"))
+
+    def test_one_line(self):
+        src = plist("\t\t\t\t<dict><key>Comment</key><string>a</string>"
+                    "<key>Find</key><data>QUJD</data></dict>\n"
+                    "\t\t\t\t<dict><key>Comment</key><string>b</string></dict>\n")
+        out = write(src, {0: 3, 1: 0})
+        self.assertEqual(out, plist(
+            "\t\t\t\t<dict><key>Comment</key><string>a</string>"
+            "<key>Find</key><data>QUJD</data><key>Expect</key><integer>3</integer></dict>\n"
+            "\t\t\t\t<dict><key>Comment</key><string>b</string>"
+            "<key>Expect</key><integer>0</integer></dict>\n"))
+        self.assertEqual(expects_of(out), [3, 0])
+
+    def test_key_on_dict_line(self):
+        src = plist("    <dict><key>Comment</key>\n      <string>a</string>\n    </dict>\n")
+        out = write(src, {0: 1})
+        self.assertEqual(out, plist(
+            "    <dict><key>Comment</key>\n      <string>a</string>\n"
+            "    \t<key>Expect</key>\n    \t<integer>1</integer>\n    </dict>\n"))
+        self.assertEqual(expects_of(out), [1])
+
+    def test_mixed_indentation(self):
+        src = plist("\t  <dict>\n\t    <key>Comment</key>\n\t    <string>a</string>\n\t  </dict>\n"
+                    "  \t<dict>\n  \t\t<key>Comment</key>\n  \t\t<string>b</string></dict>\n")
+        out = write(src, {0: 4, 1: 5})
+        self.assertEqual(out, plist(
+            "\t  <dict>\n\t    <key>Comment</key>\n\t    <string>a</string>\n"
+            "\t    <key>Expect</key>\n\t    <integer>4</integer>\n\t  </dict>\n"
+            "  \t<dict>\n  \t\t<key>Comment</key>\n  \t\t<string>b</string>"
+            "<key>Expect</key><integer>5</integer></dict>\n"))
+        self.assertEqual(expects_of(out), [4, 5])
+
+    def test_replace_existing(self):
+        src = plist("\t\t\t\t<dict><key>Expect</key><integer>1</integer><key>Comment</key>"
+                    "<string>a</string></dict>\n")
+        self.assertEqual(expects_of(write(src, {0: 7})), [7])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import plistlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import kernelcache
+import macho
+import patch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FIND = "\x0f\x0b\xde\xad"
+
+
+def executable(text, linkedit=""):
+    return macho.build([("__TEXT", "__text", text), ("__DATA", "__data", "\0" * 16),
+                        ("__LINKEDIT", "__symtab", linkedit)])
+
+
+KEXTS = [
+    ("/System/Library/Extensions/AppleHDA.kext", executable(FIND * 3, linkedit=FIND)),
+    ("/System/Library/Extensions/IOAudioFamily.kext/Contents/PlugIns/Codec.kext",
+     executable("\x90" + FIND + "\x90")),
+    ("/System/Library/Extensions/IOUSBFamily.kext", executable("\x90" * 8, linkedit=FIND * 2)),
+]
+
+
+def kext_patch(name, find=FIND, replace="\x90" * 4):
+    return patch.FilePatch({"Name": name, "Find": plistlib.Data(find),
+                            "Replace": plistlib.Data(replace), "Comment": name})
+
+
+class PrelinkedKextsTest(unittest.TestCase):
+    def setUp(self):
+        self.image = kernelcache.build_prelinked(KEXTS, kernel="\xcf\xfa\xed\xfe" + FIND * 5)
+
+    def count(self, name):
+        start, end = kernelcache.prelinked_kexts(self.image)[name]
+        kext = bytearray(self.image[start:end])
+        return [len(offsets) for offsets in
+                patch.PatchSet([kext_patch(name)]).apply_within(kext, kernelcache.kext_ranges(kext))]
+
+    def test_extents(self):
+        kexts = kernelcache.prelinked_kexts(self.image)
+        self.assertEqual(sorted(kexts), ["AppleHDA", "Codec", "IOUSBFamily"])
+        for path, contents in KEXTS:
+            name = os.path.basename(path)[:-len(".kext")]
+            start, end = kexts[name]
+            self.assertEqual(self.image[start:end], contents)
+
+    def test_counts_per_kext(self):
+        # Not the kernel's five, nor the other kext's, nor outside __TEXT
+        # and __DATA
+        self.assertEqual(self.count("AppleHDA"), [3])
+        self.assertEqual(self.count("Codec"), [1])
+        self.assertEqual(self.count("IOUSBFamily"), [0])
+
+    def test_compressed(self):
+        for compression in ("lzss", "lzvn"):
+            cache = kernelcache.build(self.image, compression)
+            self.assertEqual("".join(kernelcache.decompress(cache)), self.image)
+
+    def test_idref(self):
+        info = ("<dict><key>_PrelinkInfoDictionary</key><array>"
+                "<dict><key>_PrelinkBundlePath</key><string ID=\"1\">/a.kext</string>"
+                "<key>_PrelinkExecutableSize</key><integer size=\"64\" ID=\"2\">0x10</integer></dict>"
+                "<dict><key>_PrelinkBundlePath</key><string IDREF=\"1\"/>"
+                "<key>_PrelinkExecutableSize</key><integer IDREF=\"2\"/></dict>"
+                "</array></dict>\0\0")
+        self.assertEqual(kernelcache.parse_prelink_info(info),
+                         [{"_PrelinkBundlePath": "/a.kext", "_PrelinkExecutableSize": 16}] * 2)
+
+    def test_not_prelinked(self):
+        self.assertRaises(kernelcache.KernelCacheError, kernelcache.prelinked_kexts,
+                          macho.build([("__TEXT", "__text", FIND)]))
+
+
+class CheckKernelCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_expected(self):
+        image = kernelcache.build_prelinked(KEXTS, kernel="\xcf\xfa\xed\xfe" + FIND * 5)
+        cache_path = os.path.join(self.dir, "prelinkedkernel")
+        with open(cache_path, "wb") as f:
+            f.write(kernelcache.build(image, fat=True))
+        config_path = os.path.join(self.dir, "config.plist")
+        plistlib.writePlist({"KernelAndKextPatches": {
+            "KextsToPatch": [{"Name": name, "Find": plistlib.Data(FIND),
+                              "Replace": plistlib.Data("\x90" * 4)}
+                             for name in ("AppleHDA", "codec", "IOUSBFamily", "Missing")],
+            "KernelToPatch": [{"Find": plistlib.Data(FIND), "Replace": plistlib.Data("\x90" * 4)}],
+        }}, config_path)
+        env = dict(os.environ, XDG_CACHE_HOME=self.dir)
+        p = subprocess.Popen([sys.executable, os.path.join(HERE, "check-kext-patches.py"),
+                              "--no-cache", "--expected", "--kernelcache", cache_path, config_path],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = p.communicate()
+        expects = [e.get("Expect") for e in
+                   plistlib.readPlistFromString(out)["KernelAndKextPatches"]["KextsToPatch"]]
+        # Patches applying 0 times get no Expect
+        self.assertEqual(expects, [3, 1, None, None])
+        self.assertIn("applied 0 times IOUSBFamily", err)
+        self.assertIn("Not checking the 1 KernelToPatch patches", err)
+
+
+if __name__ == "__main__":
+    unittest.main()
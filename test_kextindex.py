@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import kextindex
+
+
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ["AppleHDA.kext/Contents/PlugIns/AppleHDAController.kext",
+                     "AppleHDA.kext/Contents/PlugIns/AppleHDAHardwareConfigDriver.kext"
+                     "/Contents/PlugIns/AppleHDAHardwareConfigDriverLoader.kext",
+                     "IOUSBFamily.kext/Contents/PlugIns/AppleUSBHub.kext",
+                     "Other.kext/Contents/PlugIns/Another.kext/Contents/PlugIns/Deep.kext",
+                     "Lilu.kext/Contents"]:
+            os.makedirs(os.path.join(self.root, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def resolve(self, names):
+        index = kextindex.KextIndex()
+        listed = index.resolve(names, [self.root])
+        return index, listed
+
+    def path(self, index, name):
+        return index.lcase_identifier_kext_to_kext_path.get(name.lower() + ".kext")
+
+    def test_in_root(self):
+        index, listed = self.resolve(["lilu"])
+        self.assertEqual(self.path(index, "lilu"), self.root + "/Lilu.kext")
+        self.assertEqual(listed, 1)
+
+    def test_likely_plugins_only(self):
+        index, listed = self.resolve(["AppleHDAController"])
+        self.assertEqual(self.path(index, "AppleHDAController"),
+                         self.root + "/AppleHDA.kext/Contents/PlugIns/AppleHDAController.kext")
+        # The root and AppleHDA's PlugIns, not those of the other kexts
+        self.assertEqual(listed, 2)
+
+    def test_nested(self):
+        index, listed = self.resolve(["AppleHDAController", "AppleHDAHardwareConfigDriverLoader"])
+        self.assertEqual(self.path(index, "AppleHDAHardwareConfigDriverLoader"),
+                         self.root + "/AppleHDA.kext/Contents/PlugIns/AppleHDAHardwareConfigDriver.kext"
+                         "/Contents/PlugIns/AppleHDAHardwareConfigDriverLoader.kext")
+
+    def test_stops_when_first_level_finds_nothing(self):
+        index, listed = self.resolve(["OtherDeep"])
+        self.assertIsNone(self.path(index, "OtherDeep"))
+        self.assertEqual(listed, 2)
+
+    def test_missing(self):
+        index, listed = self.resolve(["Missing"])
+        self.assertIsNone(self.path(index, "Missing"))
+        self.assertEqual(listed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
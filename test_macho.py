@@ -0,0 +1,92 @@
+import struct
+import unittest
+
+import macho
+
+CPU_TYPE_ARM64 = 0x0100000c
+CPU_TYPE_I386 = 7
+
+SECTIONS = [("__TEXT", "__text", "\x90" * 16), ("__TEXT", "__const", "abcd"),
+            ("__DATA", "__data", "\x01" * 8), ("__LINKEDIT", "__symtab", "sym")]
+
+
+def sections_by_name(image):
+    return dict((s.name, s) for s in image.sections)
+
+
+class ParseTest(unittest.TestCase):
+    def test_thin(self):
+        buf = macho.build(SECTIONS)
+        image = macho.parse(buf)
+        self.assertEqual((image.slice_offset, image.slice_size), (0, len(buf)))
+        text = sections_by_name(image)["__TEXT,__text"]
+        self.assertEqual(buf[text.offset:text.offset + text.size], "\x90" * 16)
+        self.assertEqual([buf[s:e] for s, e in image.ranges(["__DATA"])], ["\x01" * 8])
+        self.assertEqual([buf[s:e] for s, e in image.ranges(["__TEXT,__const", "__LINKEDIT"])],
+                         ["abcd", "sym"])
+
+    def test_fat_picks_x86_64(self):
+        x86_64 = macho.build(SECTIONS)
+        buf = macho.build_fat([(CPU_TYPE_ARM64, macho.build([("__TEXT", "__text", "arm")],
+                                                            cputype=CPU_TYPE_ARM64)),
+                               (macho.CPU_TYPE_X86_64, x86_64),
+                               (CPU_TYPE_I386, "i386")])
+        image = macho.parse(buf)
+        self.assertEqual(buf[image.slice_offset:image.slice_offset + image.slice_size], x86_64)
+        data = sections_by_name(image)["__DATA,__data"]
+        self.assertEqual(buf[data.offset:data.offset + data.size], "\x01" * 8)
+        self.assertEqual(image.ranges(), [(image.slice_offset, image.slice_offset + len(x86_64))])
+
+    def test_file_offset(self):
+        image = macho.parse(macho.build(SECTIONS))
+        data = sections_by_name(image)["__DATA,__data"]
+        # build() puts each segment at the address of its file offset
+        self.assertEqual(image.file_offset(data.offset + 3), data.offset + 3)
+        self.assertIsNone(image.file_offset(1 << 40))
+
+    def test_not_macho(self):
+        self.assertIsNone(macho.parse(""))
+        self.assertIsNone(macho.parse("\x7fELF" + "\0" * 60))
+        # A Java class file
+        self.assertIsNone(macho.parse("\xca\xfe\xba\xbe\x00\x00\x00\x34" + "\0" * 32))
+
+    def test_no_x86_64_slice(self):
+        buf = macho.build_fat([(CPU_TYPE_ARM64, macho.build(SECTIONS, cputype=CPU_TYPE_ARM64))])
+        self.assertRaises(macho.MachOError, macho.parse, buf)
+
+    def test_thin_other_architecture(self):
+        self.assertRaises(macho.MachOError, macho.parse, macho.build(SECTIONS, cputype=CPU_TYPE_ARM64))
+
+    def assertMachOError(self, buf):
+        try:
+            macho.parse(buf)
+        except macho.MachOError:
+            pass
+        else:
+            self.fail("no MachOError for %r" % buf[:40])
+
+    def test_truncated(self):
+        thin = macho.build(SECTIONS)
+        for n in (8, 31, 32, 100):
+            self.assertMachOError(thin[:n])
+        fat = macho.build_fat([(CPU_TYPE_ARM64, "arm"), (macho.CPU_TYPE_X86_64, thin)])
+        # In the fat header, in the x86_64 slice's header, and in its contents
+        for n in (12, 30, 4096 + 16, len(fat) - 1):
+            self.assertMachOError(fat[:n])
+
+    def test_bad_magic_in_slice(self):
+        fat = macho.build_fat([(macho.CPU_TYPE_X86_64, "\xde\xad\xbe\xef" + macho.build(SECTIONS)[4:])])
+        self.assertMachOError(fat)
+
+    def test_bad_load_commands(self):
+        thin = macho.build(SECTIONS)
+        # A segment command too short to hold a segment
+        short = thin[:32] + struct.pack("<II", macho.LC_SEGMENT_64, 16) + thin[40:]
+        self.assertMachOError(short)
+        # More commands than sizeofcmds holds
+        many = thin[:16] + struct.pack("<I", 100) + thin[20:]
+        self.assertMachOError(many)
+
+
+if __name__ == "__main__":
+    unittest.main()
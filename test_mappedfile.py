@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mappedfile
+
+CONTENTS = "".join(chr(i % 251) for i in range(64 * 1024))
+
+
+class MappedFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "binary")
+        with open(self.filename, "wb") as f:
+            f.write(CONTENTS)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def edit(self, m, expected, offsets, data="XYZ"):
+        for off in offsets:
+            m[off:off + len(data)] = data
+            expected[off:off + len(data)] = data
+
+    def test_edits(self):
+        m = mappedfile.MappedFile(self.filename)
+        expected = bytearray(CONTENTS)
+        self.edit(m, expected, [100, 102, 5000, 4998, 60000])
+        self.assertEqual(m[0:len(m)], str(expected))
+        self.assertEqual(len(m.edit_starts), 3)
+        for sub in ("XYZ", "ZYZ", CONTENTS[4990:5010], CONTENTS[200:210]):
+            for start in (0, 101, 4999, 5001):
+                self.assertEqual(m.find(sub, start), expected.find(sub, start), (sub, start))
+        self.assertRaises(ValueError, m.__setitem__, slice(0, 2), "abc")
+        m.close()
+
+    def test_view(self):
+        m = mappedfile.MappedFile(self.filename, max_edits=4)
+        m[0:3] = "abc"
+        v = m.view()
+        self.assertEqual(v[0:3], CONTENTS[0:3])
+        self.assertEqual(v.max_edits, 4)
+        v.close()
+        self.assertEqual(m[0:3], "abc")
+        m.close()
+
+    def test_copied_past_max_edits(self):
+        m = mappedfile.MappedFile(self.filename, max_edits=4)
+        expected = bytearray(CONTENTS)
+        self.edit(m, expected, range(0, 40, 10))
+        self.assertIsNone(m.flat)
+        self.edit(m, expected, [1000])
+        self.assertIsNotNone(m.flat)
+        self.assertEqual(m.edit_size(), len(CONTENTS))
+        self.edit(m, expected, [2000])
+        self.assertEqual(m[0:len(m)], str(expected))
+        self.assertEqual(m.find("XYZ", 1001), expected.find("XYZ", 1001))
+        m.close()
+
+    def test_no_limit(self):
+        m = mappedfile.MappedFile(self.filename, max_edits=None)
+        expected = bytearray(CONTENTS)
+        self.edit(m, expected, range(0, 10000, 10))
+        self.assertIsNone(m.flat)
+        self.assertEqual(len(m.edit_starts), 1000)
+        self.assertEqual(m[0:len(m)], str(expected))
+        m.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
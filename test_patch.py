@@ -0,0 +1,38 @@
+import plistlib
+import unittest
+
+import patch
+
+
+def make_patch(find, mask_find=None):
+    d = {"Find": plistlib.Data(find), "Replace": plistlib.Data(find), "Comment": "test"}
+    if mask_find is not None:
+        d["MaskFind"] = plistlib.Data(mask_find)
+    return patch.Patch(d)
+
+
+class FindNearTest(unittest.TestCase):
+    def test_near(self):
+        buf = bytearray("....abcdefgh....abXdefgh....aXcdeYgh")
+        self.assertEqual(make_patch("abcdefgh").find_near(buf, 2),
+                         [(4, []), (16, [(2, ord("c"), ord("X"))]),
+                          (28, [(1, ord("b"), ord("X")), (5, ord("f"), ord("Y"))])])
+
+    def test_limit(self):
+        buf = bytearray("abcd" * 10)
+        self.assertEqual(len(make_patch("abcd").find_near(buf, 1, limit=3)), 3)
+
+    def test_too_short_for_k(self):
+        # Every place would be within k, so none are suggested
+        buf = bytearray("x" * 1000)
+        self.assertEqual(make_patch("ab").find_near(buf, 2), [])
+        self.assertEqual(make_patch("abcd", mask_find="\xff\0\0\0").find_near(buf, 1), [])
+
+    def test_masked(self):
+        buf = bytearray("..aQcd..aRcX..")
+        self.assertEqual([off for off, _ in make_patch("abcd", mask_find="\xff\0\xff\xff").find_near(buf, 1)],
+                         [2, 8])
+
+
+if __name__ == "__main__":
+    unittest.main()
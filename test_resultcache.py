@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import resultcache
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "patch-results.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_key_depends_on_masks(self):
+        key = resultcache.ResultCache.key
+        plain = key("0" * 64, (("ab", "cd", False, "", ""),))
+        self.assertNotEqual(plain, key("0" * 64, (("ab", "cd", False, "\xff\x0f", ""),)))
+        self.assertNotEqual(plain, key("0" * 64, (("ab", "cd", False, "", "\xff\x0f"),)))
+        self.assertNotEqual(plain, key("0" * 64, (("ab", "cd", True, "", ""),)))
+
+    def test_round_trip(self):
+        cache = resultcache.ResultCache(self.filename)
+        cache.put("k", [[1, 2], []], "f" * 64)
+        cache.save()
+        self.assertEqual(resultcache.ResultCache(self.filename).get("k"), [[1, 2], []])
+
+    def test_other_version_discarded(self):
+        with open(self.filename, "wb") as f:
+            json.dump({"version": resultcache.ResultCache.version + 1,
+                       "entries": {"k": {"offsets": [[1]], "patched": "", "used": 0}}}, f)
+        cache = resultcache.ResultCache(self.filename)
+        self.assertIsNone(cache.get("k"))
+        cache.put("j", [[3]], "f" * 64)
+        cache.save()
+        with open(self.filename, "rb") as f:
+            self.assertEqual(sorted(json.load(f)["entries"]), ["j"])
+
+    def test_evicts_least_recently_used(self):
+        cache = resultcache.ResultCache(self.filename)
+        for i, key in enumerate("abc"):
+            cache.put(key, [[i]], "f" * 64)
+            cache.entries[key]["used"] = i
+        cache.max_bytes = cache.entries["a"]["size"] * 2
+        cache.save()
+        self.assertEqual(sorted(resultcache.ResultCache(self.filename).entries), ["b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import time
+
+# Wait for files to change, for the checkers' --watch mode.
+#
+# On Linux, inotify (through ctypes; there is no inotify in the standard
+# library) wakes us up when something in a watched file's directory
+# changes. Elsewhere we poll. Either way, a file counts as changed when
+# its mtime or size differ from what we last saw.
+
+log = logging.getLogger("watch")
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+# Editors often save by writing a new file and renaming it over the
+# old one, so watch directories rather than files.
+_inotify_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+class Watcher:
+    def __init__(self, paths=(), interval=1.0, settle=0.2):
+        """
+        :param paths: files to watch
+        :param interval: seconds between polls, without inotify
+        :param settle: seconds to wait for more changes after the first
+        """
+        self.interval = interval
+        self.settle = settle
+        self.signatures = {}
+        self.watched_dirs = set()
+        self.inotify_fd = None
+        self.libc = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init()
+            if fd >= 0:
+                self.libc = libc
+                self.inotify_fd = fd
+        except (OSError, AttributeError):
+            pass
+        if self.inotify_fd is None:
+            log.debug("inotify not available, polling every %.1fs", interval)
+        self.add(paths)
+
+    def add(self, paths):
+        """Watch more files. Files already watched keep their last state."""
+        for path in paths:
+            path = os.path.abspath(path)
+            if path in self.signatures:
+                continue
+            self.signatures[path] = _signature(path)
+            directory = os.path.dirname(path)
+            if self.inotify_fd is not None and directory not in self.watched_dirs:
+                wd = self.libc.inotify_add_watch(self.inotify_fd, directory, _inotify_mask)
+                if wd < 0:
+                    log.warning("cannot watch %s: %s", directory,
+                                os.strerror(ctypes.get_errno()))
+                self.watched_dirs.add(directory)
+
+    def changed(self):
+        """Return the watched files that changed since we last looked."""
+        changed = set()
+        for path, sig in self.signatures.items():
+            new_sig = _signature(path)
+            if new_sig != sig:
+                self.signatures[path] = new_sig
+                changed.add(path)
+        return changed
+
+    def _sleep(self, timeout):
+        if self.inotify_fd is None:
+            time.sleep(timeout if timeout is not None else self.interval)
+            return
+        try:
+            ready, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # We only care that something happened, not what
+            os.read(self.inotify_fd, 65536)
+
+    def wait(self):
+        """Block until some watched files change, and return them.
+
+        :rtype: set[str]
+        """
+        while True:
+            self._sleep(None)
+            changed = self.changed()
+            if changed:
+                # Let a burst of writes finish
+                time.sleep(self.settle)
+                changed |= self.changed()
+                return changed